@@ -12,14 +12,33 @@
 # Compatible with readability.js 1.7.1, except the multi-page part
 from __future__ import generators
 
-import htmlentitydefs
+import cPickle
+import hashlib
 import logging
+import multiprocessing
+import os
 import re
+import select
+import threading
+import time
 import urllib
+import urllib2
 import urlparse
 
+from collections import OrderedDict
 from string import punctuation
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    # the futures backport on Python 2
+    from concurrent import futures as concurrent_futures
+except ImportError:
+    concurrent_futures = None
+
 __READABILITY_VERSION__ = '1.7.1'
 __BEAUTIFULSOUP_VERSION = '3.2.0'
 __VERSION__ = '1.7.1.12'
@@ -35,6 +54,7 @@ negativeRe = re.compile(
     'combx|comment|com-|contact|foot|footer|footnote|link|masthead|media|meta|outbrain|promo|related|scroll|shoutbox|sidebar|sponsor|shopping|tags|tool|widget',
     re.IGNORECASE)
 extraneousRe = re.compile('print|archive|comment|discuss|e[\-]?mail|share|reply|all|login|sign|single', re.IGNORECASE)
+DIV_TO_P_ELEMENTS = frozenset(['a', 'blockquote', 'dl', 'div', 'img', 'ol', 'p', 'pre', 'table', 'ul'])
 divToPElementsRe = re.compile('<(a|blockquote|dl|div|img|ol|p|pre|table|ul)', re.IGNORECASE)
 replaceBrsRe = re.compile('(<br[^>]*>[ \n\r\t]*){2,}', re.IGNORECASE | re.MULTILINE)
 replaceFontsRe = re.compile('<(/?)font[^>]*>', re.IGNORECASE | re.MULTILINE)
@@ -44,10 +64,17 @@ killBreaksRe = re.compile('(<br\s*/?>(\s|&nbsp;?)*){1,}', re.MULTILINE)
 killMoreBreaksRe = re.compile('<br[^>]*>\s*<p', re.MULTILINE)
 videoRe = re.compile('(youtube|vimeo|blip|slideshare|brightcove)\.(com|tv|net)', re.IGNORECASE)
 unknownRe = re.compile('\.( |$)')
+# descendant counters kept by Readability._conditional_features; embeds and objects share a counter
+CONDITIONAL_COUNTERS = {'p': 0, 'img': 1, 'li': 2, 'input': 3, 'embed': 4, 'object': 4}
 skipFootnoteLink = re.compile('^\s*(\[?[a-z0-9]{1,2}\]?|^|edit|citation needed)\s*$', re.IGNORECASE)
 nextLinkRe = re.compile('(next|weiter|continue|>([^\|]|$)|»([^\|]|$))',
                         re.IGNORECASE) # Match: next, continue, >, >>, ¬ª but not >|, ¬ª| as those usually mean last.
 prevLinkRe = re.compile('(prev|earl|old|new|<|«)', re.IGNORECASE)
+paginateRe = re.compile('pag(e|ing|inat)', re.IGNORECASE)
+extPaginateRe = re.compile('p(a|g|ag)?(e|ing|ination)?(=|\/)[0-9]{1,2}', re.IGNORECASE)
+nextLinkWordRe = re.compile('next|weiter|continue', re.IGNORECASE)
+markupTagRe = re.compile('<[^>]*>')
+entityRe = re.compile('&#?\w+;')
 wordSplitRe = re.compile('(\s|&nbsp;|&#160;|&#xA0)+', re.UNICODE)
 
 READ_STYLES = ('style-newspaper', 'style-novel', 'style-athelas', 'style-ebook', 'style-apertura')
@@ -72,13 +99,31 @@ _DEFAULT_SETTINGS = {
     'read_margin': 'margin-medium',
     'read_size': 'size-medium',
     'strip_unlike': True,
+    'prune_unlike': False,
     'weight_classes': True,
-    'clean_conditionally': True
+    'clean_conditionally': True,
+    'extract_only': False,
+    'max_pages': 30,
+    'page_fetchers': 4
 }
 
 
+def _effective_conf(footnote_links, settings):
+    ''' The settings a Readability works with: the defaults, updated with settings and footnote_links '''
+    conf = _DEFAULT_SETTINGS.copy()
+    conf.update(settings)
+    conf['footnote_links'] = footnote_links
+    conf['readable_footnote_links'] = conf['footnote_links'] and conf['readable_footnote_links']
+    return conf
+
+
+# Processing settings dropped one at a time, in this order, when _grabArticle comes back with too little content
+_FALLBACK_SETTINGS = ('strip_unlike', 'weight_classes', 'clean_conditionally')
+
+
 class Readability(object):
-    def __init__(self, content, url=None, footnote_links=False, **settings):
+    def __init__(self, content, url=None, footnote_links=False, trace=None, charset=None, fetcher=None,
+                 locators=None, **settings):
         ''' Supported settings:
 
         - footnote_links: extract a set of footnotes from all links in content
@@ -90,34 +135,162 @@ class Readability(object):
         - read_size: formatting setting
 
         - strip_unlike: processing setting
+        - prune_unlike: processing setting, drops the unlikely candidates strip_unlike removes while parsing,
+          so they are never built unless the strip_unlike fallback needs them. The title and next page link
+          searches don't see them
         - weight_classes: processing setting
         - clean_conditionally: processing setting
+        - extract_only: processing setting, process_document only extracts the title, the article and its
+          footnotes (see get_article). The reader page is built the first time get_html, iter_html, write_html
+          or get_doc is called
+
+        - max_pages: multi-page setting, the most pages an article is assembled from, this one included
+        - page_fetchers: multi-page setting, how many following pages are fetched and extracted at a time
+
+        trace is an optional callable that gets called as trace(event, fields) for each step of the
+        extraction, fields being a dict of the event's values (nodes are passed as Tags). Events:
+
+        - node_removed: node, reason
+        - node_retagged: node, name
+        - text_wrapped: node
+        - candidate_scored: node, score
+        - top_candidate: node, score
+        - sibling_checked: node, score, appended
+        - unknown_score: node
+        - conditional_check: node, weight, score
+        - class_removed: node, value
+        - list_fixed: node
+        - title_candidate: source, node
+        - title_candidates: titles
+        - next_page_links: links
+        - next_page_skipped: href, reason
+        - next_page_appended: href, page
+        - locator_checked: node, accepted
+        - locator_learned: domain, steps
+        - missing_url
+
+        Nothing is computed for an event unless a trace is set. With __DEBUG__ on, the default is log_trace.
+
+        charset is the encoding a byte string content was served with, as in an HTTP Content-Type header. It is
+        tried before the one the document declares, and when it decodes the content the document is neither
+        sniffed for another one nor parsed a second time after a META tag.
+
+        fetcher turns on multi-page articles: it is called as fetcher(url) for the pages the next page links
+        point to, from several threads at a time, and returns the page's content, a (content, charset) tuple,
+        or None if there is no such page; fetch_page is one. The article of each following page is appended
+        to the article, instead of a list of next page links.
+
+        locators is a LocatorStore. When the url's domain has a locator, the top candidate is looked up with it
+        and only the paragraphs under its parent are scored. It is used if it passes a sanity check, which
+        includes outscoring the other candidates there, and its siblings are gathered as usual. Full scoring
+        is the fallback, and its top candidates teach the store the locators.
         '''
-        self._conf = _DEFAULT_SETTINGS.copy()
-        self._conf.update(settings)
-        self._conf['footnote_links'] = footnote_links
-        self._conf['readable_footnote_links'] = self._conf['footnote_links'] and self._conf['readable_footnote_links']
+        self._conf = _effective_conf(footnote_links, settings)
 
         self._url = url or ""
+        self._charset = charset
+        self._fetcher = fetcher
+        self._locators = locators
+        if trace is None and __DEBUG__:
+            trace = log_trace
+        self._trace = trace
+        self._timings = []
+        # candidate scores of the last _grabArticle attempt: id(node) -> {'node': node, 'contentScore': score}
+        self._scores = {}
+        # what a _grabArticle attempt that may be retried changed in the document, for _undo_changes
+        self._changes = None
 
         self.content = replaceBrsRe.sub('</p><p>', content)
-        try:
-            self._osoup = ICantBelieveItsBeautifulSoup(self.content)
-        except TypeError:
-            raise ValueError('content cannot be converted to unicode')
+        self._parse(self._conf['strip_unlike'] and self._conf['prune_unlike'])
         #    dbg("content: %s" % self._osoup)
-        self._fsoup = ICantBelieveItsBeautifulSoup(Readability.OUTPUT_BODY % self._conf)
+        # the reader page, built by _build_page
+        self._fsoup = None
+        # a document holding the head, title and article, in page order, as extracted and post-processed by
+        # process_document
+        self._pageParts = None
+        self._footnotesWrapper = None
         self._articleBody = u''
         self._articleTitle = u''
         self._articleFootnotes = []
 
+    def _parse(self, prune):
+        ''' Parses the content into _osoup, leaving out the unlikely candidates if prune is set.
+
+        Pruning is only kept when the document has an html and a head element: _prepare_document rebuilds
+        documents that lack one around their tags, unlikely candidates included. '''
+        start = time.time()
+        pruneThese = None
+        if prune:
+            pruneThese = [SoupStrainer(is_unlikely_candidate)]
+        try:
+            self._osoup = ReadabilitySoup(self.content, fromEncoding=self._charset,
+                                          skipThese=ReadabilitySoup.UNREADABLE_ELEMENTS, pruneThese=pruneThese)
+        except TypeError:
+            raise ValueError('content cannot be converted to unicode')
+        self._timings.append(('parse', time.time() - start))
+        if self._osoup.prunedElements and not (self._osoup.html and self._osoup.head):
+            self._parse(False)
+        elif self._trace:
+            for tag, _, _, _ in self._osoup.prunedElements:
+                self._trace('node_removed', {'node': tag, 'reason': 'unlikely candidate'})
+
+    def _restore_pruned(self, prepared, wanted=None):
+        ''' Puts the unlikely candidates pruned from the prepared document back where they were, parsing each
+        one on its own, or only those whose markup wanted returns true for. Returns the document, which is
+        parsed and prepared anew, without pruning, if one of them can't be put back that way '''
+        start = time.time()
+        grafts = []
+        kept = []
+        inserted = {}
+        for tag, parent, index, markup in prepared.prunedElements:
+            if markup is not None and wanted is not None and not wanted(markup):
+                kept.append((tag, parent, index + inserted.get(id(parent), 0), markup))
+                continue
+            if markup is None or parent._documentRoot() is not prepared:
+                grafts = None
+                break
+            # a trailing '<' gives the last token of the markup the same lookahead it had in the document;
+            # it is then dropped as incomplete
+            element = ReadabilitySoup(markup + '<', markupMassage=False,
+                                      skipThese=ReadabilitySoup.UNREADABLE_ELEMENTS)
+            index += inserted.get(id(parent), 0)
+            if len(element.contents) != 1 or index > len(parent.contents):
+                grafts = None
+                break
+            inserted[id(parent)] = inserted.get(id(parent), 0) + 1
+            grafts.append((parent, index, element.contents[0]))
+
+        if grafts is None:
+            self._parse(False)
+            self._prepare_document()
+            prepared = self._osoup
+        else:
+            for parent, index, element in grafts:
+                parent.insert(index, element)
+                self._prepare_elements([element] + element.findAll(['font', 'textarea']))
+            prepared.prunedElements = kept
+        self._timings.append(('restore_pruned', time.time() - start))
+        return prepared
+
     def get_html(self, prettyPrint=False, removeComments=True):
+        return ''.join(self.iter_html(prettyPrint, removeComments))
+
+    def iter_html(self, prettyPrint=False, removeComments=True, encoding='utf-8'):
+        ''' Yields the output of get_html in chunks, rendered and cleaned as they are yielded. Chunks are
+        Unicode if encoding is None '''
+        self._build_page()
         if removeComments:
-            [comment.extract() for comment in self._fsoup.findAll(text=lambda text: isinstance(text, Comment))]
+            extract_many(self._fsoup.findAll(text=lambda text: isinstance(text, Comment)))
 
-        output = self._fsoup.renderContents(prettyPrint=prettyPrint)
-        output = clean_extraspaces(output)
-        return output
+        for chunk in clean_extraspaces_chunks(self._fsoup.iterRender(None, prettyPrint, contentsOnly=True)):
+            if encoding:
+                chunk = chunk.encode(encoding)
+            yield chunk
+
+    def write_html(self, out, prettyPrint=False, removeComments=True, encoding='utf-8'):
+        ''' Writes the output of get_html to the file-like object out, a chunk at a time '''
+        for chunk in self.iter_html(prettyPrint, removeComments, encoding):
+            out.write(chunk)
 
     def get_doc(self, removeComments=True):
         """ Returns the output as a BeautifulSoup object.
@@ -129,22 +302,55 @@ class Readability(object):
         return self._articleTitle
 
     def get_article_body(self):
-        return self._articleBody.renderContents(prettyPrint=False)
+        return ''.join(self.iter_article_body())
+
+    def iter_article_body(self, encoding='utf-8'):
+        ''' Yields the output of get_article_body in chunks, rendered as they are yielded, without building the
+        reader page. Chunks are Unicode if encoding is None '''
+        return self.get_article().iter_render(encoding)
+
+    def write_article_body(self, out, encoding='utf-8'):
+        ''' Writes the output of get_article_body to the file-like object out, a chunk at a time '''
+        self.get_article().write(out, encoding)
 
     def get_article_footnotes(self):
         return self._articleFootnotes
 
+    def get_article(self):
+        ''' Returns the title, the article and its footnotes as a ReadabilityArticle, without building the
+        reader page '''
+        return ReadabilityArticle(self._articleTitle, self._articleBody, self._articleFootnotes)
+
+    def get_timings(self):
+        ''' Returns a list of (pass, seconds) tuples, in the order the passes ran.
+
+        Every _grabArticle attempt is reported as 'grab_article' followed by the fallback
+        settings that were turned off for it, e.g. 'grab_article -strip_unlike'. The cost
+        of undoing what a failed attempt changed in the document is reported as 'undo'.
+        '''
+        return list(self._timings)
+
+    def get_content_scores(self):
+        ''' Returns the candidates scored by the last extraction attempt as a list of
+        (node, contentScore) tuples, best candidate first. '''
+        scores = [(entry['node'], entry['contentScore']) for entry in self._scores.values()]
+        scores.sort(key=lambda score: score[1], reverse=True)
+        return scores
+
     def process_document(self):
+        start = time.time()
         self._prepare_document()
+        self._timings.append(('prepare', time.time() - start))
         #    dbg("_prepare_document:content: %s" % self._osoup)
 
         nextPageLinks = self._find_next_page_link()
-        dbg("nextPageLinks: %s" % nextPageLinks)
+        if self._trace:
+            self._trace('next_page_links', {'links': nextPageLinks})
 
         article_title = self._getArticleTitle()
 
         if not len(self._osoup.findAll('body')):
-            articleContent = Tag(self._fsoup, 'p')
+            articleContent = Tag(self._osoup, 'p')
             articleContent.setString(
                 "Sorry, readability was unable to parse this page for content. If you feel like it should have been able to, please <a href='http://code.google.com/p/arc90labs-readability/issues/entry'>let us know by submitting an issue.</a>")
         else:
@@ -154,19 +360,20 @@ class Readability(object):
             # that may mean we stripped out the actual content so we couldn't parse it. So re-run init while preserving
             # unlikely candidates to have a better shot at getting our content out properly.
             #
-            if (not articleContent) or (len(get_inner_text(articleContent)) == 0):
-                articleContent = Tag(self._fsoup, 'p')
+            if (not articleContent) or (get_text_stats(articleContent)[0] == 0):
+                articleContent = Tag(self._osoup, 'p')
                 articleContent.setString(
                     "Sorry, readability was unable to parse this page for content. If you feel like it should have been able to, please <a href='http://code.google.com/p/arc90labs-readability/issues/entry'>let us know by submitting an issue.</a>")
             else:
-                if nextPageLinks:
-                    pagesep = Tag(self._fsoup, 'p', attrs=[('class', 'readability-page-separator')])
+                # with a fetcher the following pages are appended to the article, and only listed if none can be
+                if nextPageLinks and not (self._fetcher and self._append_next_pages(articleContent, nextPageLinks)):
+                    pagesep = Tag(self._osoup, 'p', attrs=[('class', 'readability-page-separator')])
                     pagesep.setString('&#167;')
                     articleContent.append(pagesep)
-                    continuationparagraph = Tag(self._fsoup, 'p', attrs=[('class', 'readability-page-pagination')])
+                    continuationparagraph = Tag(self._osoup, 'p', attrs=[('class', 'readability-page-pagination')])
                     continuationparagraph.setString("Continuation: ")
                     for idx, nextPage in enumerate(nextPageLinks):
-                        nextPageLink = Tag(self._fsoup, 'a',
+                        nextPageLink = Tag(self._osoup, 'a',
                                            attrs=[('class', 'readability-page-next'), ('href', nextPage['href'])])
                         nextPageLink.setString("%s" % (idx + 2))
                         continuationparagraph.append(nextPageLink)
@@ -175,17 +382,42 @@ class Readability(object):
 
         self._articleBody = articleContent
 
+        head = self._osoup.head
+        if not head:
+            head = Tag(self._osoup, 'head')
+        # a document of its own, so that post-processing finds tags from its tag index
+        self._pageParts = ReadabilitySoup('')
+        self._pageParts.append(head)
+        self._pageParts.append(article_title)
+        self._pageParts.append(articleContent)
+
+        start = time.time()
+        self._post_process_content()
+        self._timings.append(('post_process', time.time() - start))
+
+        if not self._conf['extract_only']:
+            self._build_page()
+
+    def _build_page(self):
+        ''' Puts the extracted parts in the reader page, along with the footnotes, the footer and the
+        stylesheets. Does nothing once the page is built '''
+        if self._fsoup is not None:
+            return
+        self._fsoup = ReadabilitySoup(Readability.OUTPUT_BODY % self._conf)
+        if self._pageParts is None:
+            return
+        head, article_title, articleContent = list(self._pageParts.contents)
+
         divInner = self._fsoup.find('div', attrs={'id': 'readInner'})
         divInner.append(article_title)
         #    if self._url:
         #      divInner.append(self._get_article_link())
         divInner.append(articleContent)
+        if self._footnotesWrapper is not None:
+            divInner.append(self._footnotesWrapper)
         divInner.append(self._getArticleFooter(article_title))
 
         # prepare head
-        head = self._osoup.find('head')
-        if not head:
-            head = Tag(self._fsoup, 'head')
         screen_stylesheet = Tag(self._fsoup, 'link', attrs=[('rel', 'stylesheet'),
                                                             ('href',
                                                              'http://lab.arc90.com/experiments/readability/css/readability.css'),
@@ -206,15 +438,91 @@ class Readability(object):
                                                        ('type', 'text/javascript'),
                                                        ('charset', 'UTF-8')])
 
-        self._fsoup.find('html').insert(0, head)
-        head = self._fsoup.find('head')
+        self._fsoup.html.insert(0, head)
         head.append(screen_stylesheet)
         head.append(print_stylesheet)
         head.append(inline_stylesheet)
         head.append(typekit_css)
         head.append(typekit_js)
 
-        self._post_process_content()
+    def _append_next_pages(self, articleContent, nextPageLinks):
+        ''' Appends the articles of the following pages to articleContent, each in a readability-page div after
+        a page separator. Follows the best next page link of each page, fetching the next page_fetchers
+        candidates ahead, up to max_pages pages. Pages whose article is the same as one already there are left
+        out. Returns the number of pages appended '''
+        fetchers = self._conf['page_fetchers']
+        slots = threading.Semaphore(fetchers)
+        loaders = {}
+        parsed = set([self._url, self._url.rstrip('/')])
+        digests = set([_page_digest(articleContent)])
+        pageNum = 1
+        links = nextPageLinks
+        while pageNum < self._conf['max_pages']:
+            candidates = [link['href'] for link in links if link['href'] not in parsed]
+            for href in candidates[:fetchers]:
+                if href not in loaders and len(loaders) < self._conf['max_pages'] - 1:
+                    loaders[href] = _PageLoader(self, href, slots)
+            if not candidates or candidates[0] not in loaders:
+                break
+            href = candidates[0]
+            parsed.add(href)
+            loader = loaders[href].wait()
+            if loader.content is None:
+                # try the next best link of the same page
+                if self._trace:
+                    self._trace('next_page_skipped', {'href': href, 'reason': loader.error or 'no content'})
+                continue
+            links = loader.nextPageLinks
+            digest = _page_digest(loader.content)
+            if digest in digests:
+                if self._trace:
+                    self._trace('next_page_skipped', {'href': href, 'reason': 'duplicate page'})
+                continue
+            digests.add(digest)
+
+            pageNum += 1
+            pagesep = Tag(self._osoup, 'p', attrs=[('class', 'readability-page-separator'),
+                                                   ('title', 'Page %s' % pageNum)])
+            pagesep.setString('&#167;')
+            articleContent.append(pagesep)
+            page = Tag(self._osoup, 'div', attrs=[('id', 'readability-page-%s' % pageNum),
+                                                  ('class', 'readability-page')])
+            move_children(loader.content, page)
+            articleContent.append(page)
+            if self._trace:
+                self._trace('next_page_appended', {'href': href, 'page': page})
+        # the candidates fetched ahead that weren't followed: those still waiting for a slot are not fetched
+        for href, loader in loaders.items():
+            if href not in parsed:
+                loader.cancel()
+        return pageNum - 1
+
+    def _load_page(self, url):
+        ''' Fetches a following page and extracts its article, for _append_next_pages. Returns the article, or
+        None if there is none, and the page's next page links '''
+        fetched = self._fetcher(url)
+        charset = None
+        if isinstance(fetched, tuple):
+            fetched, charset = fetched
+        if not fetched:
+            return None, []
+        settings = self._conf.copy()
+        footnote_links = settings.pop('footnote_links')
+        page = Readability(fetched, url, footnote_links, charset=charset, **settings)
+        page._prepare_document()
+        nextPageLinks = page._find_next_page_link()
+        if not page._osoup.findAll('body'):
+            return None, nextPageLinks
+        articleContent = page._grabArticle()
+        if (not articleContent) or (get_text_stats(articleContent)[0] == 0):
+            return None, nextPageLinks
+        # links and images are made absolute against the page's url, the rest of the post-processing is left
+        # to the article the page is appended to
+        page._pageParts = ReadabilitySoup('')
+        page._pageParts.append(articleContent)
+        page._fix_links()
+        page._fix_image_sources()
+        return articleContent, nextPageLinks
 
     def _get_article_link(self):
         art_link = Tag(self._fsoup, 'p')
@@ -230,7 +538,8 @@ class Readability(object):
         return articleFooter
 
     def _post_process_content(self):
-        ''' Adds footnotes for links, fixes images floats '''
+        ''' Adds footnotes for links, fixes images floats. Works on the extracted parts, before they are put
+        in the reader page '''
         # remove extra class attributes
         self._clean_class_attr()
 
@@ -245,33 +554,32 @@ class Readability(object):
 
 
     def _clean_class_attr(self):
-        real_body = self._fsoup.find('div', attrs={'id': 'readability-content'})
+        real_body = self._pageParts.find('div', attrs={'id': 'readability-content'})
         if real_body:
-            for e in real_body.findAll(attrs={'class': True}):
+            for e in real_body.select('[class]'):
                 cls = e['class']
                 # I can do better here
                 if cls.find('readability') == -1:
-                    dbg("clean_class_attr %s (%s)" % (e.name, e['class']))
+                    if self._trace:
+                        self._trace('class_removed', {'node': e, 'value': cls})
                     del e['class']
 
     def _fix_lists(self):
         ''' sometimes the DOM ends up with LI elements without parents '''
-        for li in self._fsoup.findAll('li'):
+        for li in self._pageParts.findAll('li'):
             if li.parent and li.parent.name in ('ul', 'ol'):
                 continue
                 # must append ul
-            dbg("_fix_lists: missing UL/OL")
-            ul = Tag(self._fsoup, 'ul')
-            new_li = Tag(self._fsoup, 'li', attrs=li.attrs)
-            for c in [c for c in li.contents]:
-                new_li.append(c)
+            ul = Tag(self._osoup, 'ul')
+            new_li = Tag(self._osoup, 'li', attrs=li.attrs)
+            move_children(li, new_li)
             ul.append(new_li)
             sibling = li.nextSibling
             siblings = []
             while sibling:
                 if isinstance(sibling, NavigableString):
                     if sibling.strip(' \n\r\t'):
-                        nli = Tag(self._fsoup, 'li')
+                        nli = Tag(self._osoup, 'li')
                         nli.string = sibling
                         siblings.append(nli)
                     sibling = sibling.nextSibling
@@ -282,7 +590,8 @@ class Readability(object):
                     break
             for s in siblings:
                 ul.append(s)
-            dbg("_fix_lists: new UL: %s" % ul)
+            if self._trace:
+                self._trace('list_fixed', {'node': ul})
             li.replaceWith(ul)
 
     def _fix_links(self):
@@ -292,7 +601,7 @@ class Readability(object):
         hostname = "%s://%s" % (bits[0], bits[1])
         rel_uri = self._url[:self._url.rfind('/') + 1]
 
-        for link in self._fsoup.findAll('a'):
+        for link in self._pageParts.findAll('a'):
             if (not link.get('href')) or (link.get('class') == 'readability-DoNotFootnote') or (
             skipFootnoteLink.match(self.getInnerText(link))):
                 continue
@@ -309,33 +618,23 @@ class Readability(object):
 
 
     def _add_footnotes(self):
-        footnotesWrapper = self._fsoup.find({'id': 'readability-footnotes'})
-        articleFootnotes = self._fsoup.find({'id': 'readability-footnotes-list'})
-
-        if not footnotesWrapper:
-            footnotesWrapper = Tag(self._fsoup, 'div', attrs=[('id', 'readability-footnotes'),
-                                                              ('style', 'display:none')])
-            footnotesTitle = Tag(self._fsoup, 'h3')
-            footnotesTitle.setString('References')
-            footnotesWrapper.append(footnotesTitle)
-
-            articleFootnotes = Tag(self._fsoup, 'ol', attrs=[('id', 'readability-footnotes-list')])
-            footnotesWrapper.append(articleFootnotes)
-
-            readFooter = self._fsoup.find('div', attrs={'id': 'readFooter'})
-            if readFooter:
-                rf = readFooter
-                parent = rf.parent
-                readFooter.replaceWith(footnotesWrapper)
-                parent.append(rf)
-            else:
-                self._fsoup.find('div', attrs={'id': 'readInner'}).append(footnotesWrapper)
+        ''' Replaces the links with footnote references and collects the footnotes in _footnotesWrapper, which
+        _build_page puts above the footer '''
+        footnotesWrapper = Tag(self._osoup, 'div', attrs=[('id', 'readability-footnotes'),
+                                                          ('style', 'display:none')])
+        footnotesTitle = Tag(self._osoup, 'h3')
+        footnotesTitle.setString('References')
+        footnotesWrapper.append(footnotesTitle)
+
+        articleFootnotes = Tag(self._osoup, 'ol', attrs=[('id', 'readability-footnotes-list')])
+        footnotesWrapper.append(articleFootnotes)
+        self._footnotesWrapper = footnotesWrapper
 
         readable_links_uri = self._conf.get('service_uri')
         make_readable_links = self._conf['readable_footnote_links'] and readable_links_uri
 
-        linkCount = len(articleFootnotes.findAll('li'))
-        for link in self._fsoup.findAll('a'):
+        linkCount = 0
+        for link in self._pageParts.findAll('a'):
             if (not link.get('href')) or (link.get('class') == 'readability-DoNotFootnote') or (
             skipFootnoteLink.match(self.getInnerText(link))):
                 continue
@@ -346,10 +645,10 @@ class Readability(object):
 
             linkCount += 1
 
-            footnote = Tag(self._fsoup, 'li')
+            footnote = Tag(self._osoup, 'li')
             if make_readable_links:
                 url_bits = urlparse.urlparse(link['href'])
-                footnoteLink = Tag(self._fsoup, 'a', attrs=[('href', readable_links_uri % urllib.quote(link['href'])),
+                footnoteLink = Tag(self._osoup, 'a', attrs=[('href', readable_links_uri % urllib.quote(link['href'])),
                                                             ('class', 'readability-DoNotFootnote'),
                                                             ('name', "rfl-%s" % linkCount)])
                 footnoteLink.setString("".join(url_bits[1:]))
@@ -358,7 +657,7 @@ class Readability(object):
                     "<small>%s</small> (<small><a href='%s'>%s</a></small>) <small><a href='#readabilityLink-%s' title='Jump to Link in Article'>back &#8617;</a></small>" %
                     (footnoteLink, link['href'], url_bits[1], linkCount))
             else:
-                footnoteLink = Tag(self._fsoup, 'a', attrs=[('href', link.get('href')),
+                footnoteLink = Tag(self._osoup, 'a', attrs=[('href', link.get('href')),
                                                             ('class', 'readability-DoNotFootnote'),
                                                             ('name', "readabilityFootnoteLink-%s" % linkCount)])
                 footnoteLink.setString(link['href'])
@@ -390,23 +689,27 @@ class Readability(object):
         if linkCount > 0:
             footnotesWrapper['style'] = 'display:block;'
 
+    def _fix_image_sources(self):
+        if not self._url:
+            return
+        bits = urlparse.urlsplit(self._url)
+        hostname = "%s://%s" % (bits[0], bits[1])
+        rel_uri = self._url[:self._url.rfind('/') + 1]
+        for img in self._pageParts.select('img[src]'):
+            img_src = img['src']
+            if img_src.startswith('http'):
+                continue
+            elif img_src.startswith('/'):
+                img['src'] = hostname + img_src
+            else:
+                img['src'] = rel_uri + img_src
+
     def _fix_image_floats(self):
         imageWidthThreshold = 800 * MARGIN_RATIO[self._conf['read_margin']]
 
-        if self._url:
-            bits = urlparse.urlsplit(self._url)
-            hostname = "%s://%s" % (bits[0], bits[1])
-            rel_uri = self._url[:self._url.rfind('/') + 1]
-            for img in self._fsoup.findAll('img', attrs={'src': True}):
-                img_src = img['src']
-                if img_src.startswith('http'):
-                    continue
-                elif img_src.startswith('/'):
-                    img['src'] = hostname + img_src
-                else:
-                    img['src'] = rel_uri + img_src
+        self._fix_image_sources()
 
-        for img in self._fsoup.findAll('img'):
+        for img in self._pageParts.findAll('img'):
             width = self._get_size(img.get('width'))
             height = self._get_size(img.get('height'))
             if width:
@@ -437,14 +740,14 @@ class Readability(object):
 
     def _prepare_document(self):
         # let's firstly fix as much as possible the content
-        html_element = self._osoup.find('html')
+        html_element = self._osoup.html
         if not html_element:
             html_element = Tag(self._osoup, 'html')
             elements = [t for t in self._osoup.findAll(True)]
             for el in elements:
                 html_element.append(el)
             self._osoup.insert(0, html_element)
-        head_element = self._osoup.find('head')
+        head_element = self._osoup.head
         if not head_element:
             head_element = Tag(self._osoup, 'head')
             elements = [t for t in self._osoup.findAll(True) if t.name in ('title', 'meta', 'link')]
@@ -457,8 +760,7 @@ class Readability(object):
         if len(bodies) > 1:
             final_body = bodies[0]
             for b in bodies[1:]:
-                for c in [c for c in b.contents]:
-                    final_body.append(c)
+                move_children(b, final_body)
                 b.extract()
         elif len(bodies) == 0:
             body = Tag(self._osoup, 'body')
@@ -466,37 +768,35 @@ class Readability(object):
             for el in elements:
                 body.append(el)
             html_element.append(body)
-        self._osoup.find('body')['id'] = 'readabilityBody'
-
-        # remove all scripts
-        [script.extract() for script in self._osoup.findAll('script')]
+        self._osoup.body['id'] = 'readabilityBody'
 
-        # remove all stylesheets
-        [style.extract() for style in self._osoup.findAll('style')]
+        # scripts, stylesheets and style tags were left out by the parser (see ReadabilitySoup.UNREADABLE_ELEMENTS)
 
-        # remove all style tags in head
-        [link.extract() for link in self._osoup.findAll('link', attrs={'rel': 'stylesheet'})]
+        self._prepare_elements(self._osoup.findAll('font') + self._osoup.findAll('textarea'))
 
-        # remove fonts
-        for font in self._osoup.findAll('font'):
-            self._replace_element(self._osoup, font, 'span')
-
-        for ta in self._osoup.findAll('textarea'):
-            if ta.string:
-                ta.setString(ta.string.replace('<', '&lt;').replace('>', '&gt;'))
+    def _prepare_elements(self, elements):
+        ''' Turns the fonts among elements into spans and escapes the markup in its textareas '''
+        for node in elements:
+            # remove fonts
+            if node.name == 'font':
+                self._replace_element(node, 'span')
+            elif node.name == 'textarea' and node.string:
+                node.setString(node.string.replace('<', '&lt;').replace('>', '&gt;'))
 
     def _getArticleTitle(self):
-        articleTitle = Tag(self._fsoup, 'h1')
+        articleTitle = Tag(self._osoup, 'h1')
         title_element = self._osoup.find('title')
         candidate_title = None
         if title_element:
             candidate_title = self.getInnerText(title_element)
-            dbg("_get_article_title::candidate_title<title>: %s" % title_element)
+            if self._trace:
+                self._trace('title_candidate', {'source': 'title', 'node': title_element})
         else:
             h1s = self._osoup.findAll('h1')
             if h1s and len(h1s) == 1:
                 candidate_title = self.getInnerText(h1s[0])
-                dbg("_get_article_title::candidate_title<h1>: %s" % title_element)
+                if self._trace:
+                    self._trace('title_candidate', {'source': 'h1', 'node': h1s[0]})
 
         if not candidate_title:
             return articleTitle
@@ -551,7 +851,8 @@ class Readability(object):
 
                 possible_titles[innerText] = (score, tag, word_match_score)
 
-        dbg("_get_article_title::possible titles: %s" % possible_titles)
+        if self._trace:
+            self._trace('title_candidates', {'titles': possible_titles})
 
         if not len(possible_titles): # there aren't multiple possible titles
             if candidate_title:
@@ -585,143 +886,175 @@ class Readability(object):
 
 
     def _grabArticle(self):
-        def match_unlikely_candidates(node):
-            if not isinstance(node, Tag):
-                return False
-            if node.name == 'body':
-                return False
-            unlikelyMatchString = node.get('class', '') + node.get('id', '')
-            return unlikelyMatchString and \
-                   unlikelyCandidatesRe.search(unlikelyMatchString) and \
-                   not okMaybeItsACandidateRe.search(unlikelyMatchString)
+        ''' Runs the extraction and, if it comes back with less than 250 characters, retries it with
+        the _FALLBACK_SETTINGS turned off one by one.
+
+        The document is parsed and prepared only once: every attempt that can still be followed by
+        a retry records what it changes in the prepared tree, so a retry costs undoing those changes
+        and a re-score.
+        '''
+        while True:
+            can_retry = [key for key in _FALLBACK_SETTINGS if self._conf[key]]
+            if can_retry:
+                self._changes = []
+
+            start = time.time()
+            articleContent = self._grab_article_pass()
+            self._timings.append((' -'.join(['grab_article'] + [key for key in _FALLBACK_SETTINGS if not self._conf[key]]),
+                                  time.time() - start))
+
+            if not can_retry or get_text_stats(articleContent)[0] >= 250:
+                self._changes = None
+                return articleContent
+            start = time.time()
+            self._undo_changes()
+            self._timings.append(('undo', time.time() - start))
+            self._conf[can_retry[0]] = False
+            if can_retry[0] == 'strip_unlike' and self._osoup.prunedElements:
+                self._osoup = self._restore_pruned(self._osoup)
+
+    def _undo_changes(self):
+        ''' Puts the document back the way it was before the changes recorded in _changes, last change first '''
+        changes, self._changes = self._changes, None
+        for change in reversed(changes):
+            kind = change[0]
+            if kind == 'moved':
+                # (element, parent, index) in the order they can be inserted back in
+                for element, parent, index in change[1]:
+                    parent.insert(index, element)
+            elif kind == 'inserted':
+                change[1].extract()
+            elif kind == 'renamed':
+                node = change[1]
+                node.name = change[2]
+                node._reindex()
+            else:
+                node = change[1]
+                node.attrs = change[2]
+                node.attrMap = change[3]
+                node._reindex()
+
+    def _extract(self, elements):
+        ''' extract_many, recording where the elements were when the attempt may be retried '''
+        if self._changes is not None:
+            marked = set(id(element) for element in elements)
+            places = []
+            seen = set()
+            for element in elements:
+                parent = element.parent
+                if parent is not None and id(parent) not in seen:
+                    seen.add(id(parent))
+                    places.extend((child, parent, index) for index, child in enumerate(parent.contents)
+                                  if id(child) in marked)
+            self._changes.append(('moved', places))
+        extract_many(elements)
+
+    def _move(self, element, parent, index=None):
+        ''' Inserts element in parent, at its end by default, recording where it was when the attempt may be
+        retried '''
+        if self._changes is not None:
+            if element.parent is None:
+                self._changes.append(('inserted', element))
+            else:
+                self._changes.append(('moved', [(element, element.parent, element.parent.index(element))]))
+        if index is None:
+            index = len(parent.contents)
+        parent.insert(index, element)
+
+    def _del_attribute(self, node, key):
+        ''' Deletes node's key attribute, recording the attributes it had when the attempt may be retried '''
+        if self._changes is not None:
+            self._changes.append(('attributes', node, list(node.attrs), node.attrMap.copy()))
+        del node[key]
+
+    def _grab_article_pass(self):
+        self._scores = {}
 
         if self._conf['strip_unlike']:
-            for node in self._osoup.body.findAll(match_unlikely_candidates):
-                dbg("Removing unlikely candidate - " + node.get('class', '') + node.get('id', ''))
-                node.extract()
+            unlikely = self._osoup.body.findAll(is_unlikely_candidate)
+            if self._trace:
+                for node in unlikely:
+                    self._trace('node_removed', {'node': node, 'reason': 'unlikely candidate'})
+            self._extract(unlikely)
 
         # Turn all divs that don't have children block level elements into p's
-        for node in self._osoup.body.findAll('div'):
-            children = node.findAll(['a', 'blockquote', 'dl', 'div', 'img', 'ol', 'p', 'pre', 'table', 'ul'])
-            if not len(children):
-                self._replace_element(self._osoup, node, 'p')
-                dbg("Altering div to p")
+        for node, has_blocks in self._find_divs(self._osoup.body):
+            if not has_blocks:
+                self._replace_element(node, 'p')
+                if self._trace:
+                    self._trace('node_retagged', {'node': node, 'name': 'p'})
             else:
                 # experimental: replace text node with a p tag with the same content
-                new_div = Tag(self._osoup, 'div', attrs=node.attrs)
                 for c in [c for c in node.contents]:
                 # let's ignore Comments
                 #          if isinstance(c, Comment):
-                #            new_div.append(c)
+                #            continue
                     if isinstance(c, NavigableString) and c.strip(' \n\t\r'):
                         new_p = Tag(self._osoup, 'p',
                                     attrs=[('class', 'readability-styled'), ('style', 'display:inline')])
-                        new_p.append(c)
-                        new_div.append(new_p)
-                    else:
-                        new_div.append(c)
-                node.replaceWith(new_div)
-                dbg("replacing text node with a p tag with the same content.")
+                        self._move(new_p, node, node.index(c))
+                        self._move(c, new_p)
+                        if self._trace:
+                            self._trace('text_wrapped', {'node': new_p})
 
-        #
-        # Loop through all paragraphs, and assign a score to them based on how content-y they look.
-        # Then add their score to their parent node.
-        #
-        # A score is determined by things like number of commas, class names, etc. Maybe eventually link density.
-        #
-        candidates = []
-
-        for paragraph in self._osoup.body.findAll(['p', 'td', 'pre']):
-            parentNode = paragraph.parent
-            grandParentNode = parentNode and parentNode.parent
-            innerText = self.getInnerText(paragraph)
+        domain = self._locators is not None and self._locator_domain()
+        if domain:
+            topCandidate = self._locate_top_candidate(domain)
+            if topCandidate is not None:
+                return self._gather_article(topCandidate)
 
-            # If this paragraph is less than 25 characters, don't even count it.
-            if len(innerText) < 25:
-                continue
-
-            # Initialize readability data for the parent.
-            if not getattr(parentNode, 'readability', None):
-                self.initializeNode(parentNode)
-                candidates.append(parentNode)
-
-            # Initialize readability data for the grandparent.
-            if not getattr(grandParentNode, 'readability', None):
-                self.initializeNode(grandParentNode)
-                candidates.append(grandParentNode)
-
-            contentScore = 0
-
-            # Add a point for the paragraph itself as a base.
-            contentScore += 1
-
-            # Add points for any commas within this paragraph
-            contentScore += len(innerText.split(','))
-
-            # For every 100 characters in this paragraph, add another point. Up to 3 points.
-            contentScore += min((len(innerText) / 100), 3)
-
-            # Add the score to the parent. The grandparent gets half.
-            parentNode.readability['contentScore'] += contentScore
-
-            if grandParentNode:
-                grandParentNode.readability['contentScore'] += contentScore / 2
+        candidates = self._score_candidates(self._osoup.body)
 
         #
-        # After we've calculated scores, loop through all of the possible candidate nodes we found
-        # and find the one with the highest score.
+        # Find the candidate with the highest score.
         #
         topCandidate = None
         for node in candidates:
-            #
-            # Scale the final candidates score based on link density. Good content should have a
-            # relatively small link density (5% or less) and be mostly unaffected by this operation.
-            #
-            #dbg("before candidate found %s with contentScore: %d (%s:%s)" % (node.name, self._get_content_score(node), node.get('class', ''), node.get('id', '')))
-
-            node.readability['contentScore'] = node.readability['contentScore'] * (1 - self.getLinkDensity(node))
-
-            dbg('Candidate: ' + node.name + " (" + node.get('class', '') + ":" + node.get('id',
-                                                                                          '') + ") with score " + str(
-                node.readability['contentScore']))
-
-            if not topCandidate or node.readability['contentScore'] > topCandidate.readability['contentScore']:
+            if not topCandidate or self._get_content_score(node) > self._get_content_score(topCandidate):
                 topCandidate = node
 
-
         #
         # If we still have no top candidate, just use the body as a last resort.
         # We also have to copy the body node so it is something we can modify.
         #
+        steps = None
         if not topCandidate or topCandidate.name == 'body':
             topCandidate = Tag(self._osoup, 'div')
-            for c in self._osoup.body.contents:
-                topCandidate.append(c)
-            self._osoup.body.append(topCandidate)
+            if self._changes is not None:
+                self._changes.append(('moved', [(child, self._osoup.body, index)
+                                                for index, child in enumerate(self._osoup.body.contents)]))
+            move_children(self._osoup.body, topCandidate)
+            self._move(topCandidate, self._osoup.body)
             self.initializeNode(topCandidate)
-            dbg("Candidate: %s (%s:%s) with score %s" % (
-            topCandidate.name, topCandidate.get('class', ''), topCandidate.get('id', ''),
-            self._get_content_score(topCandidate)))
+        elif domain:
+            steps = locator_steps(topCandidate, self._osoup.body)
+        if self._trace:
+            self._trace('top_candidate', {'node': topCandidate, 'score': self._get_content_score(topCandidate)})
 
+        articleContent = self._gather_article(topCandidate)
+
+        if steps is not None and get_text_stats(articleContent)[0] >= Readability.LOCATOR_MIN_TEXT:
+            self._locators.put(domain, steps)
+            if self._trace:
+                self._trace('locator_learned', {'domain': domain, 'steps': steps})
+
+        return articleContent
+
+    def _gather_article(self, topCandidate):
+        ''' The article: topCandidate and those of its siblings that look related, prepared for presentation '''
         #
         # Now that we have the top candidate, look through its siblings for content that might also be related.
         # Things like preambles, content split by ads that we removed, etc.
         #
-        articleContent = Tag(self._fsoup, 'div', attrs=[('id', 'readability-content')])
-        siblingScoreThreshold = max(10, 0.2 * topCandidate.readability['contentScore'])
+        articleContent = Tag(self._osoup, 'div', attrs=[('id', 'readability-content')])
+        siblingScoreThreshold = max(10, 0.2 * self._get_content_score(topCandidate))
 
         append_list = []
         for sibling in topCandidate.parent.contents:
             if not isinstance(sibling, Tag):
                 continue
 
-            if not sibling:
-                dbg('how the fuck can it be None???')
-            dbg("Looking at sibling node: " + sibling.name + " (" + sibling.get('class', '') + ":" + sibling.get('id',
-                                                                                                                 '') + ")")
-            dbg("Sibling has score " + str(self._get_content_score(sibling)))
-
-            append = (sibling == topCandidate)
+            append = (sibling is topCandidate)
 
             #      self.initializeNode(sibling)
 
@@ -736,63 +1069,146 @@ class Readability(object):
 
             if sibling.name == "p":
                 linkDensity = self.getLinkDensity(sibling)
-                nodeContent = self.getInnerText(sibling)
-                nodeLength = len(nodeContent)
+                nodeLength = get_text_stats(sibling)[0]
 
                 if nodeLength > 80 and linkDensity < 0.25:
                     append = True
-                elif nodeLength < 80 and linkDensity == 0 and unknownRe.search(nodeContent):
+                elif nodeLength < 80 and linkDensity == 0 and unknownRe.search(self.getInnerText(sibling)):
                     append = True
 
+            if self._trace:
+                self._trace('sibling_checked', {'node': sibling, 'score': self._get_content_score(sibling),
+                                                'appended': append})
             if append:
-                dbg("Appending node: " + sibling.name + " (" + sibling.get('class', '') + ":" + sibling.get('id',
-                                                                                                            '') + ")")
-
                 # don't remove it from the iterator as I don't know what'll hapen
                 append_list.append(sibling)
 
         for n in append_list:
-            articleContent.append(n)
+            self._move(n, articleContent)
 
         #
         #So we have all of the content that we need. Now we clean it up for presentation.
         #
         self.prepArticle(articleContent)
+        return articleContent
 
-        if len(get_inner_text(articleContent)) < 250:
-            if self._conf['strip_unlike']:
-                self._conf['strip_unlike'] = False
-                self._osoup = ICantBelieveItsBeautifulSoup(self.content)
-                self._prepare_document()
-                return self._grabArticle()
-            if self._conf['weight_classes']:
-                self._conf['weight_classes'] = False
-                self._osoup = ICantBelieveItsBeautifulSoup(self.content)
-                self._prepare_document()
-                return self._grabArticle()
-            if self._conf['clean_conditionally']:
-                self._conf['clean_conditionally'] = False
-                self._osoup = ICantBelieveItsBeautifulSoup(self.content)
-                self._prepare_document()
-                return self._grabArticle()
+    # a located top candidate is only used if it has this much text, and at most this link density
+    LOCATOR_MIN_TEXT = 250
+    LOCATOR_MAX_LINK_DENSITY = 0.25
 
-        return articleContent
+    def _locator_domain(self):
+        ''' The domain locators are kept for, when this pass can use them: locators are only learned and used
+        with all the _FALLBACK_SETTINGS on, as the document they're applied to is only prepared the same way
+        then '''
+        if not self._url or not all(self._conf[key] for key in _FALLBACK_SETTINGS):
+            return None
+        return urlparse.urlsplit(self._url)[1].lower() or None
+
+    def _locate_top_candidate(self, domain):
+        ''' Looks the top candidate up with the domain's locator. Returns it if it passes the sanity check, else
+        None. Only the paragraphs under its parent are scored, which gives the located node, its parent and
+        its siblings the scores full scoring would; the check makes sure none of those outscores it, so the
+        article only differs from the one full scoring finds when a candidate elsewhere does '''
+        steps = self._locators.get(domain)
+        if steps is None:
+            return None
+        node = follow_locator(self._osoup.body, steps)
+        accepted = False
+        if node is not None:
+            textLength, linkLength, _ = get_text_stats(node)
+            if textLength >= Readability.LOCATOR_MIN_TEXT and \
+                    float(linkLength) / textLength <= Readability.LOCATOR_MAX_LINK_DENSITY:
+                parent = node.parent
+                candidates = self._score_candidates(parent)
+                # as with full scoring, the top candidate has paragraphs of its own
+                accepted = id(node) in self._scores
+                if accepted:
+                    # the grandparent of the paragraphs right under parent is the one candidate outside it, and
+                    # only partly scored
+                    score = self._get_content_score(node)
+                    for candidate in candidates:
+                        if candidate is not node and candidate is not parent.parent and \
+                                self._get_content_score(candidate) >= score:
+                            accepted = False
+                            break
+                    else:
+                        self._scores.pop(id(parent.parent), None)
+        if self._trace and node is not None:
+            self._trace('locator_checked', {'node': node, 'accepted': accepted})
+        if not accepted:
+            self._scores = {}
+            return None
+        if self._trace:
+            self._trace('top_candidate', {'node': node, 'score': self._get_content_score(node)})
+        return node
 
-    def _get_content_score(self, node, bonus=0):
-        result = 'unknown'
-        try:
-            result = node.readability['contentScore']
-        except KeyError:
-        #      dbg("KeyError: node %s (%s:%s)" % (node.name, node.get("id"), node.get('class')) )
-            pass
-        except TypeError:
-        #      dbg("TypeError: node %s (%s:%s)" % (node.name, node.get("id"), node.get('class')) )
-            pass
+    def _score_candidates(self, root):
+        ''' Scores the paragraphs under root and adds their scores to their parents and grandparents, the
+        candidates, which are returned '''
+        #
+        # Loop through all paragraphs, and assign a score to them based on how content-y they look.
+        # Then add their score to their parent node.
+        #
+        # A score is determined by things like number of commas, class names, etc. Maybe eventually link density.
+        #
+        candidates = []
 
-        if result == 'unknown':
-            dbg("node (%s:%s) has unknown contentScore {%s}" % (node.get('id'), node.get('class'), '')) # node
-            result = 0
-        return result
+        for paragraph in root.findAll(['p', 'td', 'pre']):
+            parentNode = paragraph.parent
+            grandParentNode = parentNode and parentNode.parent
+            textLength, _, commas = get_text_stats(paragraph)
+
+            # If this paragraph is less than 25 characters, don't even count it.
+            if textLength < 25:
+                continue
+
+            # Initialize readability data for the parent.
+            if id(parentNode) not in self._scores:
+                self.initializeNode(parentNode)
+                candidates.append(parentNode)
+
+            # Initialize readability data for the grandparent.
+            if grandParentNode and id(grandParentNode) not in self._scores:
+                self.initializeNode(grandParentNode)
+                candidates.append(grandParentNode)
+
+            contentScore = 0
+
+            # Add a point for the paragraph itself as a base.
+            contentScore += 1
+
+            # Add points for any commas within this paragraph
+            contentScore += commas + 1
+
+            # For every 100 characters in this paragraph, add another point. Up to 3 points.
+            contentScore += min((textLength / 100), 3)
+
+            # Add the score to the parent. The grandparent gets half.
+            self._scores[id(parentNode)]['contentScore'] += contentScore
+
+            if grandParentNode:
+                self._scores[id(grandParentNode)]['contentScore'] += contentScore / 2
+
+        for node in candidates:
+            #
+            # Scale the final candidates score based on link density. Good content should have a
+            # relatively small link density (5% or less) and be mostly unaffected by this operation.
+            #
+            score = self._scores[id(node)]
+            score['contentScore'] = score['contentScore'] * (1 - self.getLinkDensity(node))
+
+            if self._trace:
+                self._trace('candidate_scored', {'node': node, 'score': score['contentScore']})
+
+        return candidates
+
+    def _get_content_score(self, node, bonus=0):
+        score = self._scores.get(id(node))
+        if score is None:
+            if self._trace:
+                self._trace('unknown_score', {'node': node})
+            return 0
+        return score['contentScore']
 
     def prepArticle(self, articleContent):
         self.cleanStyles(articleContent)
@@ -808,13 +1224,15 @@ class Readability(object):
 
         subtitles = articleContent.findAll('h2')
         if len(subtitles) == 1:
-            [s.extract() for s in subtitles]
+            self._extract(subtitles)
 
+        empty = []
         for paragraph in articleContent.findAll('p'):
             imgCount = len(paragraph.findAll('img'))
             embedCount = len(paragraph.findAll(['embed', 'object', 'iframe']))
-            if imgCount == 0 and embedCount == 0 and len(self.getInnerText(paragraph)) == 0:
-                paragraph.extract()
+            if imgCount == 0 and embedCount == 0 and get_text_stats(paragraph)[0] == 0:
+                empty.append(paragraph)
+        self._extract(empty)
 
         # readability.cleanHeaders(articleContent);
 
@@ -825,112 +1243,127 @@ class Readability(object):
         self._cleanLeftBehinds(articleContent)
 
     def _cleanLeftBehinds(self, articleContent):
+        ''' Removes headers followed by nothing but <br>s inside their parent.
+        Only the last non-<br> tag of a parent can qualify, so each parent
+        holding a header is swept once from its end '''
         headers = articleContent.findAll(['h2', 'h3', 'h4', 'h5', 'h6'])
+        header_ids = set(id(h) for h in headers)
+        parents = []
+        seen = set()
         for h in headers:
-            siblings = h.parent.contents
-            afterHeaderSiblingsCount = 0
-            for j in range(len(siblings) - 1, -1, -1):
-                if isinstance(siblings[j], Tag):
-                    if h == siblings[j]:
-                        break
-                    if siblings[j].name != 'br':
-                        afterHeaderSiblingsCount += 1
-            if afterHeaderSiblingsCount == 0:
-                dbg("Removing header with no siblings %s (%s:%s)" % (h.name, h.get('class', ''), h.get('id', '')))
-                h.extract()
+            if id(h.parent) not in seen:
+                seen.add(id(h.parent))
+                parents.append(h.parent)
+        for parent in parents:
+            for sibling in reversed(parent.contents):
+                if not isinstance(sibling, Tag) or sibling.name == 'br':
+                    continue
+                if id(sibling) in header_ids:
+                    if self._trace:
+                        self._trace('node_removed', {'node': sibling, 'reason': 'header with no siblings'})
+                    self._extract([sibling])
+                break
 
 
     def cleanStyles(self, articleContent):
         for c in articleContent.contents:
             if isinstance(c, Tag):
                 if c.get('class', '') != 'readability-styled' and c.has_key('style'):
-                    del c['style']
+                    self._del_attribute(c, 'style')
                 self.cleanStyles(c)
 
     def _clean(self, articleContent, tag):
         is_embed = (tag in ('object', 'embed', 'iframe'))
-        for c in articleContent.findAll(tag):
-            if is_embed and videoRe.search(str(c)):
-                continue
-            c.extract()
+        self._extract([c for c in articleContent.findAll(tag) if not (is_embed and videoRe.search(str(c)))])
+
+    def _conditional_features(self, articleContent, tag):
+        ''' Returns the <tag> elements under articleContent in document order, and id(node) -> [p, img, li, input,
+        embed] descendant counts for every element under it, all from one post-order walk. Embeds and objects only
+        count when no attribute of theirs or of their descendants names a video site '''
+        nodes = []
+        features = {}
+        # per open element: (element, children left, counts, video seen in its subtree)
+        stack = [(articleContent, iter(articleContent.contents), [0] * 5, [False])]
+        while stack:
+            node, children, counts, video = stack[-1]
+            for child in children:
+                if isinstance(child, Tag):
+                    if child.name == tag:
+                        nodes.append(child)
+                    child_video = [False]
+                    for _, value in child.attrs:
+                        if videoRe.search(value):
+                            child_video[0] = True
+                            break
+                    stack.append((child, iter(child.contents), [0] * 5, child_video))
+                    break
+            else:
+                stack.pop()
+                features[id(node)] = counts
+                if stack:
+                    parent_counts, parent_video = stack[-1][2], stack[-1][3]
+                    for i in xrange(5):
+                        parent_counts[i] += counts[i]
+                    slot = CONDITIONAL_COUNTERS.get(node.name)
+                    if slot is not None and not (slot == 4 and video[0]):
+                        parent_counts[slot] += 1
+                    parent_video[0] = parent_video[0] or video[0]
+        return nodes, features
 
     def _clean_conditionally(self, articleContent, tag):
-        for node in articleContent.findAll(tag):
+        # Removing an element only changes the counts of its ancestors, which come before it in document order and
+        # have been judged already, so the counts taken up front hold for every node and the removals can wait.
+        nodes, features = self._conditional_features(articleContent, tag)
+        removed = []
+        for node in nodes:
             weight = self.getClassWeight(node)
+            if self._trace:
+                self._trace('conditional_check', {'node': node, 'weight': weight,
+                                                  'score': self._get_content_score(node)})
 
-            dbg("Cleaning Conditionally " + node.name + " (" + node.get('class', '') + ":" + node.get('id',
-                                                                                                      '') + ") w/ score:" + str(
-                self._get_content_score(node)))
-
+            reason = None
             if weight < 0:
-                dbg("Removed  Conditionally (weight<0)" + node.name + " (" + node.get('class', '') + ":" + node.get(
-                    'id', '') + ")")
-                node.extract()
+                reason = 'weight<0'
             elif self._get_char_count(node, ',') < 10:
                 #
                 # If there are not very many commas, and the number of
                 # non-paragraph elements is more than paragraphs or other ominous signs, remove the element.
                 #
-                p = len(node.findAll('p'))
-                img = len(node.findAll('img'))
-                li = len(node.findAll('li')) - 100
-                input = len(node.findAll('input'))
-
-                embedCount = 0
-                for embed in node.findAll(['embed', 'object']):
-                    if not videoRe.search(unicode(embed)):
-                        embedCount += 1
+                p, img, li, input, embedCount = features[id(node)]
+                li -= 100
 
                 linkDensity = self.getLinkDensity(node)
-                contentLenght = len(self.getInnerText(node))
-                toRemove = False
+                contentLenght = get_text_stats(node)[0]
 
                 if img > p:
-                    toRemove = True
-                    dbg("Removed  Conditionally (img>p)" + node.name + " (" + node.get('class', '') + ":" + node.get(
-                        'id', '') + ")")
+                    reason = 'img>p'
                 elif li > p and tag != 'ul' and tag != 'ol':
-                    toRemove = True
-                    dbg("Removed  Conditionally (li>p)" + node.name + " (" + node.get('class', '') + ":" + node.get(
-                        'id', '') + ")")
+                    reason = 'li>p'
                 elif input > (p / 3):
-                    dbg("Removed  Conditionally (input>p/3)" + node.name + " (" + node.get('class',
-                                                                                           '') + ":" + node.get('id',
-                                                                                                                '') + ")")
-                    toRemove = True
+                    reason = 'input>p/3'
                 elif (contentLenght < 25) and (img == 0 or img > 2):
-                    dbg("Removed  Conditionally (contentLength<25 and img)" + node.name + " (" + node.get('class',
-                                                                                                          '') + ":" + node.get(
-                        'id', '') + ")")
-                    toRemove = True
+                    reason = 'contentLength<25 and img'
                 elif weight < 25 and linkDensity > .2:
-                    dbg("Removed  Conditionally (weight<25 and linkDensity)" + node.name + " (" + node.get('class',
-                                                                                                           '') + ":" + node.get(
-                        'id', '') + ")")
-                    toRemove = True
+                    reason = 'weight<25 and linkDensity'
                 elif weight >= 25 and linkDensity > .5:
-                    dbg("Removed  Conditionally (weight>=25 and linkDensity)" + node.name + " (" + node.get('class',
-                                                                                                            '') + ":" + node.get(
-                        'id', '') + ")")
-                    toRemove = True
+                    reason = 'weight>=25 and linkDensity'
                 elif (embedCount == 1 and contentLenght < 75) or (embedCount > 1):
-                    dbg("Removed  Conditionally (embedCount)" + node.name + " (" + node.get('class',
-                                                                                            '') + ":" + node.get('id',
-                                                                                                                 '') + ")")
-                    toRemove = True
+                    reason = 'embedCount'
 
-                if toRemove:
-                    node.extract()
+            if reason:
+                if self._trace:
+                    self._trace('node_removed', {'node': node, 'reason': 'conditionally: ' + reason})
+                removed.append(node)
+        self._extract(removed)
 
 
     def _get_char_count(self, node, separator=','):
+        if separator == ',':
+            return get_text_stats(node)[2] + 1
         return len(self.getInnerText(node).split(separator))
 
     def getLinkDensity(self, node):
-        textLength = len(self.getInnerText(node))
-        linkLength = 0
-        for l in node.findAll('a'):
-            linkLength += len(self.getInnerText(l))
+        textLength, linkLength, _ = get_text_stats(node)
 
         #dbg("get_link_density for %s %d/%d w/ contentScore: %s (%s:%s)" % (node.name, linkLength, textLength, self._get_content_score(node), node.get('class', ''), node.get('id', '')))
 
@@ -939,22 +1372,23 @@ class Readability(object):
         return float(linkLength) / textLength
 
     def initializeNode(self, node):
-        node.readability = {'contentScore': 0}
+        score = {'node': node, 'contentScore': 0}
+        self._scores[id(node)] = score
 
         tag = node.name
         if tag == 'div':
-            node.readability['contentScore'] += 5
+            score['contentScore'] += 5
         elif tag in ('pre', 'td', 'blockquote'):
-            node.readability['contentScore'] += 3
+            score['contentScore'] += 3
         elif tag in ('address', 'ol', 'ul', 'dl', 'dd', 'dt', 'li', 'form'):
-            node.readability['contentScore'] -= 3
+            score['contentScore'] -= 3
         elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'th'):
-            node.readability['contentScore'] -= 5
+            score['contentScore'] -= 5
 
-        #    dbg("initializeNode1: %s (%s:%s): %d " % (node.name, node.get('class', ''), node.get('id', ''), node.readability['contentScore']))
-        node.readability['contentScore'] += self.getClassWeight(node)
+        #    dbg("initializeNode1: %s (%s:%s): %d " % (node.name, node.get('class', ''), node.get('id', ''), score['contentScore']))
+        score['contentScore'] += self.getClassWeight(node)
 
-    #    dbg("initializeNode2: %s (%s:%s): %d " % (node.name, node.get('class', ''), node.get('id', ''), node.readability['contentScore']))
+    #    dbg("initializeNode2: %s (%s:%s): %d " % (node.name, node.get('class', ''), node.get('id', ''), score['contentScore']))
 
     def getClassWeight(self, node):
         if not self._conf['weight_classes']:
@@ -984,15 +1418,42 @@ class Readability(object):
     def getInnerText(self, node, trimSpaces=True, normalizeSpaces=True):
         return get_inner_text(node, trimSpaces, normalizeSpaces)
 
-    def _replace_element(self, soup, node, new_element):
-        new_node = Tag(soup, new_element, attrs=node.attrs)
-        for c in [c for c in node.contents]:
-            new_node.append(c)
-        node.replaceWith(new_node)
+    def _replace_element(self, node, new_element):
+        ''' Renames node in place: its attributes and children stay where they are '''
+        if self._changes is not None:
+            self._changes.append(('renamed', node, node.name))
+        node.name = new_element
+        node._reindex()
+
+    def _find_divs(self, root):
+        ''' Returns a [div, has block-level descendant] pair for every div under root, in document order.
+        Converting a div only touches the div and its direct children, never the subtree of a div that comes
+        after it, so the flags can be computed once, bottom-up, in a single walk '''
+        divs = []
+        # per open element: (element, children left, block-level descendant seen, its pair if it is a div)
+        stack = [(root, iter(root.contents), [False], None)]
+        while stack:
+            node, children, has_blocks, entry = stack[-1]
+            for child in children:
+                if isinstance(child, Tag):
+                    child_entry = None
+                    if child.name == 'div':
+                        child_entry = [child, False]
+                        divs.append(child_entry)
+                    stack.append((child, iter(child.contents), [False], child_entry))
+                    break
+            else:
+                stack.pop()
+                if entry is not None:
+                    entry[1] = has_blocks[0]
+                if stack and (has_blocks[0] or node.name in DIV_TO_P_ELEMENTS):
+                    stack[-1][2][0] = True
+        return divs
 
     def _find_base_url(self):
         if not self._url:
-            dbg("[WARN] no content URI")
+            if self._trace:
+                self._trace('missing_url', {})
             return None
         parts = urlparse.urlsplit(self._url)
         noUrlParams = parts[2]
@@ -1040,14 +1501,16 @@ class Readability(object):
 
 
     def _find_next_page_link(self):
+        # links to the next page can be among the unlikely candidates pruned while parsing; those are put back,
+        # for strip_unlike to remove again
+        if self._osoup.prunedElements:
+            self._osoup = self._restore_pruned(self._osoup, lambda markup: may_link_next_page(markup, self._url))
         allLinks = self._osoup.findAll('a')
         articleBaseUrl = self._find_base_url()
         possible_pages = {}
 
         fragment_re = re.compile('#.*$')
         end_slash_re = re.compile('/$')
-        paginate_re = re.compile('pag(e|ing|inat)', re.IGNORECASE)
-        ext_paginate_re = re.compile('p(a|g|ag)?(e|ing|ination)?(=|\/)[0-9]{1,2}', re.IGNORECASE)
         firstLast_re = re.compile('(first|last)', re.IGNORECASE)
 
         if articleBaseUrl:
@@ -1070,7 +1533,8 @@ class Readability(object):
                 pass
             else:
                 if not articleBaseUrl:
-                    dbg("_find_next_page_link:relative path cannot be used with no articleBaseUrl")
+                    if self._trace:
+                        self._trace('next_page_skipped', {'href': linkHref, 'reason': 'relative path without base url'})
                     continue
                 if linkHref.startswith('/'):
                     linkHref = hostname + linkHref
@@ -1113,7 +1577,7 @@ class Readability(object):
             if nextLinkRe.search(linkData):
                 linkObj['score'] += 50
 
-            if paginate_re.search(linkData):
+            if paginateRe.search(linkData):
                 linkObj['score'] += 25
 
             if firstLast_re.search(linkData): #// -65 is enough to negate any bonuses gotten from a > or » in the text,
@@ -1134,7 +1598,7 @@ class Readability(object):
             negativeNodeMatch = False
             while parentNode:
                 parentNodeClassAndId = parentNode.get('class', '') + ' ' + parentNode.get('id', '')
-                if (not positiveNodeMatch) and parentNodeClassAndId and paginate_re.search(parentNodeClassAndId):
+                if (not positiveNodeMatch) and parentNodeClassAndId and paginateRe.search(parentNodeClassAndId):
                     positiveNodeMatch = True
                     linkObj['score'] += 25
 
@@ -1149,7 +1613,7 @@ class Readability(object):
 
             # If the URL looks like it has paging in it, add to the score.
             # Things like /page/2/, /pagenum/2, ?p=3, ?page=11, ?pagination=34
-            if paginate_re.search(linkHref) or ext_paginate_re.search(linkHref):
+            if paginateRe.search(linkHref) or extPaginateRe.search(linkHref):
                 linkObj['score'] += 25
 
             # If the URL contains negative values, give a slight decrease.
@@ -1174,7 +1638,6 @@ class Readability(object):
 
         if continuation_pages:
             continuation_pages.sort(cmp=lambda x, y: y['score'] - x['score'])
-            dbg('NEXT PAGE IS:' + continuation_pages[0]['href'])
             return continuation_pages
 
         return []
@@ -1189,27 +1652,967 @@ class Readability(object):
 </html>"""
 
 
-def unescape(text):
-    def fixup(m):
-        text = m.group(0)
-        if text[:2] == "&#":
-            # character reference
+class ReadabilityArticle(object):
+    ''' What Readability extracts from a document: the title, the article as a Tag and the footnotes as
+    (href, footnote link) tuples '''
+    __slots__ = ('title', 'body', 'footnotes')
+
+    def __init__(self, title, body, footnotes):
+        self.title = title
+        self.body = body
+        self.footnotes = footnotes
+
+    def render(self):
+        ''' The article's contents as a UTF-8 string, as returned by get_article_body '''
+        return ''.join(self.iter_render())
+
+    def iter_render(self, encoding='utf-8'):
+        ''' Yields the article's contents in chunks, rendered as they are yielded. Chunks are Unicode if
+        encoding is None '''
+        return self.body.iterRender(encoding, False, contentsOnly=True)
+
+    def write(self, out, encoding='utf-8'):
+        ''' Writes the article's contents to the file-like object out, a chunk at a time '''
+        for chunk in self.iter_render(encoding):
+            out.write(chunk)
+
+
+class _PageLoader(object):
+    ''' Loads a following page with Readability._load_page in a thread of its own, once it gets one of
+    slots, unless it is cancelled before '''
+
+    def __init__(self, readability, url, slots):
+        self.url = url
+        self.content = None
+        self.nextPageLinks = []
+        self.error = None
+        self.cancelled = False
+        self._thread = threading.Thread(target=self._load, args=(readability, slots))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self, readability, slots):
+        slots.acquire()
+        try:
+            if self.cancelled:
+                return
             try:
-                if text[:3] == "&#x":
-                    return unichr(int(text[3:-1], 16))
-                else:
-                    return unichr(int(text[2:-1]))
-            except ValueError:
-                pass
-        else:
-            # named entity
+                self.content, self.nextPageLinks = readability._load_page(self.url)
+            except Exception, e:
+                self.error = '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            slots.release()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self):
+        self._thread.join()
+        return self
+
+
+def fetch_page(url, timeout=10):
+    ''' A Readability fetcher: returns the content of url and the charset it is served with, if any '''
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        return response.read(), response.info().getparam('charset')
+    finally:
+        response.close()
+
+
+class ReadabilityBatchError(Exception):
+    ''' Stands in the results of process_many for a document that couldn't be processed. reason is 'timeout',
+    'crash' when the worker process died, or 'error' when processing raised; detail says more.
+
+    ReadabilityFuture.result raises it, with 'cancelled' and 'closed' as further reasons, or 'wait_timeout' when
+    the document is still pending or running after the time it was given to wait, and ReadabilityPool.submit
+    with 'full' '''
+
+    def __init__(self, reason, detail=''):
+        Exception.__init__(self, reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+
+def extract_document(content, url=None, settings=None, cache=None):
+    ''' Processes a document in extract_only mode. Returns (title, article body, footnotes) with the footnotes
+    as (href, footnote link) tuples of unicode strings, so the result can be pickled cheaply.
+
+    With a ReadabilityCache, a document already processed with the same url and settings isn't even parsed '''
+    if cache is not None:
+        key = cache_key(content, url, settings)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    settings = dict(settings or {})
+    settings['extract_only'] = True
+    readability = Readability(content, url, **settings)
+    readability.process_document()
+    article = readability.get_article()
+    result = (unicode(article.title), article.render(),
+              [(unicode(href), unicode(link)) for href, link in article.footnotes])
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def cache_key(content, url=None, settings=None):
+    ''' The key the result of extract_document is cached under: a hash of the content's bytes, the url, the
+    settings in effect and the locator of the url's domain, if locators are used '''
+    settings = dict(settings or {})
+    footnote_links = settings.pop('footnote_links', False)
+    charset = settings.pop('charset', None)
+    locators = settings.pop('locators', None)
+    conf = _effective_conf(footnote_links, settings)
+    # a domain's locator decides the top candidate when it passes the check: the key is for the one it has now
+    if locators is not None and url:
+        steps = locators.get(urlparse.urlsplit(url)[1].lower())
+        if steps is not None:
+            conf['locator'] = steps
+    if isinstance(content, unicode):
+        content = 'u' + content.encode('utf-8')
+    else:
+        content = 'b' + content
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    digest = hashlib.sha1(content)
+    digest.update('\0%s\0%r\0%r' % (url or '', charset, sorted(conf.items())))
+    return digest.hexdigest()
+
+
+class ReadabilityCache(object):
+    ''' Results of extract_document by cache_key. The size most recently used are kept in memory and, if path
+    is given, results are also kept in an sqlite database there, shared by the processes that open it. When
+    the database holds more than max_bytes of results the least recently used are dropped.
+
+    hits, memory_hits (the hits served from memory) and misses count the lookups. When results were last used
+    is written to the database with the next put, every USED_BATCH hits or on close, not with each hit.
+    '''
+    USED_BATCH = 256
+
+    def __init__(self, size=1024, path=None, max_bytes=64 * 1024 * 1024):
+        if path is not None and sqlite3 is None:
+            raise ValueError('an on-disk cache needs the sqlite3 module')
+        self.size = size
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        # key -> when it was last used, for the hits not yet written to the database
+        self._used = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def get(self, key):
+        ''' Returns the result cached under key, or None '''
+        self._lock.acquire()
+        try:
+            result = self._memory.pop(key, None)
+            if result is not None:
+                self._memory[key] = result
+                self.memory_hits += 1
+            else:
+                result = self._load(key)
+                if result is not None:
+                    self._remember(key, result)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.path is not None:
+                self._used[key] = time.time()
+                if len(self._used) >= self.USED_BATCH:
+                    self._flush_used(self._database())
+                    self._db.commit()
+        finally:
+            self._lock.release()
+        title, body, footnotes = result
+        return title, body, list(footnotes)
+
+    def put(self, key, result):
+        title, body, footnotes = result
+        result = (title, body, tuple(footnotes))
+        self._lock.acquire()
+        try:
+            self._memory.pop(key, None)
+            self._remember(key, result)
+            self._store(key, result)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._used:
+                self._flush_used(self._database())
+                self._db.commit()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        finally:
+            self._lock.release()
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _database(self):
+        # connections don't survive a fork: each process opens its own
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                             '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        db = self._database()
+        row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return cPickle.loads(str(row[0]))
+
+    def _flush_used(self, db):
+        db.executemany('UPDATE results SET used = ? WHERE key = ?', [(used, key) for key, used in self._used.items()])
+        self._used = {}
+
+    def _store(self, key, result):
+        if self.path is None:
+            return
+        db = self._database()
+        self._used.pop(key, None)
+        self._flush_used(db)
+        value = cPickle.dumps(result, 2)
+        db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                   (key, sqlite3.Binary(value), len(value), time.time()))
+        excess = db.execute('SELECT SUM(size) FROM results').fetchone()[0] - self.max_bytes
+        if excess > 0:
+            dropped = []
+            for old_key, size in db.execute('SELECT key, size FROM results ORDER BY used'):
+                dropped.append((old_key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            db.executemany('DELETE FROM results WHERE key = ?', dropped)
+        db.commit()
+
+
+class LocatorStore(object):
+    ''' The locators Readability learns, by domain: the steps to the top candidate of the domain's last
+    article. The size most recently used domains are kept in memory and, if
+    path is given, the size most recently learned in an sqlite database there, which the processes that open it
+    share. A store with a path reads each locator through to the database, so that what other processes
+    learn is picked up; the one in memory is only used while it is still the latest.
+
+    A LocatorStore passed to worker processes, in the settings of ReadabilityPool documents, is opened
+    again there, once per process and path. Only one with a path can be: what an in-memory one learns in a
+    worker would be lost to the others, and to the cache keys the pool looks results up with. '''
+
+    def __init__(self, size=1024, path=None):
+        if path is not None and sqlite3 is None:
+            raise ValueError('an on-disk locator store needs the sqlite3 module')
+        self.size = size
+        self.path = path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def __reduce__(self):
+        if self.path is None:
+            raise TypeError('an in-memory LocatorStore cannot be pickled, give it a path')
+        return (_open_locator_store, (self.size, self.path))
+
+    def get(self, domain):
+        ''' Returns the locator of domain, or None '''
+        self._lock.acquire()
+        try:
+            learned, steps = self._memory.pop(domain, (None, None))
+            if self.path is not None:
+                row = self._database().execute('SELECT learned FROM locators WHERE domain = ?',
+                                               (domain,)).fetchone()
+                if row is None:
+                    return None
+                if row[0] != learned:
+                    learned = row[0]
+                    steps = cPickle.loads(str(self._db.execute('SELECT steps FROM locators WHERE domain = ?',
+                                                               (domain,)).fetchone()[0]))
+            if steps is not None:
+                self._remember(domain, learned, steps)
+            return steps
+        finally:
+            self._lock.release()
+
+    def put(self, domain, steps):
+        self._lock.acquire()
+        try:
+            self._memory.pop(domain, None)
+            learned = None
+            if self.path is not None:
+                learned = time.time()
+                db = self._database()
+                db.execute('INSERT OR REPLACE INTO locators VALUES (?, ?, ?)',
+                           (domain, sqlite3.Binary(cPickle.dumps(steps, 2)), learned))
+                db.execute('DELETE FROM locators WHERE domain IN '
+                           '(SELECT domain FROM locators ORDER BY learned DESC LIMIT -1 OFFSET ?)', (self.size,))
+                db.commit()
+            self._remember(domain, learned, steps)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, domain, learned, steps):
+        # learned is when the locator was written to the database, None for a store without one
+        self._memory[domain] = (learned, steps)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _database(self):
+        # connections don't survive a fork: each process opens its own
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS locators (domain TEXT PRIMARY KEY, steps BLOB, learned REAL)')
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+
+# the LocatorStores opened in this process by _open_locator_store, by (size, path)
+_locator_stores = {}
+
+
+def _open_locator_store(size, path):
+    store = _locator_stores.get((size, path))
+    if store is None:
+        store = _locator_stores[(size, path)] = LocatorStore(size, path)
+    return store
+
+
+def _pool_worker(conn):
+    ''' Body of a ReadabilityPool worker process: processes (key, content, url, settings) tasks received on
+    conn, one at a time, and sends back (key, result) until it gets None '''
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        key, content, url, settings = task
+        try:
+            result = extract_document(content, url, settings)
+        except Exception, e:
+            result = ReadabilityBatchError('error', '%s: %s' % (e.__class__.__name__, e))
+        conn.send((key, result))
+
+
+class _PoolWorker(object):
+    __slots__ = ('process', 'conn', 'key', 'deadline')
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_pool_worker, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        # the worker holds the only other end, so its death shows up as an EOF on conn
+        child_conn.close()
+        self.key = None
+        self.deadline = None
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class ReadabilityFuture(object):
+    ''' The pending result of a document submitted to a ReadabilityPool. Callbacks added with
+    add_done_callback are called with the future in the pool's dispatching thread, or right away if the
+    future is already done; an event loop should hand them over to its own thread, as loop_done_callback
+    does '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = 'pending'
+        self._result = None
+        self._callbacks = []
+
+    def cancel(self):
+        ''' Cancels the document if it isn't being processed yet. Returns True if it is cancelled '''
+        if not self._finish(('pending',), 'cancelled', ReadabilityBatchError('cancelled')):
+            return self._state == 'cancelled'
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def running(self):
+        return self._state == 'running'
+
+    def done(self):
+        return self._state in ('cancelled', 'finished')
+
+    def result(self, timeout=None):
+        ''' Waits up to timeout seconds, or for as long as it takes, for the document to be done and returns
+        the result of extract_document. Raises ReadabilityBatchError if the document couldn't be processed,
+        and 'wait_timeout' if it isn't done in time; it is then still pending or running '''
+        self._condition.acquire()
+        try:
+            if not self.done():
+                self._condition.wait(timeout)
+            if not self.done():
+                raise ReadabilityBatchError('wait_timeout', 'not done after %ss' % timeout)
+        finally:
+            self._condition.release()
+        if isinstance(self._result, ReadabilityBatchError):
+            raise self._result
+        return self._result
+
+    def add_done_callback(self, fn):
+        self._condition.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._condition.release()
+        fn(self)
+
+    def _start(self):
+        self._condition.acquire()
+        try:
+            if self._state != 'pending':
+                return False
+            self._state = 'running'
+            return True
+        finally:
+            self._condition.release()
+
+    def _finish(self, expected, state, result):
+        self._condition.acquire()
+        try:
+            if self._state not in expected:
+                return False
+            self._state = state
+            self._result = result
+            self._condition.notifyAll()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._condition.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('ReadabilityFuture callback failed')
+        return True
+
+
+if concurrent_futures is not None:
+    class _ConcurrentFuture(concurrent_futures.Future):
+        ''' A concurrent.futures.Future that follows a ReadabilityFuture, for extract_async to return: event loops
+        that can wrap such futures, as asyncio and trollius do with wrap_future, can wait on it '''
+
+        def __init__(self, future):
+            concurrent_futures.Future.__init__(self)
+            self._readability_future = future
+            future.add_done_callback(self._follow)
+
+        def _follow(self, future):
+            if future.cancelled():
+                concurrent_futures.Future.cancel(self)
+                return
             try:
-                text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-            except KeyError:
+                self.set_result(future.result())
+            except ReadabilityBatchError, e:
+                self.set_exception(e)
+
+        def cancel(self):
+            ''' Cancels the document if it isn't being processed yet. Returns True if it is cancelled '''
+            return self._readability_future.cancel() and concurrent_futures.Future.cancel(self)
+
+        def running(self):
+            return self._readability_future.running()
+
+
+def loop_done_callback(loop, fn):
+    ''' Returns a done callback for a ReadabilityFuture, or the future extract_async returns, that hands the
+    future over to fn in the thread of loop, an event loop with a call_soon_threadsafe method as those of
+    asyncio and trollius have '''
+    def callback(future):
+        loop.call_soon_threadsafe(fn, future)
+    return callback
+
+
+class ReadabilityPool(object):
+    ''' A pool of worker processes that run extract_document, each on one document at a time.
+
+    Workers are started as they are needed and kept for the following documents. A worker that takes more
+    than timeout seconds over a document is killed, as is one that dies, and is replaced by a new one on
+    demand; the document gets a ReadabilityBatchError in place of its result.
+
+    Documents are either run through process_many or submitted one at a time with submit, not both. Submitted
+    documents are handed to the workers by a dispatching thread, started with the first one; at most
+    max_pending of them, processes * ORDERED_BACKLOG by default, can be waiting or running at a time.
+
+    With a ReadabilityCache, documents are looked up in it before they are handed to a worker, and their
+    results are put in it.
+    '''
+    # how many documents past the oldest unfinished one process_many hands out when results are ordered,
+    # per worker
+    ORDERED_BACKLOG = 4
+
+    def __init__(self, processes=None, timeout=None, max_pending=None, cache=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.max_pending = max_pending or self.processes * ReadabilityPool.ORDERED_BACKLOG
+        self.cache = cache
+        # key -> cache key of the documents handed to the workers
+        self._cacheKeys = {}
+        self._idle = []
+        # conn -> worker
+        self._busy = {}
+        # submitted documents: (key, document) tuples waiting for a worker, and key -> future
+        self._queue = []
+        self._futures = {}
+        self._submitted = 0
+        self._slots = threading.Semaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        # a pipe written to whenever the dispatching thread has something new to look at
+        self._wakeup = None
+        self._closing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Stops the workers. Documents still being processed are dropped, and their futures fail with
+        'closed', as do the submitted documents that are still waiting '''
+        if self._thread is not None:
+            self._lock.acquire()
+            try:
+                self._closing = True
+            finally:
+                self._lock.release()
+            os.write(self._wakeup[1], '.')
+            self._thread.join()
+            self._thread = None
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._fail_futures(ReadabilityBatchError('closed', 'the pool was closed'))
+        for worker in self._idle:
+            try:
+                worker.conn.send(None)
+            except IOError:
                 pass
-        return text # leave as is
+            worker.process.join()
+            worker.conn.close()
+        for worker in self._busy.values():
+            worker.kill()
+        self._idle = []
+        self._busy = {}
+
+    def process_many(self, documents, ordered=True):
+        ''' Processes (content, url) or (content, url, settings) documents in the workers. Yields the results
+        of extract_document in the order of documents if ordered is set, else (index, result) tuples as
+        the documents are done. Documents are read from the iterable as workers become available '''
+        if self._thread is not None:
+            raise ValueError('process_many cannot run while submitted documents are handled')
+        documents = iter(documents)
+        backlog = self.processes * ReadabilityPool.ORDERED_BACKLOG
+        finished = {}
+        sent = 0
+        next_index = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(self._busy) < self.processes and \
+                        (not ordered or sent - next_index < backlog):
+                    try:
+                        document = documents.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    cacheKey, result = self._lookup(*_document_parts(document))
+                    if result is None:
+                        if cacheKey is not None:
+                            self._cacheKeys[sent] = cacheKey
+                        self._dispatch(sent, document)
+                    elif ordered:
+                        finished[sent] = result
+                    else:
+                        yield sent, result
+                    sent += 1
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+                if not self._busy:
+                    if exhausted:
+                        break
+                    continue
+                for index, result in self._collect():
+                    self._store(index, result)
+                    if ordered:
+                        finished[index] = result
+                    else:
+                        yield index, result
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            # left before the end: the documents still being processed are of no use to anyone
+            for worker in self._busy.values():
+                worker.kill()
+            self._busy = {}
+            self._cacheKeys = {}
+
+    def submit(self, content, url=None, settings=None, block=True):
+        ''' Hands a document to the workers and returns its ReadabilityFuture. If max_pending documents are
+        already waiting or running, waits for one of them to be done, or raises ReadabilityBatchError with
+        'full' if block isn't set '''
+        if self._closing:
+            raise ValueError('the pool is closed')
+        future = ReadabilityFuture()
+        cacheKey, result = self._lookup(content, url, settings)
+        if result is not None:
+            future._finish(('pending',), 'finished', result)
+            return future
+        if not self._slots.acquire(block):
+            raise ReadabilityBatchError('full', '%s documents pending' % self.max_pending)
+        future.add_done_callback(lambda future: self._slots.release())
+        self._lock.acquire()
+        try:
+            if self._closing:
+                future._finish(('pending',), 'cancelled', ReadabilityBatchError('closed', 'the pool was closed'))
+                raise ValueError('the pool is closed')
+            key = self._submitted
+            self._submitted += 1
+            if cacheKey is not None:
+                self._cacheKeys[key] = cacheKey
+            self._futures[key] = future
+            self._queue.append((key, (content, url, settings)))
+            if self._thread is None:
+                self._wakeup = os.pipe()
+                self._thread = threading.Thread(target=self._run, name='ReadabilityPool')
+                self._thread.daemon = True
+                self._thread.start()
+        finally:
+            self._lock.release()
+        os.write(self._wakeup[1], '.')
+        return future
+
+    def _run(self):
+        ''' The dispatching thread: hands the submitted documents to idle workers and settles their futures.
+        Should it fail, the pool is closed to new documents and the outstanding futures fail with 'error' '''
+        try:
+            self._run_dispatch()
+        except Exception, e:
+            logging.exception('ReadabilityPool dispatching thread failed')
+            self._lock.acquire()
+            try:
+                self._closing = True
+            finally:
+                self._lock.release()
+            for worker in self._busy.values():
+                worker.kill()
+            self._busy = {}
+            self._fail_futures(ReadabilityBatchError('error', 'the dispatching thread failed: %s: %s' %
+                                                              (e.__class__.__name__, e)))
+
+    def _run_dispatch(self):
+        while True:
+            failed = []
+            self._lock.acquire()
+            try:
+                if self._closing:
+                    break
+                while self._queue and len(self._busy) < self.processes:
+                    key, document = self._queue.pop(0)
+                    if not self._futures[key]._start():
+                        del self._futures[key]
+                        self._cacheKeys.pop(key, None)
+                        continue
+                    try:
+                        self._dispatch(key, document)
+                    except (IOError, EOFError, OSError), e:
+                        # not even a new worker could take the document
+                        failed.append((key, ReadabilityBatchError('crash', 'no worker could be started: %s' % e)))
+            finally:
+                self._lock.release()
+            if failed:
+                self._settle(failed)
+                continue
+            self._settle(self._collect(self._wakeup[0]))
 
-    return re.sub("&#?\w+;", fixup, text)
+    def _settle(self, done):
+        ''' Finishes the futures of the (key, result) tuples of documents that are done '''
+        for key, result in done:
+            self._lock.acquire()
+            try:
+                future = self._futures.pop(key)
+            finally:
+                self._lock.release()
+            self._store(key, result)
+            future._finish(('running',), 'finished', result)
+
+    def _fail_futures(self, error):
+        ''' Fails the futures of the submitted documents that are still waiting or running with error '''
+        self._lock.acquire()
+        try:
+            futures, self._futures = self._futures, {}
+            self._queue = []
+            self._cacheKeys = {}
+        finally:
+            self._lock.release()
+        for future in futures.values():
+            future._finish(('pending', 'running'), 'finished', error)
+
+    def _lookup(self, content, url, settings):
+        ''' Returns the cache key of a document and its cached result, None for either if there is none '''
+        locators = (settings or {}).get('locators')
+        if locators is not None and locators.path is None:
+            raise ValueError('documents handed to worker processes need a LocatorStore with a path')
+        if self.cache is None:
+            return None, None
+        cacheKey = cache_key(content, url, settings)
+        return cacheKey, self.cache.get(cacheKey)
+
+    def _store(self, key, result):
+        cacheKey = self._cacheKeys.pop(key, None)
+        if cacheKey is not None and not isinstance(result, ReadabilityBatchError):
+            self.cache.put(cacheKey, result)
+
+    def _dispatch(self, key, document):
+        content, url, settings = _document_parts(document)
+        while True:
+            started = not self._idle
+            if started:
+                worker = _PoolWorker()
+            else:
+                worker = self._idle.pop()
+                # an idle worker can die too, e.g. killed from outside; its document goes to another one
+                if not worker.process.is_alive():
+                    worker.kill()
+                    continue
+            try:
+                worker.conn.send((key, content, url, settings))
+            except (IOError, EOFError):
+                worker.kill()
+                if started:
+                    raise
+                continue
+            break
+        worker.key = key
+        if self.timeout is not None:
+            worker.deadline = time.time() + self.timeout
+        self._busy[worker.conn] = worker
+
+    def _collect(self, wakeup=None):
+        ''' Waits for at least one of the busy workers to be done or to time out, or for wakeup to be readable,
+        and returns the (key, result) tuples of the documents that are done '''
+        wait = None
+        if self.timeout is not None and self._busy:
+            wait = max(0, min([worker.deadline for worker in self._busy.values()]) - time.time())
+        waiting = self._busy.keys()
+        if wakeup is not None:
+            waiting.append(wakeup)
+        try:
+            ready = select.select(waiting, [], [], wait)[0]
+        except select.error:
+            ready = []
+
+        done = []
+        for conn in ready:
+            if conn is wakeup:
+                os.read(wakeup, 512)
+                continue
+            worker = self._busy.pop(conn)
+            try:
+                key, result = conn.recv()
+            except (EOFError, IOError):
+                worker.kill()
+                done.append((worker.key, ReadabilityBatchError('crash', 'worker exited with code %s' %
+                                                                         worker.process.exitcode)))
+            else:
+                self._idle.append(worker)
+                done.append((key, result))
+        if self.timeout is not None:
+            now = time.time()
+            for conn, worker in self._busy.items():
+                if worker.deadline <= now:
+                    del self._busy[conn]
+                    worker.kill()
+                    done.append((worker.key, ReadabilityBatchError('timeout', 'took more than %ss' % self.timeout)))
+        return done
+
+
+def _document_parts(document):
+    ''' (content, url, settings) from a (content, url) or (content, url, settings) document '''
+    if len(document) == 2:
+        return document[0], document[1], None
+    return document
+
+
+def process_many(documents, processes=None, timeout=None, ordered=True, cache=None):
+    ''' Processes (content, url) or (content, url, settings) documents in a ReadabilityPool of processes
+    workers, stopped once all the results are yielded. See ReadabilityPool.process_many '''
+    pool = ReadabilityPool(processes, timeout, cache=cache)
+    try:
+        for result in pool.process_many(documents, ordered):
+            yield result
+    finally:
+        pool.close()
+
+
+# the pool extract_async submits to, created under _shared_pool_lock
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def set_shared_pool(pool):
+    ''' Makes extract_async submit to pool, a ReadabilityPool, from now on. Returns the previous shared pool,
+    which is left running '''
+    global _shared_pool
+    _shared_pool_lock.acquire()
+    try:
+        previous, _shared_pool = _shared_pool, pool
+    finally:
+        _shared_pool_lock.release()
+    return previous
+
+
+def extract_async(content, url=None, block=False, **settings):
+    ''' Submits a document to the shared ReadabilityPool, a default one unless set_shared_pool was called, and
+    returns its future: a concurrent.futures.Future when the futures backport can be imported, else its
+    ReadabilityFuture, whose callbacks can be handed to an event loop with loop_done_callback. Either one's
+    result raises ReadabilityBatchError if the document couldn't be processed.
+
+    See ReadabilityPool.submit; as the caller is likely an event loop, which must not wait,
+    ReadabilityBatchError is raised with 'full' when the pool has no room, unless block is set '''
+    global _shared_pool
+    _shared_pool_lock.acquire()
+    try:
+        if _shared_pool is None:
+            _shared_pool = ReadabilityPool()
+        pool = _shared_pool
+    finally:
+        _shared_pool_lock.release()
+    future = pool.submit(content, url, settings, block)
+    if concurrent_futures is not None:
+        return _ConcurrentFuture(future)
+    return future
+
+
+def _unescape_ref(m):
+    text = m.group(0)
+    if text[1] == "#":
+        # character reference
+        try:
+            if text[2] == "x":
+                return unichr(int(text[3:-1], 16))
+            else:
+                return unichr(int(text[2:-1]))
+        except ValueError:
+            return text
+    # named entity, left as is if unknown
+    return ENTITY_CHARS.get(text[1:-1], text)
+
+
+def unescape(text):
+    if '&' not in text:
+        return text
+    return entityRe.sub(_unescape_ref, text)
+
+
+def is_unlikely_candidate(node):
+    ''' True for the elements strip_unlike removes: tags other than body whose class and id look like
+    page furniture rather than content '''
+    if not isinstance(node, Tag):
+        return False
+    if node.name == 'body':
+        return False
+    unlikelyMatchString = node.get('class', '') + node.get('id', '')
+    return unlikelyMatchString and \
+           unlikelyCandidatesRe.search(unlikelyMatchString) and \
+           not okMaybeItsACandidateRe.search(unlikelyMatchString)
+
+
+def may_link_next_page(markup, url=None):
+    ''' False when none of the links in markup can score as a next page link of the page at url in
+    _find_next_page_link, which takes "next" or a "page" in the text, class or id of a link, or in its href
+    along with a paging container. True for markup that is None '''
+    if markup is None:
+        return True
+    if '<a' not in markup.lower():
+        return False
+    # relative hrefs are resolved against url
+    if url and (paginateRe.search(url) or extPaginateRe.search(url)):
+        return True
+    for tag in markupTagRe.findall(markup):
+        if nextLinkWordRe.search(tag) or paginateRe.search(tag) or extPaginateRe.search(tag):
+            return True
+    text = unescape(markupTagRe.sub(' ', markup))
+    return bool(nextLinkRe.search(text) or paginateRe.search(text))
+
+
+def locator_steps(node, root):
+    ''' The steps from root down to node, as LocatorStore keeps them: a (name, class, id, n) tuple for each
+    ancestor of node under root and for node, n counting the earlier siblings with the same name, class and id '''
+    steps = []
+    while node is not root:
+        parent = node.parent
+        if parent is None:
+            return None
+        key = (node.name, node.get('class', ''), node.get('id', ''))
+        n = 0
+        for sibling in parent.contents:
+            if sibling is node:
+                break
+            if isinstance(sibling, Tag) and sibling.name == key[0] and \
+                    sibling.get('class', '') == key[1] and sibling.get('id', '') == key[2]:
+                n += 1
+        steps.append(key + (n,))
+        node = parent
+    steps.reverse()
+    return tuple(steps)
+
+
+def follow_locator(root, steps):
+    ''' The node locator_steps returned steps for, found again under root, or None '''
+    node = root
+    for name, cls, id, n in steps:
+        found = None
+        for child in node.contents:
+            if isinstance(child, Tag) and child.name == name and \
+                    child.get('class', '') == cls and child.get('id', '') == id:
+                if n == 0:
+                    found = child
+                    break
+                n -= 1
+        if found is None:
+            return None
+        node = found
+    return node
+
+
+def _page_digest(node):
+    ''' What _append_next_pages tells repeated pages by: a hash of the text of their article '''
+    return hashlib.md5(get_inner_text(node).encode('utf-8')).hexdigest()
 
 
 def get_inner_text(node, trimSpaces=True, normalizeSpaces=True):
@@ -1230,13 +2633,183 @@ def get_inner_text(node, trimSpaces=True, normalizeSpaces=True):
     if normalizeSpaces:
         textContent = normalizeRe.sub(' ', textContent)
 
-    return textContent
+    return textContent
+
+
+def get_text_stats(node):
+    ''' Returns (text length, link text length, comma count) for node, where the text is what get_inner_text
+    returns and the link text is that of every <a> below node. A Tag's text is its non-empty children's texts
+    joined by single spaces, so the figures are built bottom-up and kept on each Tag until its subtree changes '''
+    if not isinstance(node, Tag):
+        text = get_inner_text(node)
+        return len(text), 0, text.count(',')
+    if node.textStats is not None:
+        return node.textStats
+    # per open tag: [sum of non-empty child text lengths, non-empty children, link length, commas]
+    stack = [(node, iter(node.contents), [0, 0, 0, 0])]
+    while stack:
+        tag, children, acc = stack[-1]
+        for child in children:
+            if isinstance(child, Tag):
+                stats = child.textStats
+                if stats is None:
+                    stack.append((child, iter(child.contents), [0, 0, 0, 0]))
+                    break
+                _add_text_stats(acc, child, stats)
+            else:
+                text = get_inner_text(child)
+                if text:
+                    acc[0] += len(text)
+                    acc[1] += 1
+                    acc[3] += text.count(',')
+        else:
+            stack.pop()
+            tag.textStats = (acc[0] + acc[1] - 1 if acc[1] else 0, acc[2], acc[3])
+            if stack:
+                _add_text_stats(stack[-1][2], tag, tag.textStats)
+    return node.textStats
+
+
+def _add_text_stats(acc, child, stats):
+    length, linkLength, commas = stats
+    if length:
+        acc[0] += length
+        acc[1] += 1
+    acc[2] += linkLength + (length if child.name == 'a' else 0)
+    acc[3] += commas
+
+
+def move_children(source, target):
+    ''' Moves every child of source to the end of target, leaving the tree as appending them one by one would.
+    The children's run of the next/previous chain is spliced out and back in once '''
+    if source is target or not source.contents:
+        return
+    moved = source.contents[:]
+    first, last = moved[0], source._lastRecursiveChild()
+    before, after = first.previous, last.next
+    if before is not None:
+        before.next = after
+    if after is not None:
+        after.previous = before
+    del source.contents[:]
+    source._invalidateTextStats()
+
+    targetLast = target._lastRecursiveChild()
+    following = targetLast.next
+    targetLast.next = first
+    first.previous = targetLast
+    last.next = following
+    if following is not None:
+        following.previous = last
+    if target.contents:
+        first.previousSibling = target.contents[-1]
+        target.contents[-1].nextSibling = first
+    else:
+        first.previousSibling = None
+    for child in moved:
+        child.parent = target
+    target.contents.extend(moved)
+    target._invalidateTextStats()
+    root = target._documentRoot()
+    if isinstance(root, BeautifulStoneSoup):
+        root._indexRun(first, last)
+
+
+def extract_many(elements):
+    ''' Extracts all elements from the tree, leaving it as calling extract() on each of them would, but rebuilding
+    each parent's contents once instead of searching and deleting one child at a time '''
+    marked = {}
+    for element in elements:
+        marked[id(element)] = element
+    if not marked:
+        return
+
+    # Cut each element's run out of the next/previous chain. Cutting a container before the elements inside it
+    # ends in the same links as any other order, and keeps the runs well-formed while the contents are untouched.
+    def depth(element):
+        d = 0
+        while element.parent is not None:
+            element = element.parent
+            d += 1
+        return d
+    for element in sorted(marked.values(), key=depth):
+        lastChild = element._lastRecursiveChild()
+        nextElement = lastChild.next
+        if element.previous is not None:
+            element.previous.next = nextElement
+        if nextElement is not None:
+            nextElement.previous = element.previous
+        element.previous = None
+        lastChild.next = None
+
+    parents = {}
+    for element in marked.values():
+        if element.parent is not None:
+            parents[id(element.parent)] = element.parent
+    for parent in parents.values():
+        parent._invalidateTextStats()
+        kept = []
+        previous = None
+        for child in parent.contents:
+            if id(child) in marked:
+                child.parent = None
+                child.previousSibling = child.nextSibling = None
+            else:
+                child.previousSibling = previous
+                if previous is not None:
+                    previous.nextSibling = child
+                kept.append(child)
+                previous = child
+        if previous is not None:
+            previous.nextSibling = None
+        parent.contents[:] = kept
 
 
 def clean_extraspaces(output):
     output = killBreaksRe.sub('<br />', output)
     output = killMoreBreaksRe.sub('<p', output)
     return output
+
+
+# How much markup clean_extraspaces_chunks collects before it cleans what it can of it
+CLEAN_CHUNK_SIZE = 65536
+
+
+def clean_extraspaces_chunks(chunks):
+    ''' Does clean_extraspaces on markup that comes in chunks, yielding it cleaned as it goes. The markup is
+    cleaned in pieces cut where no match of killBreaksRe or killMoreBreaksRe can run across, so the output is
+    the same as if it was cleaned whole '''
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < CLEAN_CHUNK_SIZE:
+            continue
+        text = chunk[:0].join(pending)
+        cut = _extraspaces_cut(text)
+        if cut > 0:
+            yield clean_extraspaces(text[:cut])
+            text = text[cut:]
+        pending = [text]
+        size = len(text)
+    if pending:
+        yield clean_extraspaces(pending[0][:0].join(pending))
+
+
+def _extraspaces_cut(text):
+    ''' Returns the last position in text that clean_extraspaces can cut it at, 0 if there's none: a '<' that
+    starts neither a run of breaks nor a '<p' one can end in, and that isn't inside a '<br' tag '''
+    end = len(text) - 1
+    while True:
+        cut = text.rfind('<', 0, end)
+        if cut <= 0:
+            return 0
+        if text[cut + 1] not in 'bp':
+            lastBr = text.rfind('<br', 0, cut)
+            if lastBr < 0 or text.find('>', lastBr, cut) >= 0:
+                return cut
+        end = cut
   
 
 """Beautiful Soup
@@ -1324,6 +2897,7 @@ __copyright__ = "Copyright (c) 2004-2012 Leonard Richardson"
 __license__ = "New-style BSD"
 
 from sgmllib import SGMLParser, SGMLParseError
+from bisect import bisect_left, bisect_right
 import codecs
 import markupbase
 import types
@@ -1342,18 +2916,168 @@ except NameError:
 sgmllib.tagfind = re.compile('[a-zA-Z][-_.:a-zA-Z0-9]*')
 markupbase._declname_match = re.compile(r'[a-zA-Z][-_.:a-zA-Z0-9]*\s*').match
 
+# What BeautifulStoneSoup.goahead reads with a single match: a run of
+# text, then a start tag, an end tag, or a character or entity
+# reference, if one follows. As in sgmllib, a tag runs to the next '<'
+# or '>'; the '/' of a start tag's '/>' is read on its own, as the
+# default markup massage puts a space before it.
+TOKEN = re.compile(r'([^&<]*)'
+                   r'(?:<([a-zA-Z][-_.:a-zA-Z0-9]*)((?:[^<>/]|/(?!>))*)(/?)'
+                   r'(?:>|(?=<))'
+                   r'|</([^<>]*)(?:>|(?=<))'
+                   r'|&#([0-9]+)(?:;|(?=[^0-9]))'
+                   r'|&([a-zA-Z][-.a-zA-Z0-9]*)(?:;|(?=[^a-zA-Z0-9])))?')
+
+# Used by BeautifulStoneSoup._skipQuoted on the contents of a skipped
+# quote tag: markup that can do more there than add to its text, and
+# the start and end tags in it.
+QUOTED_HAZARD = re.compile(r'<[!?]|<[a-zA-Z][-.a-zA-Z0-9]*/')
+QUOTED_STARTTAG = re.compile(r'<([a-zA-Z][-_.:a-zA-Z0-9]*)')
+QUOTED_ENDTAG = re.compile(r'</([^<>]*)')
+QUOTED_EMPTY_ENDTAG = re.compile(r'</\s*[<>]')
+
+# The entity references Tag converts in attribute values, and the
+# character each HTML entity stands for.
+ATTRIBUTE_ENTITY = re.compile("&(#\d+|#x[0-9a-fA-F]+|\w+);")
+ENTITY_CHARS = dict([(name, unichr(codepoint))
+                     for name, codepoint in name2codepoint.items()])
+
+# BeautifulStoneSoup._getEntityTables' tables, by entity settings.
+ENTITY_TABLES = {}
+
 DEFAULT_OUTPUT_ENCODING = "utf-8"
 
 def _match_css_class(str):
     """Build a RE to match the given CSS class."""
     return re.compile(r"(^|.*\s)%s($|\s)" % str)
 
+# A token of the CSS selectors Tag.select understands: a combinator or
+# a group separator, whitespace, a type selector, an id, a class, or
+# an attribute selector.
+SELECTOR_TOKEN = re.compile(r'\s*([>,])\s*|(\s+)'
+                            r'|([a-zA-Z][-_a-zA-Z0-9]*|\*)'
+                            r'|#([-_a-zA-Z0-9]+)|\.([-_a-zA-Z0-9]+)'
+                            r'|\[\s*([-_.:a-zA-Z0-9]+)\s*'
+                            r'(?:(~?=)\s*("[^"]*"|\'[^\']*\'|[^\]\s"\']+)\s*)?\]')
+
+def _compileSelector(selector):
+    """Compiles a CSS selector into one list of steps per group: the
+    (combinator, SoupStrainer) pairs of its compound selectors, the
+    combinator being the one before the step (None for the first)."""
+    groups = []
+    steps = []
+    combinator = None
+    compound = None
+    selector = selector.strip()
+    pos = 0
+    while True:
+        match = SELECTOR_TOKEN.match(selector, pos)
+        if pos == len(selector) or match is None or match.end() == pos:
+            if pos != len(selector) or compound is None:
+                raise ValueError("Unsupported selector: %r" % selector)
+            steps.append((combinator, _compoundStrainer(*compound)))
+            groups.append(steps)
+            return groups
+        pos = match.end()
+        separator, space, name, tagId, cls, attr, operator, value = \
+                   match.groups()
+        if separator or space:
+            if compound is None:
+                raise ValueError("Unsupported selector: %r" % selector)
+            steps.append((combinator, _compoundStrainer(*compound)))
+            compound = None
+            combinator = None
+            if separator == ',':
+                groups.append(steps)
+                steps = []
+            else:
+                combinator = separator or ' '
+            continue
+        if compound is None:
+            compound = [None, []]
+        if name:
+            if compound[0] is not None or compound[1]:
+                raise ValueError("Unsupported selector: %r" % selector)
+            compound[0] = name.lower()
+        elif tagId:
+            compound[1].append(('id', tagId))
+        elif cls:
+            compound[1].append(('class', _match_css_class(cls)))
+        elif not operator:
+            compound[1].append((attr.lower(), True))
+        else:
+            if value[:1] in '"\'' and value:
+                value = value[1:-1]
+            if operator == '~=':
+                value = _match_css_class(re.escape(value))
+            compound[1].append((attr.lower(), value))
+
+def _compoundStrainer(name, conditions):
+    """Returns a SoupStrainer for a tag name ('*' for any) and a list of
+    (attribute, matchAgainst) conditions that must all hold."""
+    if name == '*':
+        name = None
+    attrs = {}
+    for attr, matchAgainst in conditions:
+        if attr in attrs:
+            attrs[attr] = _allOf(attrs[attr], matchAgainst)
+        else:
+            attrs[attr] = matchAgainst
+    return SoupStrainer(name, attrs)
+
+def _allOf(*matchAgainst):
+    """Returns a callable that matches an attribute value when all the
+    given things to match it against do."""
+    strainer = SoupStrainer()
+    def matches(value):
+        for m in matchAgainst:
+            if not strainer._matches(value, m):
+                return False
+        return True
+    return matches
+
+def _matchesSelectorSteps(tag, steps, i):
+    """Tells whether the ancestors of a tag that matches steps[i] match
+    the steps before it."""
+    combinator = steps[i][0]
+    match = steps[i - 1][1]._getTagMatcher()
+    parent = tag.parent
+    while parent is not None and not isinstance(parent, BeautifulStoneSoup):
+        if match(parent) and (i == 1
+                              or _matchesSelectorSteps(parent, steps, i - 1)):
+            return True
+        if combinator == '>':
+            break
+        parent = parent.parent
+    return False
+
 # First, the classes that represent markup elements.
 
 class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
 
+    # Elements keep no __dict__: NavigableString and Tag list their
+    # fields in __slots__ of their own, as unicode can't share a
+    # layout with a slotted base.
+    __slots__ = ()
+
+    def __getstate__(self):
+        """Pickles the slots that are set, along with the __dict__ of
+        subclasses that have one."""
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = cls.__dict__[name].__get__(self, cls)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def _invert(h):
         "Cheap function to invert a hash."
         i = {}
@@ -1408,6 +3132,7 @@ class PageElement(object):
     def extract(self):
         """Destructively rips this element out of the tree."""
         if self.parent:
+            self.parent._invalidateTextStats()
             try:
                 del self.parent.contents[self.parent.index(self)]
             except ValueError:
@@ -1498,7 +3223,12 @@ class PageElement(object):
 
         if newChildsLastElement.next:
             newChildsLastElement.next.previous = newChildsLastElement
+        self._invalidateTextStats()
         self.contents.insert(position, newChild)
+        if isinstance(newChild, Tag):
+            root = self._documentRoot()
+            if isinstance(root, BeautifulStoneSoup):
+                root._indexRun(newChild, newChildsLastElement)
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
@@ -1607,6 +3337,15 @@ class PageElement(object):
         else:
             strainer = SoupStrainer(name, attrs, text, **kwargs)
         results = ResultSet(strainer)
+        if not strainer.text:
+            # Only tags can match: no need to go through search().
+            match = strainer._getTagMatcher()
+            for element in generator():
+                if isinstance(element, Tag) and match(element):
+                    results.append(element)
+                    if limit and len(results) >= limit:
+                        break
+            return results
         g = generator()
         while True:
             try:
@@ -1688,6 +3427,9 @@ class PageElement(object):
 
 class NavigableString(unicode, PageElement):
 
+    __slots__ = ('parent', 'previous', 'next', 'previousSibling',
+                 'nextSibling')
+
     def __new__(cls, value):
         """Create a new NavigableString.
 
@@ -1700,8 +3442,11 @@ class NavigableString(unicode, PageElement):
             return unicode.__new__(cls, value)
         return unicode.__new__(cls, value, DEFAULT_OUTPUT_ENCODING)
 
-    def __getnewargs__(self):
-        return (NavigableString.__str__(self),)
+    def __reduce_ex__(self, protocol):
+        """Pickles the text itself, rather than the markup __str__ and
+        __unicode__ make of it, along with the slots, whatever the
+        protocol."""
+        return (self.__class__, (self[:],), self.__getstate__())
 
     def __getattr__(self, attr):
         """text.string gives you text. This is for backwards
@@ -1724,11 +3469,15 @@ class NavigableString(unicode, PageElement):
             return data
 
 class CData(NavigableString):
+    __slots__ = ()
+
 
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<![CDATA[%s]]>" % NavigableString.__str__(self, encoding)
 
 class ProcessingInstruction(NavigableString):
+    __slots__ = ()
+
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         output = self
         if "%SOUP-ENCODING%" in output:
@@ -1736,10 +3485,14 @@ class ProcessingInstruction(NavigableString):
         return "<?%s?>" % self.toEncoding(output, encoding)
 
 class Comment(NavigableString):
+    __slots__ = ()
+
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<!--%s-->" % NavigableString.__str__(self, encoding)
 
 class Declaration(NavigableString):
+    __slots__ = ()
+
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<!%s>" % NavigableString.__str__(self, encoding)
 
@@ -1747,30 +3500,10 @@ class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
-    def _convertEntities(self, match):
-        """Used in a call to re.sub to replace HTML, XML, and numeric
-        entities with the appropriate Unicode characters. If HTML
-        entities are being converted, any unrecognized entities are
-        escaped."""
-        x = match.group(1)
-        if self.convertHTMLEntities and x in name2codepoint:
-            return unichr(name2codepoint[x])
-        elif x in self.XML_ENTITIES_TO_SPECIAL_CHARS:
-            if self.convertXMLEntities:
-                return self.XML_ENTITIES_TO_SPECIAL_CHARS[x]
-            else:
-                return u'&%s;' % x
-        elif len(x) > 0 and x[0] == '#':
-            # Handle numeric entities
-            if len(x) > 1 and x[1] == 'x':
-                return unichr(int(x[2:], 16))
-            else:
-                return unichr(int(x[1:]))
-
-        elif self.escapeUnrecognizedEntities:
-            return u'&amp;%s;' % x
-        else:
-            return u'&%s;' % x
+    __slots__ = ('parent', 'previous', 'next', 'previousSibling',
+                 'nextSibling', 'parserClass', 'name', 'isSelfClosing',
+                 'attrs', 'attrMap', 'contents', 'textStats', 'hidden',
+                 'containsSubstitutions')
 
     def __init__(self, parser, name, attrs=None, parent=None,
                  previous=None):
@@ -1781,25 +3514,27 @@ class Tag(PageElement):
         self.parserClass = parser.__class__
         self.isSelfClosing = parser.isSelfClosingTag(name)
         self.name = name
-        if attrs is None:
-            attrs = []
-        elif isinstance(attrs, dict):
-            attrs = attrs.items()
-        self.attrs = attrs
         self.contents = []
+        # (text length, link text length, comma count) as computed by
+        # readability's get_text_stats; None until asked for
+        self.textStats = None
         self.setup(parent, previous)
         self.hidden = False
         self.containsSubstitutions = False
-        self.convertHTMLEntities = parser.convertHTMLEntities
-        self.convertXMLEntities = parser.convertXMLEntities
-        self.escapeUnrecognizedEntities = parser.escapeUnrecognizedEntities
 
-        # Convert any HTML, XML, or numeric entities in the attribute values.
-        convert = lambda(k, val): (k,
-                                   re.sub("&(#\d+|#x[0-9a-fA-F]+|\w+);",
-                                          self._convertEntities,
-                                          val))
-        self.attrs = map(convert, self.attrs)
+        if not attrs:
+            self.attrs = []
+            self.attrMap = {}
+            return
+        if isinstance(attrs, dict):
+            attrs = attrs.items()
+        # Convert any HTML, XML, or numeric entities in the attribute
+        # values, as the parser's entity settings say.
+        convert = parser._convertEntities
+        self.attrs = [(k, '&' in val and ATTRIBUTE_ENTITY.sub(convert, val)
+                       or val)
+                      for k, val in attrs]
+        self.attrMap = dict(self.attrs)
 
     def getString(self):
         if (len(self.contents) == 1
@@ -1880,6 +3615,8 @@ class Tag(PageElement):
         if not found:
             self.attrs.append((key, value))
         self._getAttrMap()[key] = value
+        if key == 'id':
+            self._reindex()
 
     def __delitem__(self, key):
         "Deleting tag[key] deletes all 'key' attributes for the tag."
@@ -1891,6 +3628,8 @@ class Tag(PageElement):
             self._getAttrMap()
             if self.attrMap.has_key(key):
                 del self.attrMap[key]
+        if key == 'id':
+            self._reindex()
 
     def __call__(self, *args, **kwargs):
         """Calling a tag like a function is the same as calling its
@@ -1900,6 +3639,11 @@ class Tag(PageElement):
 
     def __getattr__(self, tag):
         #print "Getattr %s.%s" % (self.__class__, tag)
+        if tag != 'parserClass' and tag.find('__') != 0 \
+               and getattr(self.parserClass, 'STRICT_ATTRIBUTES', False):
+            # Strict parsers don't turn unknown attributes into find()
+            # calls; use find() explicitly to navigate by tag name.
+            raise AttributeError, "'%s' object has no attribute '%s'" % (self.__class__, tag)
         if len(tag) > 3 and tag.rfind('Tag') == len(tag)-3:
             return self.find(tag[:-3])
         elif tag.find('__') != 0:
@@ -1941,15 +3685,170 @@ class Tag(PageElement):
         NOTE: since Python's HTML parser consumes whitespace, this
         method is not certain to reproduce the whitespace present in
         the original string."""
+        s = u''.join(self._renderChunks(encoding, prettyPrint, indentLevel))
+        if encoding:
+            s = s.encode(encoding)
+        return s
+
+    def decompose(self):
+        """Recursively destroys the contents of this tree."""
+        self.extract()
+        if len(self.contents) == 0:
+            return
+        current = self.contents[0]
+        while current is not None:
+            next = current.next
+            if isinstance(current, Tag):
+                del current.contents[:]
+            current.parent = None
+            current.previous = None
+            current.previousSibling = None
+            current.next = None
+            current.nextSibling = None
+            current = next
 
-        encodedName = self.toEncoding(self.name, encoding)
+    def prettify(self, encoding=DEFAULT_OUTPUT_ENCODING):
+        return self.__str__(encoding, True)
 
-        attrs = []
-        if self.attrs:
-            for key, val in self.attrs:
-                fmt = '%s="%s"'
+    def renderContents(self, encoding=DEFAULT_OUTPUT_ENCODING,
+                       prettyPrint=False, indentLevel=0):
+        """Renders the contents of this tag as a string in the given
+        encoding. If encoding is None, returns a Unicode string.."""
+        s = u''.join(self._renderChunks(encoding, prettyPrint, indentLevel,
+                                        True))
+        if encoding:
+            s = s.encode(encoding)
+        return s
+
+    def iterRender(self, encoding=DEFAULT_OUTPUT_ENCODING, prettyPrint=False,
+                   indentLevel=0, contentsOnly=False):
+        """Renders this tag, or only its contents, as __str__ and
+        renderContents do, a chunk at a time: for writing a large tree
+        out without holding all of its markup in memory. Chunks are
+        Unicode if encoding is None."""
+        for chunk in self._renderChunks(encoding, prettyPrint, indentLevel,
+                                        contentsOnly):
+            if encoding:
+                chunk = chunk.encode(encoding)
+            yield chunk
+
+    # How many pieces of markup _renderChunks joins into each chunk.
+    RENDER_CHUNK_PIECES = 1024
+
+    def _renderChunks(self, encoding, prettyPrint, indentLevel,
+                      contentsOnly=False):
+        """Walks the tree under this tag without recursing and yields
+        its markup as Unicode chunks. encoding is only used for what
+        depends on it: %SOUP-ENCODING% substitutions and the strings
+        that have a rendering of their own."""
+        escape = self.BARE_AMPERSAND_OR_BRACKET.sub
+        subEntity = self._sub_entity
+        # What the text of a NavigableString is stripped of when pretty
+        # printing: encoded text used to be stripped as bytes.
+        strip = None
+        if encoding:
+            strip = ' \t\n\r\x0b\x0c'
+        pieces = []
+        # The last character rendered and how many pieces were: enough
+        # to tell, when closing a tag, whether its contents are empty
+        # or end with a newline.
+        lastChar = u''
+        rendered = 0
+        # A (children, tag, indent of the children, closing markup,
+        # indent of the closing tag, pieces rendered before the
+        # children) frame for each open tag; closing markup is None for
+        # hidden tags and for the tag whose contents only are rendered.
+        stack = []
+        if contentsOnly:
+            stack.append((iter(self.contents), self, indentLevel, None, None,
+                          0))
+        else:
+            stack.append(None)
+        while stack:
+            frame = stack[-1]
+            if frame is None:
+                # The tag itself still has to be opened.
+                stack.pop()
+                child = self
+                children = ()
+                childIndent = indentLevel
+            else:
+                children, tag, childIndent = frame[:3]
+            for child in children:
+                if isinstance(child, Tag):
+                    break
+                elif not isinstance(child, NavigableString):
+                    continue
+                if type(child) is NavigableString:
+                    text = child
+                    if '&' in text or '<' in text or '>' in text:
+                        text = escape(subEntity, text)
+                elif encoding:
+                    text = child.__str__(encoding).decode(encoding)
+                else:
+                    text = child.__str__(None)
+                if text and prettyPrint:
+                    text = text.strip(strip)
+                if text:
+                    if prettyPrint:
+                        if childIndent > 1:
+                            pieces.append(u' ' * (childIndent - 1))
+                        pieces.append(text)
+                        pieces.append(u'\n')
+                        rendered += 3
+                        lastChar = u'\n'
+                    else:
+                        pieces.append(text)
+                        rendered += 1
+                        lastChar = text[-1]
+            else:
+                if frame is not None:
+                    # All the children are rendered: close the tag.
+                    stack.pop()
+                    tag, closeTag, space, contentsStart = frame[1], frame[3], \
+                                                          frame[4], frame[5]
+                    if closeTag is not None:
+                        if (prettyPrint and rendered > contentsStart
+                            and lastChar != u'\n'):
+                            pieces.append(u'\n')
+                            rendered += 1
+                            lastChar = u'\n'
+                        if closeTag:
+                            if prettyPrint and space:
+                                pieces.append(space)
+                                rendered += 1
+                                lastChar = u' '
+                            pieces.append(closeTag)
+                            rendered += 1
+                            lastChar = u'>'
+                            if prettyPrint and tag.nextSibling:
+                                pieces.append(u'\n')
+                                rendered += 1
+                                lastChar = u'\n'
+                    if len(pieces) >= self.RENDER_CHUNK_PIECES:
+                        yield u''.join(pieces)
+                        pieces = []
+                    continue
+            # Open the tag the loop stopped at.
+            if prettyPrint:
+                space = u' ' * (childIndent - 1)
+                indentContents = childIndent + 1
+            else:
+                space = u''
+                indentContents = 0
+            if child.hidden:
+                stack.append((iter(child.contents), child, indentContents,
+                              None, None, rendered))
+                continue
+            name = child.name
+            if not isinstance(name, unicode):
+                name = unicode(name)
+            attrs = []
+            for key, val in child.attrs:
+                fmt = u'%s="%s"'
                 if isinstance(val, basestring):
-                    if self.containsSubstitutions and '%SOUP-ENCODING%' in val:
+                    if (child.containsSubstitutions
+                        and '%SOUP-ENCODING%' in val):
                         val = self.substituteEncoding(val, encoding)
 
                     # The attribute value either:
@@ -1968,7 +3867,7 @@ class Tag(PageElement):
                     #   attribute in single quotes, and escaping any
                     #   embedded single quotes to XML entities.
                     if '"' in val:
-                        fmt = "%s='%s'"
+                        fmt = u"%s='%s'"
                         if "'" in val:
                             # TODO: replace with apos when
                             # appropriate.
@@ -1978,86 +3877,39 @@ class Tag(PageElement):
                     # value might also contain angle brackets, or
                     # ampersands that aren't part of entities. We need
                     # to escape those to XML entities too.
-                    val = self.BARE_AMPERSAND_OR_BRACKET.sub(self._sub_entity, val)
-
-                attrs.append(fmt % (self.toEncoding(key, encoding),
-                                    self.toEncoding(val, encoding)))
-        close = ''
-        closeTag = ''
-        if self.isSelfClosing:
-            close = ' /'
-        else:
-            closeTag = '</%s>' % encodedName
-
-        indentTag, indentContents = 0, 0
-        if prettyPrint:
-            indentTag = indentLevel
-            space = (' ' * (indentTag-1))
-            indentContents = indentTag + 1
-        contents = self.renderContents(encoding, prettyPrint, indentContents)
-        if self.hidden:
-            s = contents
-        else:
-            s = []
-            attributeString = ''
+                    if '&' in val or '<' in val or '>' in val:
+                        val = escape(subEntity, val)
+                    # A NavigableString value, as BeautifulSOAP makes,
+                    # is rendered as its text, not its markup.
+                    val = val[:]
+                if not isinstance(key, unicode):
+                    key = unicode(key)
+                if not isinstance(val, unicode):
+                    val = unicode(val)
+                attrs.append(fmt % (key, val))
+            if child.isSelfClosing:
+                close = u' /'
+                closeTag = u''
+            else:
+                close = u''
+                closeTag = u'</%s>' % name
+            if prettyPrint and space:
+                pieces.append(space)
+                rendered += 1
             if attrs:
-                attributeString = ' ' + ' '.join(attrs)
-            if prettyPrint:
-                s.append(space)
-            s.append('<%s%s%s>' % (encodedName, attributeString, close))
+                pieces.append(u'<%s %s%s>' % (name, u' '.join(attrs), close))
+            else:
+                pieces.append(u'<%s%s>' % (name, close))
+            rendered += 1
+            lastChar = u'>'
             if prettyPrint:
-                s.append("\n")
-            s.append(contents)
-            if prettyPrint and contents and contents[-1] != "\n":
-                s.append("\n")
-            if prettyPrint and closeTag:
-                s.append(space)
-            s.append(closeTag)
-            if prettyPrint and closeTag and self.nextSibling:
-                s.append("\n")
-            s = ''.join(s)
-        return s
-
-    def decompose(self):
-        """Recursively destroys the contents of this tree."""
-        self.extract()
-        if len(self.contents) == 0:
-            return
-        current = self.contents[0]
-        while current is not None:
-            next = current.next
-            if isinstance(current, Tag):
-                del current.contents[:]
-            current.parent = None
-            current.previous = None
-            current.previousSibling = None
-            current.next = None
-            current.nextSibling = None
-            current = next
-
-    def prettify(self, encoding=DEFAULT_OUTPUT_ENCODING):
-        return self.__str__(encoding, True)
-
-    def renderContents(self, encoding=DEFAULT_OUTPUT_ENCODING,
-                       prettyPrint=False, indentLevel=0):
-        """Renders the contents of this tag as a string in the given
-        encoding. If encoding is None, returns a Unicode string.."""
-        s=[]
-        for c in self:
-            text = None
-            if isinstance(c, NavigableString):
-                text = c.__str__(encoding)
-            elif isinstance(c, Tag):
-                s.append(c.__str__(encoding, prettyPrint, indentLevel))
-            if text and prettyPrint:
-                text = text.strip()
-            if text:
-                if prettyPrint:
-                    s.append(" " * (indentLevel-1))
-                s.append(text)
-                if prettyPrint:
-                    s.append("\n")
-        return ''.join(s)
+                pieces.append(u'\n')
+                rendered += 1
+                lastChar = u'\n'
+            stack.append((iter(child.contents), child, indentContents,
+                          closeTag, space, rendered))
+        if pieces:
+            yield u''.join(pieces)
 
     #Soup methods
 
@@ -2083,12 +3935,44 @@ class Tag(PageElement):
         callable that takes a string and returns whether or not the
         string matches for some custom definition of 'matches'. The
         same is true of the tag name."""
+        if recursive and text is None:
+            found = self._findAllIndexed(name, attrs, limit, **kwargs)
+            if found is not None:
+                return found
         generator = self.recursiveChildGenerator
         if not recursive:
             generator = self.childGenerator
         return self._findAll(name, attrs, text, limit, generator, **kwargs)
     findChildren = findAll
 
+    def select(self, selector, limit=None):
+        """Extracts a list of the Tag objects under this one that match
+        the given CSS selector, in document order.
+
+        Supported are type selectors and '*', #id, .class, [attr],
+        [attr=value] and [attr~=value], combined with ' ' and '>' and
+        grouped with ','. As with querySelectorAll, the ancestors a
+        selector names can be outside this tag."""
+        found = []
+        for steps in _compileSelector(selector):
+            tags = self.findAll(steps[-1][1])
+            if len(steps) > 1:
+                tags = [tag for tag in tags
+                        if _matchesSelectorSteps(tag, steps, len(steps) - 1)]
+            found.append(tags)
+        if len(found) == 1:
+            results = found[0]
+        else:
+            ids = {}
+            for tags in found:
+                for tag in tags:
+                    ids[id(tag)] = True
+            results = [element for element in self.recursiveChildGenerator()
+                       if id(element) in ids]
+        if limit:
+            results = results[:limit]
+        return results
+
     # Pre-3.x compatibility methods
     first = find
     fetch = findAll
@@ -2102,14 +3986,121 @@ class Tag(PageElement):
     #Private methods
 
     def _getAttrMap(self):
-        """Initializes a map representation of this tag's attributes,
-        if not already initialized."""
-        if not getattr(self, 'attrMap'):
-            self.attrMap = {}
-            for (key, value) in self.attrs:
-                self.attrMap[key] = value
+        """Returns the map representation of this tag's attributes. The
+        map is built when the tag is constructed and kept in sync by
+        __setitem__ and __delitem__."""
         return self.attrMap
 
+    def _documentRoot(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return root
+
+    def _dropTagIndex(self):
+        """Tells the document this tag belongs to, if any, that its tag
+        index no longer holds."""
+        root = self._documentRoot()
+        if isinstance(root, BeautifulStoneSoup):
+            root.tagIndex = None
+
+    def _reindex(self):
+        """Tells the document this tag belongs to, if any, about a new
+        name or id. Call it after changing a tag's name."""
+        root = self._documentRoot()
+        if isinstance(root, BeautifulStoneSoup):
+            root._reindexTag(self)
+
+    def _findAllIndexed(self, name, attrs, limit, **kwargs):
+        """Answers a recursive findAll() by tag name or id from the tag
+        index of the document this tag is part of. Returns None when
+        the document keeps no index or the query can't use it.
+
+        Extracted tags are left in the index: a candidate only counts
+        if walking up its parents still leads to this tag."""
+        root = self._documentRoot()
+        if not isinstance(root, BeautifulStoneSoup) or not root.INDEX_TAGS:
+            return None
+        if isinstance(name, SoupStrainer):
+            strainer = name
+            if strainer.text is not None:
+                return None
+        else:
+            strainer = SoupStrainer(name, attrs, None, **kwargs)
+        key = None
+        if strainer.attrs and isinstance(strainer.attrs.get('id'), basestring):
+            key = ('id', strainer.attrs['id'])
+        elif strainer.name and isinstance(strainer.name, basestring):
+            key = ('name', strainer.name)
+        elif strainer.name and isinstance(strainer.name, (list, tuple, dict,
+                                                          set, frozenset)):
+            for n in strainer.name:
+                if not isinstance(n, basestring):
+                    return None
+            key = ('names', strainer.name)
+        if key is None:
+            return None
+
+        names, ids, positions, _ = root._getTagIndex()
+        start, end = -1, None
+        if self is not root:
+            if id(self) not in positions:
+                return None
+            start = positions[id(self)]
+            after = self._lastRecursiveChild().next
+            while after is not None and not isinstance(after, Tag):
+                after = after.next
+            if after is not None:
+                if id(after) not in positions:
+                    return None
+                end = positions[id(after)]
+
+        if key[0] == 'id':
+            lists = [ids.get(key[1])]
+        elif key[0] == 'name':
+            lists = [names.get(key[1])]
+        else:
+            lists = [names.get(n) for n in set(key[1])]
+        candidates = []
+        for entry in lists:
+            if entry is None:
+                continue
+            tagPositions, tags = entry
+            first = bisect_left(tagPositions, start + 1)
+            last = len(tagPositions)
+            if end is not None:
+                last = bisect_left(tagPositions, end)
+            candidates.extend(zip(tagPositions[first:last], tags[first:last]))
+        if len(lists) > 1:
+            candidates.sort(key=lambda candidate: candidate[0])
+
+        results = ResultSet(strainer)
+        match = strainer._getTagMatcher()
+        inside = {id(self): True}
+        for position, tag in candidates:
+            path = []
+            parent = tag.parent
+            while parent is not None and id(parent) not in inside:
+                path.append(parent)
+                parent = parent.parent
+            isInside = parent is not None and inside[id(parent)]
+            for node in path:
+                inside[id(node)] = isInside
+            if isInside and match(tag):
+                results.append(tag)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+    def _invalidateTextStats(self):
+        """Forgets the cached text statistics of this tag and of its
+        parents. A tag without statistics never has an ancestor with
+        statistics, so the walk stops at the first one that is unset."""
+        tag = self
+        while tag is not None and tag.textStats is not None:
+            tag.textStats = None
+            tag = tag.parent
+
     #Generator methods
     def childGenerator(self):
         # Just use the iterator from the contents
@@ -2187,6 +4178,85 @@ class SoupStrainer:
                     found = markupName
         return found
 
+    def _getTagMatcher(self):
+        """Returns a function that tells whether a Tag matches, as
+        searchTag() would, compiled from this strainer the first time
+        it's asked for."""
+        matcher = getattr(self, '_tagMatcher', None)
+        if matcher is None:
+            matcher = self._tagMatcher = self._compileTagMatcher()
+        return matcher
+
+    def _compileTagMatcher(self):
+        if not isinstance(self.attrs, dict):
+            return lambda tag: self.searchTag(tag) is not None
+        name = None
+        if self.name:
+            name = self._compileMatcher(self.name, True)
+        attrs = [(attr, self._compileMatcher(matchAgainst, False))
+                 for attr, matchAgainst in self.attrs.items()]
+        if name is None and not attrs:
+            return lambda tag: True
+        if not attrs:
+            return name
+        def match(tag):
+            if name is not None and not name(tag):
+                return False
+            get = tag.attrMap.get
+            for attr, matches in attrs:
+                if not matches(get(attr)):
+                    return False
+            return True
+        return match
+
+    def _compileMatcher(self, matchAgainst, isName):
+        """Returns a function doing what _matches(value, matchAgainst)
+        does, for a tag if isName is set or for an attribute value."""
+        if matchAgainst is True:
+            if isName:
+                return lambda tag: True
+            return lambda value: value is not None
+        elif callable(matchAgainst):
+            return matchAgainst
+        if hasattr(matchAgainst, 'match'):
+            search = matchAgainst.search
+            def matches(value):
+                if value and not isinstance(value, basestring):
+                    value = unicode(value)
+                return bool(value and search(value))
+        elif isinstance(matchAgainst, (list, tuple, set, frozenset, dict)):
+            if not isinstance(matchAgainst, dict):
+                try:
+                    matchAgainst = frozenset(matchAgainst)
+                except TypeError:
+                    return self._genericMatcher(matchAgainst, isName)
+            def matches(value):
+                if value and not isinstance(value, basestring):
+                    value = unicode(value)
+                return value in matchAgainst
+        elif isinstance(matchAgainst, basestring):
+            try:
+                asUnicode = unicode(matchAgainst)
+                asStr = str(matchAgainst)
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                return self._genericMatcher(matchAgainst, isName)
+            def matches(value):
+                if isinstance(value, unicode):
+                    return value == asUnicode
+                elif isinstance(value, str):
+                    return value == asStr
+                return self._matches(value, matchAgainst)
+        elif matchAgainst is None and not isName:
+            return lambda value: value is None
+        else:
+            return self._genericMatcher(matchAgainst, isName)
+        if isName:
+            return lambda tag: matches(tag.name)
+        return matches
+
+    def _genericMatcher(self, matchAgainst, isName):
+        return lambda markup: self._matches(markup, matchAgainst)
+
     def search(self, markup):
         #print 'looking for %s in %s' % (self, markup)
         found = None
@@ -2300,6 +4370,14 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     QUOTE_TAGS = {}
     PRESERVE_WHITESPACE_TAGS = []
 
+    # When true, tags built by this parser raise AttributeError for
+    # unknown attributes instead of treating them as find() calls.
+    STRICT_ATTRIBUTES = False
+
+    # When true, the document keeps an index of its tags by name and
+    # id, which findAll() uses for name and id queries.
+    INDEX_TAGS = False
+
     MARKUP_MASSAGE = [(re.compile('(<[^<>]*)/>'),
                        lambda x: x.group(1) + ' />'),
                       (re.compile('<!\s+([^<>]*)>'),
@@ -2319,10 +4397,15 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     # fancy Unicode spaces (usually non-breaking) should be left
     # alone.
     STRIP_ASCII_SPACES = { 9: None, 10: None, 12: None, 13: None, 32: None, }
+    NOT_ASCII_SPACE = re.compile(r'[^\t\n\f\r ]')
+
+    # The characters \s matches in the MARKUP_MASSAGE patterns.
+    MASSAGE_SPACES = ' \t\n\r\f\v'
 
     def __init__(self, markup="", parseOnlyThese=None, fromEncoding=None,
                  markupMassage=True, smartQuotesTo=XML_ENTITIES,
-                 convertEntities=None, selfClosingTags=None, isHTML=False):
+                 convertEntities=None, selfClosingTags=None, isHTML=False,
+                 skipThese=None, pruneThese=None):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
         is fed into the underlying parser.
@@ -2333,10 +4416,9 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         if your data uses self-closing tags or declarations
         incorrectly.
 
-        By default, Beautiful Soup uses regexes to sanitize input,
+        By default, Beautiful Soup sanitizes input as it reads it,
         avoiding the vast majority of these problems. If the problems
-        don't apply to you, pass in False for markupMassage, and
-        you'll get better performance.
+        don't apply to you, pass in False for markupMassage.
 
         The default parser massage techniques fix the two most common
         instances of invalid HTML that choke sgmllib:
@@ -2346,9 +4428,33 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
         You can pass in a custom list of (RE object, replace method)
         tuples to get Beautiful Soup to scrub your input the way you
-        want."""
+        want; those are applied to the whole document before it is
+        parsed.
+
+        skipThese is an optional list of SoupStrainers. A tag one of
+        them matches is read but left out of the tree, with everything
+        inside it, as if it had been extracted right after parsing; no
+        Tags or NavigableStrings are kept for its contents.
+
+        pruneThese is a list of SoupStrainers too, for tags that are
+        skipped the same way but may be wanted back later. Each one is
+        recorded in prunedElements as a (tag, parent, index, markup)
+        tuple: the tag without its contents, the tag it was left out
+        of and its position there, and its markup from its start tag to
+        where it was closed, which parses on its own into the element
+        that was left out. markup is None if the element's markup
+        can't be parsed out of context. Self-closing tags are never
+        pruned."""
 
         self.parseOnlyThese = parseOnlyThese
+        self.skipThese = skipThese
+        self.pruneThese = pruneThese
+        # The tag names skipThese can match, when they are all plain
+        # names.
+        self.skipNames = None
+        if skipThese and not [strainer for strainer in skipThese
+                              if not isinstance(strainer.name, basestring)]:
+            self.skipNames = set([strainer.name for strainer in skipThese])
         self.fromEncoding = fromEncoding
         self.smartQuotesTo = smartQuotesTo
         self.convertEntities = convertEntities
@@ -2376,6 +4482,8 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             self.convertHTMLEntities = False
             self.escapeUnrecognizedEntities = False
 
+        self.entityRefs, self.attributeEntities = self._getEntityTables()
+
         self.instanceSelfClosingTags = buildTagMap(None, selfClosingTags)
         SGMLParser.__init__(self)
 
@@ -2383,12 +4491,56 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             markup = markup.read()
         self.markup = markup
         self.markupMassage = markupMassage
+        self.declaredHTMLEncoding = None
         try:
             self._feed(isHTML=isHTML)
         except StopParsing:
             pass
         self.markup = None                 # The markup can now be GCed
 
+    def _getEntityTables(self):
+        """Returns what the entity references this parser converts are
+        replaced with: a table for text, one for attribute values. The
+        tables are built once for each combination of entity settings,
+        and references they don't have are left to handle_entityref
+        and _convertEntities."""
+        key = (self.convertHTMLEntities, self.convertXMLEntities)
+        tables = ENTITY_TABLES.get(key)
+        if tables is None:
+            text = {}
+            attribute = {}
+            for name, char in self.XML_ENTITIES_TO_SPECIAL_CHARS.items():
+                if self.convertXMLEntities:
+                    text[name] = char
+                    attribute[name] = char
+                else:
+                    attribute[name] = u'&%s;' % name
+            if self.convertHTMLEntities:
+                text.update(ENTITY_CHARS)
+                attribute.update(ENTITY_CHARS)
+            tables = ENTITY_TABLES[key] = (text, attribute)
+        return tables
+
+    def _convertEntities(self, match):
+        """Used in a call to re.sub to replace HTML, XML, and numeric
+        entities in attribute values with the appropriate Unicode
+        characters. If HTML entities are being converted, any
+        unrecognized entities are escaped."""
+        x = match.group(1)
+        data = self.attributeEntities.get(x)
+        if data is not None:
+            return data
+        elif x[0] == '#':
+            # Handle numeric entities
+            if x[1] == 'x':
+                return unichr(int(x[2:], 16))
+            else:
+                return unichr(int(x[1:]))
+        elif self.escapeUnrecognizedEntities:
+            return u'&amp;%s;' % x
+        else:
+            return u'&%s;' % x
+
     def convert_charref(self, name):
         """This method fixes a bug in Python's SGMLParser."""
         try:
@@ -2411,13 +4563,22 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                       smartQuotesTo=self.smartQuotesTo, isHTML=isHTML)
             markup = dammit.unicode
             self.originalEncoding = dammit.originalEncoding
-            self.declaredHTMLEncoding = dammit.declaredHTMLEncoding
+            # An encoding start_meta found past UnicodeDammit's prescan
+            # is just as declared.
+            self.declaredHTMLEncoding = (dammit.declaredHTMLEncoding
+                                         or inDocumentEncoding)
+        massage = False
         if markup:
-            if self.markupMassage:
+            if getattr(self, 'markupMassage', None):
                 if not hasattr(self.markupMassage, "__iter__"):
                     self.markupMassage = self.MARKUP_MASSAGE
-                for fix, m in self.markupMassage:
-                    markup = fix.sub(m, markup)
+                if self.markupMassage is BeautifulStoneSoup.MARKUP_MASSAGE:
+                    # The tokenizer applies the default massage itself,
+                    # as it reads the markup.
+                    massage = True
+                else:
+                    for fix, m in self.markupMassage:
+                        markup = fix.sub(m, markup)
                 # TODO: We get rid of markupMassage so that the
                 # soup object can be deepcopied later on. Some
                 # Python installations can't copy regexes. If anyone
@@ -2425,13 +4586,455 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                 # might cause problems.
                 del(self.markupMassage)
         self.reset()
+        self.massage = massage
 
         SGMLParser.feed(self, markup)
         # Close out any unfinished strings and close all the open tags.
+        self.tagStart = None
         self.endData()
         while self.currentTag.name != self.ROOT_TAG_NAME:
             self.popTag()
 
+    def goahead(self, end):
+        """Tokenizes as much of self.rawdata as it can and reports the
+        pieces through the usual SGMLParser callbacks. This replaces
+        SGMLParser.goahead and finds the same tokens, but text is found
+        a run at a time rather than character by character, tags that
+        have no start_, do_ or end_ method skip the getattr() lookups,
+        and the default markup massage is applied as the markup is
+        read (see _massaged)."""
+        rawdata = self.rawdata
+        n = len(rawdata)
+        i = 0
+        token = TOKEN.match
+        interesting = sgmllib.interesting
+        starttagopen = sgmllib.starttagopen
+        handle_data = self.handle_data
+        startTags = self.startTagHandlers
+        endTags = self.endTagHandlers
+        massage = self.massage
+        while i < n:
+            # The common tokens, read in one match. Anything else, and
+            # anything in literal mode, is read below the way SGMLParser
+            # reads it.
+            match = not self.literal and token(rawdata, i)
+            if match:
+                j = match.end(1)
+                if i < j:
+                    text = match.group(1)
+                    if massage and '/>' in text:
+                        text = self._massaged(i, j)
+                    handle_data(text)
+                    i = j
+                kind = match.lastindex
+                if kind == 4:
+                    tag = match.group(2)
+                    k = match.end(2)
+                    j = match.end(3)
+                    if not massage:
+                        j = match.end(4)
+                    if k == j:
+                        attrs = []
+                    elif rawdata[k] == '/' and '_' not in tag and ':' not in tag:
+                        # SGML shorthand, read by parse_starttag.
+                        attrs = None
+                    elif j < match.end(4):
+                        # Massaged, '<tag .../>' reads as '<tag ... />'.
+                        attrs = self._readAttributes(rawdata[k:j] + ' /',
+                                                     0, j - k + 2)
+                    else:
+                        attrs = self._readAttributes(rawdata, k, j)
+                    if attrs is not None:
+                        tag = tag.lower()
+                        self.lasttag = tag
+                        self.tagStart = i
+                        if tag in startTags:
+                            self.finish_starttag(tag, attrs)
+                        else:
+                            self.unknown_starttag(tag, attrs)
+                        i = match.end()
+                        continue
+                elif kind == 5:
+                    tag = match.group(5)
+                    if massage and match.end() > match.end(5):
+                        if not tag:
+                            # '</>', massaged into '< />': text.
+                            handle_data('<')
+                            i = i + 1
+                            continue
+                        if tag[-1] == '/':
+                            # Massaged, '</tag/>' reads as '</tag />'.
+                            tag = tag[:-1] + ' /'
+                    tag = tag.strip().lower()
+                    self.tagStart = i
+                    if tag and tag not in self.stack and tag not in endTags:
+                        self.unknown_endtag(tag)
+                    else:
+                        self.finish_endtag(tag)
+                    self.literal = 0
+                    i = match.end()
+                    continue
+                elif kind == 6:
+                    self.handle_charref(match.group(6))
+                    i = match.end()
+                    continue
+                elif kind == 7:
+                    self.handle_entityref(match.group(7))
+                    i = match.end()
+                    continue
+            if self.nomoretags:
+                self.handle_data(self._massaged(i, n))
+                i = n
+                break
+            if self.literal:
+                if self.skipQuoted:
+                    self.skipQuoted = False
+                    i = self._skipQuoted(i)
+                # Up to the next '</', literal text is all data.
+                j = rawdata.find('</', i)
+                if j < 0:
+                    j = n
+                    if rawdata.endswith('<'):
+                        j = n - 1
+            else:
+                match = interesting.search(rawdata, i)
+                if match:
+                    j = match.start()
+                else:
+                    j = n
+            if i < j:
+                self.handle_data(self._massaged(i, j))
+            i = j
+            if i == n:
+                break
+            if rawdata[i] == '<':
+                if starttagopen.match(rawdata, i):
+                    if self.literal:
+                        self.handle_data('<')
+                        i = i + 1
+                        continue
+                    k = self.parse_starttag(i)
+                elif rawdata.startswith('</', i):
+                    if massage and rawdata.startswith('</>', i):
+                        # Massaged into '< />': text.
+                        self.handle_data('<')
+                        i = i + 1
+                        continue
+                    k = self.parse_endtag(i)
+                    if k >= 0:
+                        self.literal = 0
+                elif self.literal:
+                    if n > i + 1:
+                        self.handle_data('<')
+                        i = i + 1
+                        continue
+                    break
+                elif rawdata.startswith('<!--', i):
+                    match = markupbase._commentclose.search(rawdata, i + 4)
+                    if not match:
+                        break
+                    self.handle_comment(self._massaged(i + 4, match.start()))
+                    i = match.end()
+                    continue
+                elif rawdata.startswith('<?', i):
+                    j = rawdata.find('>', i + 2)
+                    if j < 0:
+                        break
+                    self.handle_pi(self._massaged(i + 2, j))
+                    i = j + 1
+                    continue
+                elif rawdata.startswith('<!', i):
+                    j = i + 2
+                    if massage:
+                        j = self._declarationStart(i)
+                    if j > i + 2 and rawdata.startswith('--', j):
+                        # '<! --', massaged into a comment.
+                        match = markupbase._commentclose.search(rawdata, j + 2)
+                        if not match:
+                            break
+                        self.handle_comment(self._massaged(j + 2, match.start()))
+                        i = match.end()
+                        continue
+                    k = self.parse_declaration(i)
+                else:
+                    k = None
+                if k is not None:
+                    if k < 0:
+                        break
+                    i = k
+                    # The parse methods may have massaged the rest of
+                    # the markup.
+                    if self.rawdata is not rawdata:
+                        rawdata = self.rawdata
+                        n = len(rawdata)
+                        massage = self.massage
+                    continue
+            else:
+                if self.literal:
+                    self.handle_data('&')
+                    i = i + 1
+                    continue
+                match = sgmllib.charref.match(rawdata, i)
+                if match:
+                    self.handle_charref(match.group(1))
+                    i = match.end(0)
+                    if rawdata[i-1] != ';':
+                        i = i - 1
+                    continue
+                match = sgmllib.entityref.match(rawdata, i)
+                if match:
+                    self.handle_entityref(match.group(1))
+                    i = match.end(0)
+                    if rawdata[i-1] != ';':
+                        i = i - 1
+                    continue
+            # Only a '<' or '&' that starts nothing gets here.
+            match = sgmllib.incomplete.match(rawdata, i)
+            j = match.end(0)
+            if j == n:
+                break # Really incomplete
+            self.handle_data(rawdata[i:j])
+            i = j
+        if end and i < n:
+            self.handle_data(self._massaged(i, n))
+            i = n
+        self.rawdata = self._massaged(i, n)
+        self.massage = False
+
+    def _skipQuoted(self, i):
+        """Called with i just after the start tag of a skipped quote
+        tag. Returns the position of its end tag, or i if reading up to
+        there could do more than add text to the skipped tag, so that
+        the tokenizer has to go through it.
+
+        Literal mode only lasts until the first end tag, but in quote
+        mode start and end tags are still read as text, and only need
+        following if they have handlers or are SGML shorthand, or if
+        there's a comment, declaration or processing instruction that
+        could hide the end tag."""
+        rawdata = self.rawdata
+        name = self.quoteStack[-1]
+        match = re.compile(r'</\s*%s\s*[<>]' % re.escape(name),
+                           re.I | re.U).search(rawdata, i)
+        if not match:
+            return i
+        end = match.start()
+        first = rawdata.find('</', i, end)
+        if first == -1:
+            return end
+        text = rawdata[first:end]
+        if QUOTED_HAZARD.search(text):
+            return i
+        startTags = [tag.lower() for tag in QUOTED_STARTTAG.findall(text)]
+        endTags = set([tag.strip().lower() for tag in QUOTED_ENDTAG.findall(text)])
+        if (self.startTagHandlers.intersection(startTags) or '' in endTags
+            or endTags & self.endTagHandlers or endTags.intersection(self.stack)):
+            return i
+        if startTags:
+            self.lasttag = startTags[-1]
+        return end
+
+    def parse_starttag(self, i):
+        """Reads the start tag at i and returns the position after it,
+        or -1 if it is incomplete, as SGMLParser.parse_starttag does."""
+        self.tagStart = i
+        rawdata = self.rawdata
+        match = sgmllib.endbracket.search(rawdata, i + 1)
+        if match:
+            j = match.start(0)
+            after = j
+            if rawdata[j] == '>':
+                after = j + 1
+        else:
+            j = None
+        text = rawdata
+        start = i
+        if (j is not None and self.massage and rawdata[j] == '>'
+            and rawdata[j-1] == '/'):
+            # Massaged, '<tag .../>' reads as '<tag ... />'.
+            text = rawdata[i:j-1] + ' />'
+            start = 0
+            j = len(text) - 1
+        if sgmllib.shorttagopen.match(rawdata, i):
+            # SGML shorthand: <tag/data/ == <tag>data</tag>. The data
+            # runs to the next '/', which the massage may put a space
+            # before.
+            match = sgmllib.shorttag.match(rawdata, i)
+            if not match:
+                return -1
+            tag = match.group(1).lower()
+            data = self._massaged(match.start(2), match.end(2) + 1)[:-1]
+            self.finish_shorttag(tag, data)
+            return match.end(0)
+        if j is None:
+            return -1
+        if text[start+1] == '>':
+            # SGML shorthand: <> == <last open tag seen>
+            k = j
+            tag = self.lasttag
+        else:
+            match = sgmllib.tagfind.match(text, start + 1)
+            k = match.end(0)
+            tag = text[start+1:k].lower()
+            self.lasttag = tag
+        attrs = self._readAttributes(text, k, j)
+        if attrs is None:
+            # An unclosed quote in the massaged tag, which might close
+            # after it.
+            self._applyMassage(i)
+            return SGMLParser.parse_starttag(self, i)
+        if tag in self.startTagHandlers:
+            self.finish_starttag(tag, attrs)
+        else:
+            self.unknown_starttag(tag, attrs)
+        return after
+
+    def _readAttributes(self, text, k, j):
+        """Reads the attributes of a start tag from text[k:j] the way
+        SGMLParser.parse_starttag does. text is either self.rawdata or
+        a massaged copy of one tag; for the copy, returns None if a
+        quote in it doesn't close."""
+        attrs = []
+        attrfind = sgmllib.attrfind
+        while k < j:
+            match = attrfind.match(text, k)
+            if not match:
+                break
+            attrname, rest, attrvalue = match.group(1, 2, 3)
+            if not rest:
+                attrvalue = attrname
+            else:
+                if text is not self.rawdata:
+                    if (attrvalue and attrvalue[0] in '\'"'
+                        and text.find(attrvalue[0], match.start(3) + 1) < 0):
+                        return None
+                elif match.end(0) > j and self.massage:
+                    # A quoted value that runs past the end of the tag.
+                    attrvalue = self._massaged(match.start(3), match.end(3))
+                if (attrvalue[:1] == "'" == attrvalue[-1:] or
+                    attrvalue[:1] == '"' == attrvalue[-1:]):
+                    # strip quotes
+                    attrvalue = attrvalue[1:-1]
+                if '&' in attrvalue:
+                    attrvalue = self.entity_or_charref.sub(
+                        self._convert_ref, attrvalue)
+            attrs.append((attrname.lower(), attrvalue))
+            k = match.end(0)
+        return attrs
+
+    def parse_endtag(self, i):
+        """Reads the end tag at i, as SGMLParser.parse_endtag does."""
+        self.tagStart = i
+        rawdata = self.rawdata
+        match = sgmllib.endbracket.search(rawdata, i + 1)
+        if not match:
+            return -1
+        j = match.start(0)
+        tag = rawdata[i+2:j]
+        if rawdata[j] == '>':
+            if self.massage and tag[-1:] == '/':
+                # Massaged, '</tag/>' reads as '</tag />'.
+                tag = tag[:-1] + ' /'
+            j = j + 1
+        tag = tag.strip().lower()
+        if tag and tag not in self.stack and tag not in self.endTagHandlers:
+            self.unknown_endtag(tag)
+        else:
+            self.finish_endtag(tag)
+        return j
+
+    def _getTagHandlers(self):
+        """Returns the names of the tags this class has a start_ or do_
+        method for, and of those it has an end_ method for."""
+        handlers = self.__class__.__dict__.get('_tagHandlers')
+        if handlers is None:
+            startTags = set()
+            endTags = set()
+            for name in dir(self.__class__):
+                if name.startswith('start_'):
+                    startTags.add(name[6:])
+                elif name.startswith('do_'):
+                    startTags.add(name[3:])
+                elif name.startswith('end_'):
+                    endTags.add(name[4:])
+            handlers = (startTags, endTags)
+            setattr(self.__class__, '_tagHandlers', handlers)
+        return handlers
+
+    # The default massage, MARKUP_MASSAGE, only rewrites markup within
+    # a '<...>' segment, one that runs to the next '<' or '>': the first
+    # pattern puts a space before the '/>' that closes a segment, and
+    # the second drops the whitespace after a segment's '<!', including
+    # any space the first one put there. Whether either applies can be
+    # told from the markup around it, so the tokenizer applies them as
+    # it reads instead of rewriting the whole document first.
+
+    def _massaged(self, i, j):
+        """Returns self.rawdata[i:j] as massaged by MARKUP_MASSAGE, if
+        the massage is on."""
+        rawdata = self.rawdata
+        if not self.massage:
+            return rawdata[i:j]
+        edits = []
+        position = rawdata.find('/>', i, j + 1)
+        while position != -1:
+            if self._spacedSelfClose(position):
+                edits.append((position, 0, ' '))
+            position = rawdata.find('/>', position + 2, j + 1)
+        position = rawdata.find('<!', max(i - 2, 0), j - 1)
+        while position != -1:
+            end = self._declarationStart(position)
+            if end > position + 2 and position + 2 >= i:
+                edits.append((position + 2, end - position - 2, ''))
+            position = rawdata.find('<!', position + 2, j - 1)
+        if not edits:
+            return rawdata[i:j]
+        edits.sort()
+        pieces = []
+        for position, length, replacement in edits:
+            pieces.append(rawdata[i:position])
+            pieces.append(replacement)
+            i = position + length
+        pieces.append(rawdata[i:j])
+        return ''.join(pieces)
+
+    def _spacedSelfClose(self, position):
+        """Returns true if the massage puts a space before the '/>' at
+        position."""
+        rawdata = self.rawdata
+        start = rawdata.rfind('<', 0, position)
+        if start == -1 or rawdata.find('>', start, position) != -1:
+            return False
+        # After a '<!' and nothing but whitespace, the space is dropped
+        # along with the whitespace.
+        return not (rawdata.startswith('<!', start) and
+                    not rawdata[start+2:position].strip(self.MASSAGE_SPACES))
+
+    def _declarationStart(self, i):
+        """Returns where the '<!' segment at i goes on once massaged: i
+        + 2, or past the whitespace after its '<!' if a '>' closes the
+        segment."""
+        rawdata = self.rawdata
+        j = i + 2
+        n = len(rawdata)
+        while j < n and rawdata[j] in self.MASSAGE_SPACES:
+            j = j + 1
+        if j > i + 2:
+            match = sgmllib.endbracket.search(rawdata, j)
+            if not match or rawdata[match.start()] != '>':
+                return i + 2
+        return j
+
+    def _applyMassage(self, i):
+        """Massages the markup from i on, for the rare markup that
+        reads differently once massaged in ways the tokenizer doesn't
+        follow natively: a quote left open in a massaged tag, or a
+        declaration that runs past its own '<!...>'."""
+        if self.massage:
+            rawdata = self.rawdata
+            self.rawdata = rawdata[:i] + self._massaged(i, len(rawdata))
+            self.massage = False
+
     def __getattr__(self, methodName):
         """This method routes method call requests to either the SGMLParser
         superclass or the Tag superclass, depending on the method name."""
@@ -2451,37 +5054,235 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         return self.SELF_CLOSING_TAGS.has_key(name) \
                or self.instanceSelfClosingTags.has_key(name)
 
+    def _getDocumentElement(self, name):
+        """Returns the first tag with the given name, remembering it for
+        as long as it stays in this document."""
+        element = self.documentElements.get(name)
+        if element is not None:
+            root = element
+            while root.parent is not None:
+                root = root.parent
+            if root is self:
+                return element
+        element = self.find(name)
+        self.documentElements[name] = element
+        return element
+
+    # The distance between the positions of consecutive tags when the
+    # index is built, room for the tags inserted between them later.
+    INDEX_GAP = 1 << 16
+
+    def _getTagIndex(self):
+        """Returns (names, ids, positions, keys): tags by name and by id
+        as ([positions], [tags]) pairs in document order, the position
+        of every tag by id(tag), and the (name, id) each tag is indexed
+        under. Built on first use and kept up as tags are inserted,
+        renamed or given a new id; dropped, to be built again, when an
+        insertion finds no room between the positions around it."""
+        if self.tagIndex is None:
+            names = {}
+            ids = {}
+            positions = {}
+            keys = {}
+            position = 0
+            for element in self.recursiveChildGenerator():
+                if isinstance(element, Tag):
+                    positions[id(element)] = position
+                    tagId = element.attrMap.get('id')
+                    keys[id(element)] = (element.name, tagId)
+                    entry = names.get(element.name)
+                    if entry is None:
+                        entry = names[element.name] = ([], [])
+                    entry[0].append(position)
+                    entry[1].append(element)
+                    if tagId is not None:
+                        entry = ids.get(tagId)
+                        if entry is None:
+                            entry = ids[tagId] = ([], [])
+                        entry[0].append(position)
+                        entry[1].append(element)
+                    position += self.INDEX_GAP
+            self.tagIndex = (names, ids, positions, keys)
+        return self.tagIndex
+
+    def _indexTag(self, tag, position):
+        names, ids, positions, keys = self.tagIndex
+        tagId = tag.attrMap.get('id')
+        positions[id(tag)] = position
+        keys[id(tag)] = (tag.name, tagId)
+        for table, key in ((names, tag.name), (ids, tagId)):
+            if key is None:
+                continue
+            entry = table.get(key)
+            if entry is None:
+                entry = table[key] = ([], [])
+            i = bisect_right(entry[0], position)
+            entry[0].insert(i, position)
+            entry[1].insert(i, tag)
+
+    def _unindexTag(self, tag):
+        """Takes tag out of the index. Returns its position."""
+        names, ids, positions, keys = self.tagIndex
+        position = positions.pop(id(tag))
+        name, tagId = keys.pop(id(tag))
+        for table, key in ((names, name), (ids, tagId)):
+            if key is None:
+                continue
+            entry = table[key]
+            i = bisect_left(entry[0], position)
+            # extracted tags stay in the index, and can share a position
+            # with a tag inserted after them
+            while entry[1][i] is not tag:
+                i += 1
+            del entry[0][i]
+            del entry[1][i]
+        return position
+
+    def _reindexTag(self, tag):
+        """Indexes tag anew where it is, after a rename or an id change."""
+        if self.tagIndex is not None and id(tag) in self.tagIndex[2]:
+            self._indexTag(tag, self._unindexTag(tag))
+
+    def _indexRun(self, first, last):
+        """Indexes the tags from first to last in the next/previous
+        chain, just put in place, between the tags around them."""
+        if self.tagIndex is None:
+            return
+        positions = self.tagIndex[2]
+        tags = []
+        element = first
+        while True:
+            if isinstance(element, Tag):
+                tags.append(element)
+            if element is last:
+                break
+            element = element.next
+        if not tags:
+            return
+        before = first.previous
+        while before is not None and not isinstance(before, Tag):
+            before = before.previous
+        after = last.next
+        while after is not None and not isinstance(after, Tag):
+            after = after.next
+        if before is self:
+            low = -self.INDEX_GAP
+        elif before is not None and id(before) in positions:
+            low = positions[id(before)]
+        else:
+            self.tagIndex = None
+            return
+        if after is None:
+            high = low + (len(tags) + 1) * self.INDEX_GAP
+        elif id(after) in positions:
+            high = positions[id(after)]
+        else:
+            self.tagIndex = None
+            return
+        if high - low <= len(tags):
+            self.tagIndex = None
+            return
+        for tag in tags:
+            if id(tag) in positions:
+                self._unindexTag(tag)
+        step = len(tags) + 1
+        for i, tag in enumerate(tags):
+            self._indexTag(tag, low + (high - low) * (i + 1) // step)
+
+    html = property(lambda self: self._getDocumentElement('html'))
+    head = property(lambda self: self._getDocumentElement('head'))
+    body = property(lambda self: self._getDocumentElement('body'))
+
     def reset(self):
         Tag.__init__(self, self, self.ROOT_TAG_NAME)
         self.hidden = 1
+        self.documentElements = {}
+        self.tagIndex = None
+        self.names = {}
+        self.massage = False
+        self.startTagHandlers, self.endTagHandlers = self._getTagHandlers()
         SGMLParser.reset(self)
         self.currentData = []
         self.currentTag = None
         self.tagStack = []
+        # Bookkeeping on tagStack, so that nothing has to scan it:
+        # stack positions of the open tags by name, positions of the
+        # open nesting reset tags, and how many open tags preserve
+        # whitespace.
+        self.openTagPositions = {}
+        self.resetNestingPositions = []
+        self.openPreserveWhitespaceTags = 0
         self.quoteStack = []
+        # While a tag matched by skipThese is open: its position on
+        # tagStack, and the element parsed before it.
+        self.skipPosition = None
+        self.skipPrevious = None
+        # Set when a skipped tag puts the parser in quote mode.
+        self.skipQuoted = False
+        # Where in rawdata the tag being read starts, for pruneThese.
+        # While a pruned tag is open: where its start tag is, or -1 if
+        # its markup won't be kept, and the rawdata that's in.
+        self.tagStart = None
+        self.pruneStart = None
+        self.pruneRawdata = None
+        self.prunedElements = []
         self.pushTag(self)
 
     def popTag(self):
         tag = self.tagStack.pop()
+        self.openTagPositions[tag.name].pop()
+        if self.RESET_NESTING_TAGS.has_key(tag.name):
+            self.resetNestingPositions.pop()
+        if tag.name in self.PRESERVE_WHITESPACE_TAGS:
+            self.openPreserveWhitespaceTags -= 1
+        if len(self.tagStack) == self.skipPosition:
+            # The skipped tag is closed: pick up the document where
+            # it was left.
+            self.skipPosition = None
+            self.previous = self.skipPrevious
+            if self.previous:
+                self.previous.next = None
+            self.skipPrevious = None
+            if self.pruneStart is not None:
+                self._endPrunedElement()
 
         #print "Pop", tag.name
         if self.tagStack:
             self.currentTag = self.tagStack[-1]
         return self.currentTag
 
-    def pushTag(self, tag):
+    def pushTag(self, tag, detached=False):
         #print "Push", tag.name
-        if self.currentTag:
+        if self.currentTag and not detached:
             self.currentTag.contents.append(tag)
+        position = len(self.tagStack)
+        positions = self.openTagPositions.get(tag.name)
+        if positions is None:
+            positions = self.openTagPositions[tag.name] = []
+        positions.append(position)
+        if self.RESET_NESTING_TAGS.has_key(tag.name):
+            self.resetNestingPositions.append(position)
+        if tag.name in self.PRESERVE_WHITESPACE_TAGS:
+            self.openPreserveWhitespaceTags += 1
         self.tagStack.append(tag)
         self.currentTag = self.tagStack[-1]
 
+    def _lastOpenPosition(self, name):
+        """Returns the stack position of the most recent open tag with
+        the given name, not counting the root, or None."""
+        positions = self.openTagPositions.get(name)
+        if positions and positions[-1] > 0:
+            return positions[-1]
+        return None
+
     def endData(self, containerClass=NavigableString):
         if self.currentData:
+            if self.skipPosition is not None:
+                self.currentData = []
+                return
             currentData = u''.join(self.currentData)
-            if (currentData.translate(self.STRIP_ASCII_SPACES) == '' and
-                not set([tag.name for tag in self.tagStack]).intersection(
-                    self.PRESERVE_WHITESPACE_TAGS)):
+            if (not self.NOT_ASCII_SPACE.search(currentData) and
+                not self.openPreserveWhitespaceTags):
                 if '\n' in currentData:
                     currentData = '\n'
                 else:
@@ -2510,10 +5311,9 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
         numPops = 0
         mostRecentTag = None
-        for i in range(len(self.tagStack)-1, 0, -1):
-            if name == self.tagStack[i].name:
-                numPops = len(self.tagStack)-i
-                break
+        i = self._lastOpenPosition(name)
+        if i is not None:
+            numPops = len(self.tagStack)-i
         if not inclusivePop:
             numPops = numPops - 1
 
@@ -2544,26 +5344,34 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         isResetNesting = self.RESET_NESTING_TAGS.has_key(name)
         popTo = None
         inclusive = True
-        for i in range(len(self.tagStack)-1, 0, -1):
-            p = self.tagStack[i]
-            if (not p or p.name == name) and not isNestable:
-                #Non-nestable tags get popped to the top or to their
-                #last occurance.
-                popTo = name
-                break
-            if (nestingResetTriggers is not None
-                and p.name in nestingResetTriggers) \
-                or (nestingResetTriggers is None and isResetNesting
-                    and self.RESET_NESTING_TAGS.has_key(p.name)):
-
-                #If we encounter one of the nesting reset triggers
-                #peculiar to this tag, or we encounter another tag
-                #that causes nesting to reset, pop up to but not
-                #including that tag.
-                popTo = p.name
-                inclusive = False
-                break
-            p = p.parent
+
+        #Non-nestable tags get popped to the top or to their last
+        #occurance.
+        lastSame = None
+        if not isNestable:
+            lastSame = self._lastOpenPosition(name)
+
+        #If we encounter one of the nesting reset triggers peculiar to
+        #this tag, or we encounter another tag that causes nesting to
+        #reset, pop up to but not including that tag.
+        lastTrigger = None
+        if nestingResetTriggers is not None:
+            for trigger in nestingResetTriggers:
+                i = self._lastOpenPosition(trigger)
+                if i is not None and (lastTrigger is None or i > lastTrigger):
+                    lastTrigger = i
+        elif isResetNesting and self.resetNestingPositions \
+                 and self.resetNestingPositions[-1] > 0:
+            lastTrigger = self.resetNestingPositions[-1]
+
+        #Whichever is closer to the top of the stack wins; the same
+        #tag counts as an occurance of this tag.
+        if lastSame is not None and (lastTrigger is None
+                                     or lastSame >= lastTrigger):
+            popTo = name
+        elif lastTrigger is not None:
+            popTo = self.tagStack[lastTrigger].name
+            inclusive = False
         if popTo:
             self._popToTag(popTo, inclusive)
 
@@ -2577,26 +5385,113 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             return
         self.endData()
 
-        if not self.isSelfClosingTag(name) and not selfClosing:
+        # Tags and attributes of the same name share one string.
+        names = self.names
+        name = names.setdefault(name, name)
+        if attrs:
+            attrs = [(names.setdefault(key, key), value)
+                     for key, value in attrs]
+
+        selfClosing = selfClosing or self.isSelfClosingTag(name)
+        if not selfClosing:
             self._smartPop(name)
 
         if self.parseOnlyThese and len(self.tagStack) <= 1 \
                and (self.parseOnlyThese.text or not self.parseOnlyThese.searchTag(name, attrs)):
             return
 
-        tag = Tag(self, name, attrs, self.currentTag, self.previous)
-        if self.previous:
-            self.previous.next = tag
-        self.previous = tag
-        self.pushTag(tag)
-        if selfClosing or self.isSelfClosingTag(name):
-            self.popTag()
+        skipped = pruned = False
+        if self.skipPosition is not None:
+            # Inside a skipped tag only the tag stack is kept up, with
+            # tags that get neither attributes nor a place in the tree.
+            tag = Tag(self, name)
+            skipped = True
+            self.pushTag(tag, detached=True)
+            if selfClosing:
+                self.popTag()
+        else:
+            maySkip = self.skipThese and (self.skipNames is None
+                                          or name in self.skipNames)
+            mayPrune = (self.pruneThese and not selfClosing
+                        and self._mayPrune(name, attrs))
+            if maySkip or mayPrune:
+                tag = Tag(self, name, attrs)
+                skipped = maySkip and self._matchesAny(self.skipThese, tag)
+                pruned = (not skipped and mayPrune
+                          and self._matchesAny(self.pruneThese, tag))
+                if not skipped and not pruned:
+                    tag.setup(self.currentTag, self.previous)
+            else:
+                tag = Tag(self, name, attrs, self.currentTag, self.previous)
+        if pruned:
+            self.prunedElements.append((tag, self.currentTag,
+                                        len(self.currentTag.contents)))
+            # Whitespace inside a <pre> around the pruned tag would
+            # read differently out of context.
+            if self.tagStart is None or self.openPreserveWhitespaceTags:
+                self.pruneStart = -1
+            else:
+                self.pruneStart = self.tagStart
+            self.pruneRawdata = self.rawdata
+        if skipped or pruned:
+            if self.skipPosition is None and not selfClosing:
+                # Keep the tag on the stack, so that it nests and
+                # closes as usual, but out of the tree.
+                self.skipPosition = len(self.tagStack)
+                self.skipPrevious = self.previous
+                self.pushTag(tag, detached=True)
+                self.skipQuoted = name in self.QUOTE_TAGS
+        else:
+            if self.previous:
+                self.previous.next = tag
+            self.previous = tag
+            self.pushTag(tag)
+            if selfClosing:
+                self.popTag()
         if name in self.QUOTE_TAGS:
             #print "Beginning quote (%s)" % name
             self.quoteStack.append(name)
             self.literal = 1
         return tag
 
+    def _matchesAny(self, strainers, tag):
+        """Returns true if one of the given SoupStrainers matches the
+        given tag."""
+        for strainer in strainers:
+            if strainer._getTagMatcher()(tag):
+                return True
+        return False
+
+    def _mayPrune(self, name, attrs):
+        """Called for each tag read while pruneThese is set, before it
+        is matched against pruneThese. Subclasses can rule tags out
+        cheaply here, by where they are or by what they have."""
+        return True
+
+    def _endPrunedElement(self):
+        """Completes the prunedElements entry of the pruned tag that
+        was just closed, by the tag at self.tagStart or by the end of
+        the markup."""
+        start = self.pruneStart
+        end = self.tagStart
+        markup = None
+        if (start >= 0 and end is not None and end > start
+            and self.rawdata is self.pruneRawdata):
+            markup = self._massaged(start, end)
+            # Tags with a start_ or do_ method, and '</>', may read
+            # differently out of context.
+            lowered = markup.lower()
+            if QUOTED_EMPTY_ENDTAG.search(markup):
+                markup = None
+            else:
+                for name in self.startTagHandlers:
+                    if '<' + name in lowered:
+                        markup = None
+                        break
+        self.prunedElements[-1] = self.prunedElements[-1] + (markup,)
+        self.pruneStart = None
+        self.pruneRawdata = None
+
     def unknown_endtag(self, name):
         #print "End tag %s" % name
         if self.quoteStack and self.quoteStack[-1] != name:
@@ -2644,15 +5539,7 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         """Handle entity references as data, possibly converting known
         HTML and/or XML entity references to the corresponding Unicode
         characters."""
-        data = None
-        if self.convertHTMLEntities:
-            try:
-                data = unichr(name2codepoint[ref])
-            except KeyError:
-                pass
-
-        if not data and self.convertXMLEntities:
-                data = self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref)
+        data = self.entityRefs.get(ref)
 
         if not data and self.convertHTMLEntities and \
             not self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref):
@@ -2691,14 +5578,39 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         """Treat a bogus SGML declaration as raw data. Treat a CDATA
         declaration as a CData object."""
         j = None
-        if self.rawdata[i:i+9] == '<![CDATA[':
+        start = i + 2
+        if self.massage:
+            start = self._declarationStart(i)
+        if self.rawdata.startswith('[CDATA[', start):
              k = self.rawdata.find(']]>', i)
              if k == -1:
                  k = len(self.rawdata)
-             data = self.rawdata[i+9:k]
+             data = self._massaged(start+7, k)
              j = k+3
              self._toStringSubclass(data, CData)
         else:
+            rawdata = self.rawdata
+            if self.massage:
+                # Read the declaration within its own massaged
+                # '<!...>'; one that runs on past it is read from
+                # massaged markup.
+                match = sgmllib.endbracket.search(rawdata, i + 2)
+                if match and rawdata[match.start()] == '>':
+                    end = match.end()
+                    segment = self._massaged(i, end)
+                    self.rawdata = segment
+                    try:
+                        try:
+                            j = SGMLParser.parse_declaration(self, 0)
+                        except SGMLParseError:
+                            j = -1
+                    finally:
+                        self.rawdata = rawdata
+                    if j == len(segment):
+                        return end
+                    if j > 0 and segment == rawdata[i:end]:
+                        return i + j
+                self._applyMassage(i)
             try:
                 j = SGMLParser.parse_declaration(self, i)
             except SGMLParseError:
@@ -2899,6 +5811,37 @@ class ICantBelieveItsBeautifulSoup(BeautifulSoup):
                                 I_CANT_BELIEVE_THEYRE_NESTABLE_BLOCK_TAGS,
                                 I_CANT_BELIEVE_THEYRE_NESTABLE_INLINE_TAGS)
 
+class ReadabilitySoup(ICantBelieveItsBeautifulSoup):
+    """The parser Readability works on: ICantBelieveItsBeautifulSoup
+    with strict attribute access, so that a misspelled or missing
+    attribute fails loudly instead of searching the subtree. Use
+    find() to navigate by tag name, and the html, head and body
+    properties for the document elements. Name and id queries are
+    answered from the tag index."""
+
+    STRICT_ATTRIBUTES = True
+    INDEX_TAGS = True
+
+    # What Readability has the parser skip: scripts, style tags and stylesheet links
+    UNREADABLE_ELEMENTS = [SoupStrainer('script'), SoupStrainer('style'),
+                           SoupStrainer('link', attrs={'rel': 'stylesheet'})]
+
+    def _mayPrune(self, name, attrs):
+        """Readability strips unlikely candidates by class and id, and
+        only inside a body; they are pruned once an html and a head
+        have been read, as the document is otherwise rebuilt around
+        its tags."""
+        if not attrs:
+            return False
+        positions = self.openTagPositions
+        if ('html' not in positions or 'head' not in positions
+            or self._lastOpenPosition('body') is None):
+            return False
+        for key, value in attrs:
+            if key == 'class' or key == 'id':
+                return True
+        return False
+
 class MinimalSoup(BeautifulSoup):
     """The MinimalSoup class is for parsing HTML that contains
     pathologically bad markup. It makes no assumptions about tag
@@ -3006,6 +5949,14 @@ class UnicodeDammit:
     CHARSET_ALIASES = { "macintosh" : "mac-roman",
                         "x-sjis" : "shift-jis" }
 
+    # How much of the document is looked at for an XML declaration or
+    # a META tag declaring its encoding. An HTML head that goes on
+    # past it is looked at up to its end. A META tag further in is
+    # still found by BeautifulSoup.start_meta, which then parses the
+    # document again.
+    PRESCAN_BYTES = 65536
+    HEAD_END = re.compile('</head|<body', re.I)
+
     def __init__(self, markup, overrideEncodings=[],
                  smartQuotesTo='xml', isHTML=False):
         self.declaredHTMLEncoding = None
@@ -3154,11 +6105,21 @@ class UnicodeDammit:
                 pass
         except:
             xml_encoding_match = None
+        prescan = xml_data[:self.PRESCAN_BYTES]
         xml_encoding_match = re.compile(
-            '^<\?.*encoding=[\'"](.*?)[\'"].*\?>').match(xml_data)
+            '^<\?.*encoding=[\'"](.*?)[\'"].*\?>').match(prescan)
         if not xml_encoding_match and isHTML:
             regexp = re.compile('<\s*meta[^>]+charset=([^>]*?)[;\'">]', re.I)
-            xml_encoding_match = regexp.search(xml_data)
+            xml_encoding_match = regexp.search(prescan)
+            if (not xml_encoding_match
+                and len(xml_data) > self.PRESCAN_BYTES
+                and not self.HEAD_END.search(prescan)):
+                # from where a '</head' cut off by the prescan starts
+                headEnd = self.HEAD_END.search(xml_data,
+                                               self.PRESCAN_BYTES - 5)
+                if headEnd:
+                    xml_encoding_match = regexp.search(
+                        xml_data, 0, headEnd.start())
         if xml_encoding_match is not None:
             xml_encoding = xml_encoding_match.groups()[0].lower()
             if isHTML:
@@ -3261,6 +6222,16 @@ def dbg(msg):
   if __DEBUG__:
     logging.info(msg)
 
+
+def log_trace(event, fields):
+  ''' Readability trace sink that logs each event on one line, tags shown as name (class:id) '''
+  values = []
+  for key, value in sorted(fields.items()):
+    if isinstance(value, Tag):
+      value = '%s (%s:%s)' % (value.name, value.get('class', ''), value.get('id', ''))
+    values.append('%s=%s' % (key, value))
+  logging.info('%s: %s' % (event, ', '.join(values)))
+
 if __name__ == '__main__':
   logging.basicConfig(level=logging.DEBUG,
                       format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -0,0 +1,164 @@
+import glob
+import os
+import StringIO
+import unittest
+
+import readability
+
+
+def story(count=6):
+    return ('<html><head><title>A story</title></head><body><div id="nav"><a href="/">Home</a></div>'
+            '<div id="story">%s<p>See <a href="/notes">the notes</a>.</p><img src="/a.png"></div></body></html>'
+            % ''.join('<p>Paragraph %d of the story goes on, and on, with commas, here. %s</p>'
+                      % (k, 'More words of the story. ' * 10) for k in range(count)))
+
+
+class ExtractOnlyTest(unittest.TestCase):
+
+    def test_page_built_on_demand(self):
+        page = readability.Readability(story(), 'http://example.com/a/b.html', extract_only=True)
+        page.process_document()
+        article = page.get_article()
+        self.assertTrue(page._fsoup is None)
+        self.assertEqual(article.render(), page.get_article_body())
+        self.assertTrue('Paragraph 5 of the story' in article.render())
+        self.assertTrue('http://example.com/a.png' in article.render())
+        self.assertEqual(article.footnotes, page.get_article_footnotes())
+        self.assertTrue(page._fsoup is None)
+
+        html = page.get_html()
+        self.assertTrue(page._fsoup is not None)
+        full = readability.Readability(story(), 'http://example.com/a/b.html')
+        full.process_document()
+        self.assertEqual(html, full.get_html())
+        self.assertEqual(page.get_article_body(), full.get_article_body())
+
+    def test_extract_document(self):
+        title, body, footnotes = readability.extract_document(story(), 'http://example.com/a/b.html')
+        full = readability.Readability(story(), 'http://example.com/a/b.html')
+        full.process_document()
+        self.assertEqual(body, full.get_article_body())
+        self.assertEqual(title, unicode(full.get_title()))
+
+
+class PagePartsTest(unittest.TestCase):
+
+    def test_post_processing_uses_tag_index(self):
+        walked = []
+        findAllIndexed = readability.Tag._findAllIndexed
+        postProcess = readability.Readability._post_process_content
+
+        def counted(tag, name, attrs, limit, **kwargs):
+            found = findAllIndexed(tag, name, attrs, limit, **kwargs)
+            if found is None:
+                walked.append(name)
+            return found
+
+        def watched(page):
+            del walked[:]
+            readability.Tag._findAllIndexed = counted
+            try:
+                postProcess(page)
+            finally:
+                readability.Tag._findAllIndexed = findAllIndexed
+        readability.Readability._post_process_content = watched
+        try:
+            page = readability.Readability(story(), 'http://example.com/a/b.html')
+            page.process_document()
+        finally:
+            readability.Readability._post_process_content = postProcess
+        self.assertTrue(isinstance(page._pageParts, readability.ReadabilitySoup))
+        # only the '[class]' selector, which names no tag, is left to walk the article
+        self.assertEqual(len(walked), 1)
+        self.assertEqual(walked[0].name, None)
+
+class ArticleBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.page = readability.Readability(story(400), 'http://example.com/a/b.html', extract_only=True)
+        self.page.process_document()
+        self.rendered = self.page._articleBody.renderContents(prettyPrint=False)
+
+    def test_iter_article_body(self):
+        chunks = list(self.page.iter_article_body())
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), self.rendered)
+        self.assertEqual(self.page.get_article_body(), self.rendered)
+        self.assertEqual(u''.join(self.page.iter_article_body(None)), self.rendered.decode('utf-8'))
+        self.assertTrue(self.page._fsoup is None)
+
+    def test_write_article_body(self):
+        out = StringIO.StringIO()
+        self.page.write_article_body(out)
+        self.assertEqual(out.getvalue(), self.rendered)
+        out = StringIO.StringIO()
+        self.page.write_article_body(out, 'latin-1')
+        self.assertEqual(out.getvalue(), self.page._articleBody.renderContents('latin-1'))
+
+    def test_article_render(self):
+        article = self.page.get_article()
+        self.assertEqual(article.render(), self.rendered)
+        self.assertEqual(''.join(article.iter_render()), self.rendered)
+        out = StringIO.StringIO()
+        article.write(out)
+        self.assertEqual(out.getvalue(), self.rendered)
+
+
+def tree_state(soup):
+    ''' The markup of soup and its nodes in document order, checking that the next/previous chain and the
+    parent links follow the contents '''
+    nodes = []
+    stack = [iter(soup.contents)]
+    while stack:
+        for node in stack[-1]:
+            nodes.append(node)
+            if isinstance(node, readability.Tag):
+                stack.append(iter(node.contents))
+            break
+        else:
+            stack.pop()
+    for previous, node in zip([soup] + nodes, nodes):
+        # the first node starts the chain with no previous
+        assert previous is soup or (node.previous is previous and previous.next is node)
+        assert [child for child in node.parent.contents if child is node]
+    assert not nodes or nodes[-1].next is None
+    return unicode(soup), [id(node) for node in nodes]
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_failed_attempt_undone(self):
+        pages = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'data', 'pages', '*.html')))
+        documents = [open(path).read() for path in pages]
+        documents.append(story().replace('<p>', '<p class="x" style="color: red" id="y">'))
+        for document in documents:
+            page = readability.Readability(document, 'http://example.com/a/b.html')
+            page._prepare_document()
+            soup = page._osoup
+            before = tree_state(soup)
+            page._changes = []
+            page._grab_article_pass()
+            self.assertTrue(page._changes)
+            page._undo_changes()
+            self.assertEqual(tree_state(soup), before)
+            for name in ('p', 'div', 'span', 'a'):
+                self.assertEqual(soup.findAll(name),
+                                 list(soup._findAll(name, {}, None, None, soup.recursiveChildGenerator)))
+
+    def test_retried_without_strip_unlike(self):
+        html = ('<html><head><title>A story</title></head><body><div id="nav"><a href="/">Home</a></div>'
+                '<div class="extra">%s</div></body></html>'
+                % ''.join('<p style="color: red">Paragraph %d of the story goes on, and on, with commas, here.</p>' % k
+                          for k in range(12)))
+        page = readability.Readability(html, 'http://example.com/a/b.html')
+        page.process_document()
+        passes = [name for name, _ in page.get_timings() if name.startswith('grab_article') or name == 'undo']
+        self.assertEqual(passes, ['grab_article', 'undo', 'grab_article -strip_unlike'])
+        body = page.get_article_body()
+        for k in range(12):
+            self.assertTrue('Paragraph %d of the story' % k in body)
+        self.assertFalse('color: red' in body)
+
+
+if __name__ == '__main__':
+    unittest.main()
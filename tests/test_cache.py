@@ -0,0 +1,166 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import readability
+
+
+PARAGRAPH = '<p>' + 'Words of the story go on, and on, with commas, here. ' * 8 + '</p>'
+
+
+def story(n):
+    return ('<html><head><title>Story %d</title></head><body><div id="story">%s</div></body></html>'
+            % (n, PARAGRAPH * 3))
+
+
+def result(n, padding=0):
+    return (u'Story %d' % n, '<p>%s</p>' % ('x' * padding), [(u'http://example.com/%d' % n, u'link')])
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.directory)
+
+    def cache(self, *args, **kwargs):
+        cache = readability.ReadabilityCache(*args, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def used(self, key):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT used FROM results WHERE key = ?', (key,)).fetchone()[0]
+        finally:
+            db.close()
+
+
+class ReadabilityCacheTest(CacheTestCase):
+
+    def test_counters(self):
+        cache = self.cache()
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', result(1))
+        self.assertEqual(cache.get('a'), result(1))
+        self.assertEqual(cache.get('a'), result(1))
+        self.assertEqual((cache.hits, cache.memory_hits, cache.misses), (2, 2, 1))
+
+    def test_memory_lru(self):
+        cache = self.cache(size=2)
+        cache.put('a', result(1))
+        cache.put('b', result(2))
+        cache.get('a')
+        cache.put('c', result(3))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), result(1))
+        self.assertEqual(cache.get('c'), result(3))
+
+    def test_disk(self):
+        cache = self.cache(size=1, path=self.path)
+        cache.put('a', result(1))
+        cache.put('b', result(2))
+        self.assertEqual(cache.get('a'), result(1))
+        self.assertEqual((cache.hits, cache.memory_hits, cache.misses), (1, 0, 0))
+        other = self.cache(path=self.path)
+        self.assertEqual(other.get('b'), result(2))
+
+    def test_max_bytes_drops_least_recently_used(self):
+        cache = self.cache(size=1, path=self.path, max_bytes=2500)
+        cache.put('a', result(1, 1000))
+        cache.put('b', result(2, 1000))
+        time.sleep(0.01)
+        # a is used after b was stored, so b goes first
+        self.assertEqual(cache.get('a'), result(1, 1000))
+        cache.put('c', result(3, 1000))
+        other = self.cache(size=1, path=self.path)
+        self.assertEqual(other.get('b'), None)
+        self.assertEqual(other.get('a'), result(1, 1000))
+        self.assertEqual(other.get('c'), result(3, 1000))
+
+    def test_hits_written_in_batches(self):
+        cache = self.cache(size=1, path=self.path)
+        cache.put('a', result(1))
+        cache.put('b', result(2))
+        stored = self.used('a')
+        time.sleep(0.01)
+        cache.get('a')
+        self.assertEqual(self.used('a'), stored)
+        cache.put('c', result(3))
+        self.assertTrue(self.used('a') > stored)
+
+        stored = self.used('b')
+        cache.USED_BATCH = 2
+        cache.get('b')
+        self.assertEqual(self.used('b'), stored)
+        cache.get('c')
+        self.assertTrue(self.used('b') > stored)
+
+    def test_hits_written_on_close(self):
+        cache = self.cache(size=1, path=self.path)
+        cache.put('a', result(1))
+        cache.put('b', result(2))
+        stored = self.used('a')
+        time.sleep(0.01)
+        cache.get('a')
+        cache.close()
+        self.assertTrue(self.used('a') > stored)
+
+
+class CachedExtractionTest(CacheTestCase):
+
+    def test_hit_skips_parsing(self):
+        cache = self.cache()
+        expected = readability.extract_document(story(1), 'http://example.com/1', None, cache)
+        original = readability.Readability
+
+        def unexpected(*args, **kwargs):
+            raise AssertionError('parsed again')
+
+        readability.Readability = unexpected
+        try:
+            self.assertEqual(readability.extract_document(story(1), 'http://example.com/1', None, cache), expected)
+            self.assertRaises(AssertionError, readability.extract_document, story(1), 'http://example.com/2',
+                              None, cache)
+            self.assertRaises(AssertionError, readability.extract_document, story(1), 'http://example.com/1',
+                              {'footnote_links': True}, cache)
+        finally:
+            readability.Readability = original
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_cache_key(self):
+        key = readability.cache_key(story(1), 'http://example.com/1')
+        self.assertEqual(readability.cache_key(story(1), 'http://example.com/1', {}), key)
+        # settings left at their defaults make no difference
+        self.assertEqual(readability.cache_key(story(1), 'http://example.com/1', {'strip_unlike': True}), key)
+        self.assertNotEqual(readability.cache_key(story(1).decode('utf-8'), 'http://example.com/1'), key)
+        self.assertNotEqual(readability.cache_key(story(1), 'http://example.com/1', {'charset': 'latin-1'}), key)
+
+    def test_pool(self):
+        cache = self.cache(path=self.path)
+        documents = [(story(n), 'http://example.com/%d' % n) for n in range(3)]
+        pool = readability.ReadabilityPool(processes=2, cache=cache)
+        try:
+            first = list(pool.process_many(documents))
+            for worker in pool._idle:
+                worker.kill()
+            pool._idle = []
+            self.assertEqual(list(pool.process_many(documents)), first)
+            self.assertEqual(pool._idle, [])
+            self.assertEqual(pool.submit(*documents[0]).result(10), first[0])
+        finally:
+            pool.close()
+        self.assertEqual((cache.hits, cache.misses), (4, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# coding=UTF-8
+import unittest
+
+import readability
+
+
+def document(headFiller, charset='iso-8859-2'):
+    return ('<html><head><title>T</title>%s<meta http-equiv="Content-Type" content="text/html; charset=%s">'
+            '</head><body><p>\xb1\xb6</p></body></html>') % (headFiller, charset)
+
+
+class PrescanTest(unittest.TestCase):
+
+    def assertDeclared(self, markup, encoding):
+        dammit = readability.UnicodeDammit(markup, isHTML=True)
+        self.assertEqual(dammit.declaredHTMLEncoding, encoding)
+        self.assertEqual(dammit.originalEncoding, encoding)
+        self.assertTrue(u'ąś' in dammit.unicode)
+
+    def test_meta_in_prescan(self):
+        self.assertDeclared(document(''), 'iso-8859-2')
+
+    def test_meta_in_long_head(self):
+        filler = '<meta name="keywords" content="%s">' % ('x' * 100000)
+        self.assertDeclared(document(filler), 'iso-8859-2')
+
+    def test_meta_past_head_end_left_to_start_meta(self):
+        filler = '</head><body>' + 'x' * 100000
+        markup = document(filler)
+        self.assertEqual(readability.UnicodeDammit(markup, isHTML=True).declaredHTMLEncoding, None)
+        soup = readability.BeautifulSoup(markup)
+        self.assertEqual(soup.originalEncoding, 'iso-8859-2')
+        self.assertTrue(u'ąś' in unicode(soup))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+''' Pins the tokenizer, the serializer and the extraction to the output of readability 1.7.1.12, as recorded in
+data/baseline.json: md5 digests of what the soup classes make of random markup, and of what Readability makes
+of the pages in data/pages. The page digests were recorded once the body wrapping in _grabArticle kept the
+order of the body's children, which 1.7.1.12 shuffled '''
+import hashlib
+import json
+import os
+import random
+import unittest
+from cStringIO import StringIO
+
+import readability
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+SOUP_CLASSES = ['BeautifulStoneSoup', 'BeautifulSoup', 'ICantBelieveItsBeautifulSoup', 'MinimalSoup',
+                'BeautifulSOAP']
+PAGE_SETTINGS = {
+    'default': {},
+    'footnotes': {'url': 'http://example.com/a/b/story.html', 'footnote_links': True,
+                  'readable_footnote_links': True, 'service_uri': 'http://svc/?u=%s'},
+    'nostrip': {'strip_unlike': False, 'weight_classes': False},
+}
+
+TAGS = ('p li ul ol table tr td th b i div span pre textarea dl dd dt blockquote font a em noscript tbody thead '
+        'tfoot html body head title br hr img small big code script style meta').split()
+ATTRIBUTES = ['', ' class="c"', ' id=x', ' href="/a?b=1&c=2"', " title='it&apos;s'", ' checked']
+TEXTS = ['x', ' ', '\n', '  \n ', 'foo bar', '&amp;', '<!-- c -->', '&nbsp;', '&#233;', '\xc3\xa9',
+         '<![CDATA[ d ]]>', '<?pi x?>', '<!DOCTYPE html>', '< 3', 'a > b']
+
+
+def random_markup(seed):
+    rng = random.Random(seed)
+    markup = []
+    for _ in range(rng.randint(1, 120)):
+        r = rng.random()
+        if r < 0.45:
+            markup.append('<%s%s>' % (rng.choice(TAGS), rng.choice(ATTRIBUTES)))
+        elif r < 0.75:
+            markup.append('</%s>' % rng.choice(TAGS))
+        else:
+            markup.append(rng.choice(TEXTS))
+    return ''.join(markup)
+
+
+def digest(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.md5(text).hexdigest()[:16]
+
+
+def soup_digests(markup):
+    digests = []
+    for name in SOUP_CLASSES:
+        soup = getattr(readability, name)(markup)
+        digests.extend([digest(str(soup)), digest(soup.prettify())])
+    return digests
+
+
+def page_digests(html, settings):
+    settings = dict(settings)
+    url = settings.pop('url', None)
+    r = readability.Readability(html, url, **settings)
+    r.process_document()
+    footnotes = repr([tuple(unicode(part) for part in footnote) for footnote in r.get_article_footnotes()])
+    return {'html': digest(r.get_html()), 'pretty': digest(r.get_html(prettyPrint=True)),
+            'body': digest(r.get_article_body()), 'title': digest(r.get_title()), 'footnotes': digest(footnotes)}
+
+
+def make_baseline():
+    ''' The content of data/baseline.json, for the readability module imported '''
+    pages = {}
+    for name in sorted(os.listdir(os.path.join(DATA, 'pages'))):
+        html = open(os.path.join(DATA, 'pages', name), 'rb').read()
+        pages[name] = dict((key, page_digests(html, settings)) for key, settings in PAGE_SETTINGS.items())
+    return {'soups': [soup_digests(random_markup(seed)) for seed in range(300)], 'pages': pages}
+
+
+class EquivalenceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.baseline = json.load(open(os.path.join(DATA, 'baseline.json')))
+
+    def test_soups(self):
+        for seed, expected in enumerate(self.baseline['soups']):
+            self.assertEqual(soup_digests(random_markup(seed)), expected, 'markup of seed %s' % seed)
+
+    def test_pages(self):
+        for name, expected in sorted(self.baseline['pages'].items()):
+            html = open(os.path.join(DATA, 'pages', name), 'rb').read()
+            for key, settings in PAGE_SETTINGS.items():
+                self.assertEqual(page_digests(html, settings), expected[key], '%s, %s' % (name, key))
+
+    def test_chunked_output(self):
+        for name in sorted(self.baseline['pages']):
+            html = open(os.path.join(DATA, 'pages', name), 'rb').read()
+            r = readability.Readability(html, None)
+            r.process_document()
+            out = StringIO()
+            r.write_html(out)
+            self.assertEqual(out.getvalue(), r.get_html(), name)
+            self.assertEqual(u''.join(r.iter_html(encoding=None)).encode('utf-8'), r.get_html(), name)
+
+
+MASSAGED = ['<br/>', '<img src=x/>', '<p class="x/>', '<p title="a/>b">', '<a/b/>', '<a/b/', '<a_b/c/>', '<x:y/>',
+            '<br/<p>', '</p/>', '</ p />', '</>', '<! --', ' -->', '<!  />', '<! x/>', '<!/>', '<! DOCTYPE x>',
+            '<!DOCTYPE y/>', '<! [CDATA[', ']]>', '<?pi/>', '<!-- c/> -->', 'text/>', '<', '>', '/', ' ', 'x',
+            '<p>', '</p>', '<script>', '</script>', '<textarea>', '</textarea>']
+
+
+class MassageTest(unittest.TestCase):
+    ''' The tokenizer applies the default markup massage as it reads; a copy of MARKUP_MASSAGE is applied to the
+    markup first, the way any other massage is '''
+
+    def assertMassaged(self, markup):
+        massage = list(readability.BeautifulStoneSoup.MARKUP_MASSAGE)
+        for name in SOUP_CLASSES:
+            soup = getattr(readability, name)
+            self.assertEqual(str(soup(markup)), str(soup(markup, markupMassage=massage)), '%s: %r' % (name, markup))
+
+    def test_massaged_markup(self):
+        for markup in MASSAGED:
+            self.assertMassaged(markup)
+            self.assertMassaged('<p>%s</p>' % markup)
+
+    def test_random_markup(self):
+        for seed in range(300):
+            rng = random.Random(seed)
+            self.assertMassaged(''.join(rng.choice(MASSAGED) for _ in range(rng.randint(1, 40))))
+
+
+if __name__ == '__main__':
+    unittest.main()
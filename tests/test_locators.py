@@ -0,0 +1,124 @@
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import readability
+
+
+def paragraphs(n, count, words=12):
+    return ''.join('<p>Paragraph %d of story %d goes on, and on, with commas, here. %s</p>'
+                   % (k, n, 'More words of story %d. ' % n * words) for k in range(count))
+
+
+def page(n, story, intro=''):
+    ''' A page of the example.com template: furniture around a story div in a main div, after an optional
+    intro next to the story '''
+    return ('<html><head><title>Story %d</title></head><body>'
+            '<div id="header"><a href="/">Home</a></div>'
+            '<div id="main">%s<div id="story">%s</div><div class="share"><a href="/s">Share</a></div></div>'
+            '<div id="footer">Footer text</div></body></html>') % (n, intro, story)
+
+
+def stories():
+    ''' Pages of the same domain, with what full scoring finds in them varying around the story div '''
+    yield page(1, paragraphs(1, 5))
+    yield page(2, paragraphs(2, 6))
+    # an intro paragraph next to the story, appended as a sibling
+    yield page(3, paragraphs(3, 5), intro='<p>%s</p>' % ('An intro to story 3, with commas, and more. ' * 4))
+    # most of the story in a div of its own inside the story div, which outscores it
+    yield page(4, '<p>Story 4, in short, opens here, then goes on.</p><div class="body">%s</div>'
+                  % paragraphs(4, 8))
+    # the story in the main div, with a short note in the story div
+    yield page(5, '<p>A note, with a comma, about it all.</p>', intro=paragraphs(5, 6))
+    yield page(6, paragraphs(6, 4, words=3))
+
+
+class LocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def extract(self, html, url, **settings):
+        events = []
+        r = readability.Readability(html, url, trace=lambda event, fields: events.append((event, fields)),
+                                    **settings)
+        r.process_document()
+        accepted = [fields['accepted'] for event, fields in events if event == 'locator_checked']
+        return r.get_html(), accepted
+
+    def test_same_output_as_full_scoring(self):
+        store = readability.LocatorStore()
+        checks = []
+        for n, html in enumerate(stories()):
+            url = 'http://example.com/story/%d' % n
+            full, _ = self.extract(html, url)
+            located, accepted = self.extract(html, url, locators=store)
+            self.assertEqual(located, full, 'page %d' % n)
+            checks.append(accepted)
+        self.assertEqual(checks[0], [])
+        # the located story div is used where full scoring picks it, whatever its siblings
+        self.assertEqual(checks[1:4], [[True], [True], [False]])
+
+    def test_learned_steps(self):
+        store = readability.LocatorStore()
+        self.extract(page(1, paragraphs(1, 5)), 'http://example.com/story/1', locators=store)
+        self.assertEqual(store.get('example.com'), (('div', '', 'main', 0), ('div', '', 'story', 0)))
+        self.assertEqual(store.get('other.example.com'), None)
+
+    def test_cache_key(self):
+        store = readability.LocatorStore()
+        html = page(1, paragraphs(1, 5))
+        url = 'http://example.com/story/1'
+        key = readability.cache_key(html, url, {'locators': store})
+        self.assertEqual(key, readability.cache_key(html, url, {'locators': store}))
+        self.extract(html, url, locators=store)
+        self.assertNotEqual(readability.cache_key(html, url, {'locators': store}), key)
+        self.assertEqual(readability.cache_key(html, 'http://other.example.com/', {'locators': store}),
+                         readability.cache_key(html, 'http://other.example.com/', {}))
+
+    def test_pickled_stores(self):
+        self.assertRaises(TypeError, cPickle.dumps, readability.LocatorStore(), 2)
+        store = readability.LocatorStore(path=os.path.join(self.directory, 'locators.db'))
+        try:
+            store.put('example.com', [('div', '', 'story', 0)])
+            copy = cPickle.loads(cPickle.dumps(store, 2))
+            self.assertTrue(cPickle.loads(cPickle.dumps(store, 2)) is copy)
+            self.assertEqual(copy.get('example.com'), [('div', '', 'story', 0)])
+        finally:
+            store.close()
+
+    def test_shared_path(self):
+        path = os.path.join(self.directory, 'locators.db')
+        first = readability.LocatorStore(path=path)
+        second = readability.LocatorStore(path=path)
+        try:
+            first.put('example.com', (('div', '', 'story', 0),))
+            self.assertEqual(second.get('example.com'), (('div', '', 'story', 0),))
+            first.put('example.com', (('div', '', 'main', 0),))
+            self.assertEqual(second.get('example.com'), (('div', '', 'main', 0),))
+            # dropped from the database by the other store
+            first._db.execute('DELETE FROM locators')
+            first._db.commit()
+            self.assertEqual(second.get('example.com'), None)
+        finally:
+            first.close()
+            second.close()
+
+    def test_pool_needs_a_path(self):
+        pool = readability.ReadabilityPool(processes=1)
+        try:
+            self.assertRaises(ValueError, pool.submit, page(1, paragraphs(1, 5)), 'http://example.com/1',
+                              {'locators': readability.LocatorStore()})
+            documents = [(page(1, paragraphs(1, 5)), 'http://example.com/1', {'locators': readability.LocatorStore()})]
+            self.assertRaises(ValueError, list, readability.process_many(documents, processes=1))
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import re
+import SocketServer
+import threading
+import unittest
+
+import readability
+
+
+BASE = 'http://example.com/story/'
+
+
+def article(n):
+    return ''.join('<p>Part %d of the story, paragraph %d, goes on, and on, with commas, here. %s</p>'
+                   % (n, k, 'More words of part %d. ' % n * 10) for k in range(3))
+
+
+def page(n, links, body=None):
+    ''' A page of the story, with links, (href, text) tuples, in a pagination div '''
+    anchors = ' '.join('<a href="%s">%s</a>' % link for link in links)
+    return ('<html><head><title>Story</title></head><body><div id="story">%s</div>'
+            '<div class="pagination">%s</div></body></html>') % (body or article(n), anchors)
+
+
+def chain(count):
+    ''' A story of count pages, each with a next link to the following one '''
+    site = {}
+    for n in range(1, count + 1):
+        links = []
+        if n < count:
+            links.append((BASE + str(n + 1), 'Next'))
+        site[BASE + str(n)] = page(n, links)
+    return site
+
+
+class Site(object):
+    ''' An in-process fetcher over a dict of url -> content; urls missing from it fail '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = []
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        self._lock.acquire()
+        try:
+            self.fetched.append(url)
+        finally:
+            self._lock.release()
+        if url not in self.pages:
+            raise IOError('404 %s' % url)
+        return self.pages[url]
+
+
+def appended_parts(body):
+    ''' The story parts of the pages appended to an article body, in order '''
+    pages = re.split('id="readability-page-\d+"', body)[1:]
+    return [sorted(set(re.findall('Part (\d+) of', part))) for part in pages]
+
+
+class NextPagesTest(unittest.TestCase):
+
+    def extract(self, site, url=BASE + '1', **settings):
+        r = readability.Readability(site.pages[url], url, fetcher=site, **settings)
+        r.process_document()
+        return r.get_article_body()
+
+    def test_pages_in_order(self):
+        site = Site(chain(5))
+        body = self.extract(site)
+        self.assertEqual(appended_parts(body), [['2'], ['3'], ['4'], ['5']])
+        self.assertEqual(re.findall('id="readability-page-(\d+)"', body), ['2', '3', '4', '5'])
+        self.assertEqual(re.findall('title="Page (\d+)"', body), ['2', '3', '4', '5'])
+        self.assertFalse('readability-page-pagination' in body)
+
+    def test_duplicate_pages_skipped(self):
+        pages = chain(4)
+        # page 3 repeats the article of page 2, and links on to page 4
+        pages[BASE + '3'] = page(3, [(BASE + '4', 'Next')], body=article(2))
+        site = Site(pages)
+        self.assertEqual(appended_parts(self.extract(site)), [['2'], ['4']])
+
+    def test_next_candidate_after_failed_fetch(self):
+        pages = chain(3)
+        pages[BASE + '1'] = page(1, [(BASE + 'missing/2', 'Next'), (BASE + '2', 'Next page')])
+        site = Site(pages)
+        self.assertEqual(appended_parts(self.extract(site)), [['2'], ['3']])
+        self.assertTrue(BASE + 'missing/2' in site.fetched)
+
+    def test_all_fetches_failed(self):
+        pages = {BASE + '1': page(1, [(BASE + '2', 'Next')])}
+        body = self.extract(Site(pages))
+        self.assertEqual(appended_parts(body), [])
+        self.assertTrue('readability-page-pagination' in body)
+
+    def test_max_pages(self):
+        site = Site(chain(8))
+        self.assertEqual(appended_parts(self.extract(site, max_pages=3)), [['2'], ['3']])
+        self.assertTrue(len(site.fetched) <= 2)
+
+    def test_fetches_ahead_a_few_candidates(self):
+        pages = chain(3)
+        # numbered links score below the next link
+        pages[BASE + '1'] = page(1, [(BASE + '2', 'Next')] + [(BASE + 'page/%d' % k, str(k)) for k in range(3, 9)])
+        site = Site(pages)
+        self.assertEqual(appended_parts(self.extract(site, page_fetchers=2)), [['2'], ['3']])
+        self.assertEqual(set(site.fetched) - set([BASE + '2', BASE + 'page/3', BASE + '3']), set())
+
+    def test_prune_unlike(self):
+        site = Site(chain(4))
+        self.assertEqual(appended_parts(self.extract(site, prune_unlike=True)), [['2'], ['3'], ['4']])
+
+    def test_relative_links(self):
+        pages = chain(3)
+        pages[BASE + '1'] = page(1, [('2', 'Next')])
+        self.assertEqual(appended_parts(self.extract(Site(pages))), [['2'], ['3']])
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' Serves pages, path -> (content, charset or None), on a port of 127.0.0.1 '''
+
+    daemon_threads = True
+
+    def __init__(self, pages):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), PageHandler)
+        self.pages = pages
+        self.base = 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in self.server.pages:
+            self.send_error(404)
+            return
+        content, charset = self.server.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=%s' % charset if charset else 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchPageTest(unittest.TestCase):
+    ''' Following pages fetched over HTTP with readability.fetch_page '''
+
+    def setUp(self):
+        self.server = PageServer({})
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve(self, path, n, next, charset=None, text=u''):
+        links = next and [(self.server.base + next, 'Next')] or []
+        body = u'<p>%s</p>%s' % (text, article(n)) if text else None
+        self.server.pages[path] = (page(n, links, body).encode(charset or 'utf-8'), charset)
+
+    def extract(self, path):
+        url = self.server.base + path
+        content = readability.fetch_page(url)
+        r = readability.Readability(content[0], url, charset=content[1], fetcher=readability.fetch_page)
+        r.process_document()
+        return r.get_article_body().decode('utf-8')
+
+    def test_pages_with_charsets(self):
+        greek = u'Καλημέρα, κόσμε, με κόμματα, εδώ. ' * 4
+        french = u'Déjà l\'été, à côté, où l\'on fête. ' * 4
+        self.serve('/story/1', 1, '/story/2', 'utf-8', greek)
+        self.serve('/story/2', 2, '/story/3', 'iso-8859-7', greek)
+        self.serve('/story/3', 3, '/story/4', 'iso-8859-1', french)
+        # no charset in the response: the page is detected as what it is, UTF-8
+        self.serve('/story/4', 4, None, None, french)
+        body = self.extract('/story/1')
+        self.assertEqual(appended_parts(body), [['2'], ['3'], ['4']])
+        self.assertEqual(body.count(greek.strip()), 2)
+        self.assertEqual(body.count(french.strip()), 2)
+
+    def test_missing_page(self):
+        self.serve('/story/1', 1, '/missing/2')
+        body = self.extract('/story/1')
+        self.assertEqual(appended_parts(body), [])
+        self.assertTrue('readability-page-pagination' in body)
+        self.assertTrue(self.server.base + '/missing/2' in body)
+
+    def test_fetch_page(self):
+        self.serve('/story/1', 1, None, 'iso-8859-1', u'Déjà, été.')
+        content, charset = readability.fetch_page(self.server.base + '/story/1')
+        self.assertEqual(charset, 'iso-8859-1')
+        self.assertTrue(u'Déjà, été.'.encode('iso-8859-1') in content)
+        self.assertRaises(IOError, readability.fetch_page, self.server.base + '/missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,369 @@
+import logging
+import os
+import select
+import signal
+import threading
+import time
+import unittest
+
+import readability
+
+
+PARAGRAPH = '<p>' + 'Words of the story go on, and on, with commas, here. ' * 8 + '</p>'
+
+
+def story(n):
+    return ('<html><head><title>Story %d</title></head><body><div id="story">%s</div></body></html>'
+            % (n, PARAGRAPH * 3))
+
+
+def scripted_extract(content, url, settings, cache=None):
+    ''' Stands in for extract_document in the workers, which are forked after it is patched in: the url
+    says what to do with a document '''
+    if url == 'sleep':
+        time.sleep(30)
+    elif url == 'crash':
+        os._exit(3)
+    elif url == 'error':
+        raise RuntimeError('bad document')
+    return original_extract(content, url, settings, cache)
+
+
+original_extract = readability.extract_document
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        readability.extract_document = scripted_extract
+
+    def tearDown(self):
+        readability.extract_document = original_extract
+
+    def expected(self, n):
+        return original_extract(story(n), 'http://example.com/%d' % n, None)
+
+
+class ProcessManyTest(PoolTestCase):
+
+    def documents(self, count):
+        return [(story(n), 'http://example.com/%d' % n) for n in range(count)]
+
+    def test_ordered(self):
+        results = list(readability.process_many(self.documents(20), processes=3))
+        self.assertEqual(results, [self.expected(n) for n in range(20)])
+
+    def test_unordered(self):
+        results = list(readability.process_many(self.documents(20), processes=3, ordered=False))
+        self.assertEqual(sorted(index for index, _ in results), range(20))
+        for index, result in results:
+            self.assertEqual(result, self.expected(index))
+
+    def test_settings(self):
+        documents = [(story(0), 'http://example.com/0', {'footnote_links': False})]
+        title, body, footnotes = list(readability.process_many(documents, processes=1))[0]
+        self.assertEqual(title, u'Story 0')
+        self.assertEqual(footnotes, [])
+
+    def test_timeout(self):
+        documents = self.documents(2) + [(story(2), 'sleep')] + self.documents(2)
+        start = time.time()
+        results = list(readability.process_many(documents, processes=2, timeout=1))
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(results[2].reason, 'timeout')
+        self.assertEqual(results[:2] + results[3:], [self.expected(0), self.expected(1)] * 2)
+
+    def test_crash(self):
+        documents = [(story(0), 'crash')] + self.documents(3)
+        results = list(readability.process_many(documents, processes=2))
+        self.assertTrue(isinstance(results[0], readability.ReadabilityBatchError))
+        self.assertEqual(results[0].reason, 'crash')
+        self.assertEqual(results[1:], [self.expected(n) for n in range(3)])
+
+    def test_error(self):
+        documents = self.documents(1) + [(story(1), 'error')]
+        results = list(readability.process_many(documents, processes=1))
+        self.assertEqual(results[0], self.expected(0))
+        self.assertEqual(results[1].reason, 'error')
+        self.assertTrue('RuntimeError: bad document' in results[1].detail)
+
+    def test_idle_worker_killed(self):
+        pool = readability.ReadabilityPool(processes=2)
+        try:
+            self.assertEqual(list(pool.process_many(self.documents(2))), [self.expected(n) for n in range(2)])
+            for worker in pool._idle:
+                os.kill(worker.process.pid, signal.SIGKILL)
+                worker.process.join()
+            self.assertEqual(list(pool.process_many(self.documents(4))), [self.expected(n) for n in range(4)])
+        finally:
+            pool.close()
+
+    def test_idle_worker_killed_unnoticed(self):
+        pool = readability.ReadabilityPool(processes=1)
+        try:
+            self.assertEqual(list(pool.process_many(self.documents(1))), [self.expected(0)])
+            worker = pool._idle[0]
+            os.kill(worker.process.pid, signal.SIGKILL)
+            worker.process.join()
+            # dies between the liveness check and the send
+            worker.process.is_alive = lambda: True
+            self.assertEqual(list(pool.process_many(self.documents(2))), [self.expected(n) for n in range(2)])
+        finally:
+            pool.close()
+
+
+class SubmitTest(PoolTestCase):
+
+    def setUp(self):
+        PoolTestCase.setUp(self)
+        self.pool = readability.ReadabilityPool(processes=1, timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+        PoolTestCase.tearDown(self)
+
+    def assertFails(self, future, reason):
+        try:
+            future.result(10)
+        except readability.ReadabilityBatchError, e:
+            self.assertEqual(e.reason, reason)
+        else:
+            self.fail('%s expected' % reason)
+
+    def test_results(self):
+        futures = [self.pool.submit(story(n), 'http://example.com/%d' % n) for n in range(4)]
+        self.assertEqual([future.result(10) for future in futures], [self.expected(n) for n in range(4)])
+        self.assertTrue(all(future.done() and not future.cancelled() for future in futures))
+
+    def test_failures(self):
+        crashed = self.pool.submit(story(0), 'crash')
+        failed = self.pool.submit(story(1), 'error')
+        late = self.pool.submit(story(2), 'sleep')
+        self.assertFails(crashed, 'crash')
+        self.assertFails(failed, 'error')
+        self.assertFails(late, 'timeout')
+        self.assertEqual(self.pool.submit(story(3), 'http://example.com/3').result(10), self.expected(3))
+
+    def test_cancel(self):
+        running = self.pool.submit(story(0), 'sleep')
+        pending = self.pool.submit(story(1), 'http://example.com/1')
+        while not running.running():
+            time.sleep(0.01)
+        self.assertFalse(running.cancel())
+        self.assertTrue(pending.cancel())
+        self.assertTrue(pending.cancelled() and pending.done())
+        self.assertFails(pending, 'cancelled')
+        self.assertFails(running, 'timeout')
+        self.assertEqual(self.pool.submit(story(2), 'http://example.com/2').result(10), self.expected(2))
+
+    def test_wait_timeout(self):
+        future = self.pool.submit(story(0), 'sleep')
+        try:
+            future.result(0.1)
+        except readability.ReadabilityBatchError, e:
+            self.assertEqual(e.reason, 'wait_timeout')
+        else:
+            self.fail('wait_timeout expected')
+        self.assertFalse(future.done())
+        self.assertFails(future, 'timeout')
+
+    def test_callbacks(self):
+        done = []
+        future = self.pool.submit(story(0), 'http://example.com/0')
+        future.add_done_callback(done.append)
+        future.result(10)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_full(self):
+        pool = readability.ReadabilityPool(processes=1, timeout=2, max_pending=1)
+        try:
+            future = pool.submit(story(0), 'sleep')
+            self.assertRaises(readability.ReadabilityBatchError, pool.submit, story(1), 'http://example.com/1',
+                              block=False)
+            self.assertFails(future, 'timeout')
+            self.assertEqual(pool.submit(story(1), 'http://example.com/1', block=False).result(10),
+                             self.expected(1))
+        finally:
+            pool.close()
+
+    def test_close(self):
+        running = self.pool.submit(story(0), 'sleep')
+        pending = self.pool.submit(story(1), 'http://example.com/1')
+        self.pool.close()
+        self.assertFails(running, 'closed')
+        self.assertFails(pending, 'closed')
+        self.assertRaises(ValueError, self.pool.submit, story(2), 'http://example.com/2')
+
+    def test_idle_worker_killed(self):
+        self.assertEqual(self.pool.submit(story(0), 'http://example.com/0').result(10), self.expected(0))
+        worker = self.pool._idle[0]
+        os.kill(worker.process.pid, signal.SIGKILL)
+        worker.process.join()
+        worker.process.is_alive = lambda: True
+        self.assertEqual(self.pool.submit(story(1), 'http://example.com/1').result(10), self.expected(1))
+
+    def test_no_worker(self):
+        def unavailable(*args):
+            raise OSError('fork failed')
+        self.pool._dispatch = unavailable
+        self.assertFails(self.pool.submit(story(0), 'http://example.com/0'), 'crash')
+
+    def test_dispatching_thread_failure(self):
+        def broken(*args):
+            raise RuntimeError('unexpected')
+        self.pool._dispatch = broken
+        logging.disable(logging.ERROR)
+        try:
+            self.assertFails(self.pool.submit(story(0), 'http://example.com/0'), 'error')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertRaises(ValueError, self.pool.submit, story(1), 'http://example.com/1')
+
+
+class ExtractAsyncTest(PoolTestCase):
+
+    def tearDown(self):
+        pool = readability.set_shared_pool(None)
+        if pool is not None:
+            pool.close()
+        PoolTestCase.tearDown(self)
+
+    def test_does_not_block(self):
+        readability.set_shared_pool(readability.ReadabilityPool(processes=1, timeout=2, max_pending=1))
+        future = readability.extract_async(story(0), 'sleep')
+        try:
+            readability.extract_async(story(1), 'http://example.com/1')
+        except readability.ReadabilityBatchError, e:
+            self.assertEqual(e.reason, 'full')
+        else:
+            self.fail('full expected')
+        self.assertRaises(readability.ReadabilityBatchError, future.result, 10)
+
+    def test_one_shared_pool(self):
+        pools = []
+        original_pool = readability.ReadabilityPool
+
+        class CountedPool(original_pool):
+            def __init__(self, *args, **kwargs):
+                time.sleep(0.05)
+                pools.append(self)
+                original_pool.__init__(self, processes=2)
+
+        readability.ReadabilityPool = CountedPool
+        try:
+            futures = []
+            threads = [threading.Thread(target=lambda n=n: futures.append(
+                readability.extract_async(story(n), 'http://example.com/%d' % n))) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            readability.ReadabilityPool = original_pool
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(sorted(future.result(10) for future in futures),
+                         sorted(self.expected(n) for n in range(4)))
+
+
+class PipeLoop(object):
+    ''' A minimal event loop: run_until runs the calls handed over with call_soon_threadsafe in the thread
+    that runs it, woken up through a pipe '''
+
+    def __init__(self):
+        self._calls = []
+        self._lock = threading.Lock()
+        self._wakeup = os.pipe()
+
+    def call_soon_threadsafe(self, fn, *args):
+        self._lock.acquire()
+        try:
+            self._calls.append((fn, args))
+        finally:
+            self._lock.release()
+        os.write(self._wakeup[1], '.')
+
+    def run_until(self, done, timeout=10):
+        deadline = time.time() + timeout
+        while not done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AssertionError('not done after %ss' % timeout)
+            if select.select([self._wakeup[0]], [], [], remaining)[0]:
+                os.read(self._wakeup[0], 512)
+            self._lock.acquire()
+            try:
+                calls, self._calls = self._calls, []
+            finally:
+                self._lock.release()
+            for fn, args in calls:
+                fn(*args)
+
+    def close(self):
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+
+
+class EventLoopTest(PoolTestCase):
+
+    def setUp(self):
+        PoolTestCase.setUp(self)
+        self.loop = PipeLoop()
+        readability.set_shared_pool(readability.ReadabilityPool(processes=2, timeout=5))
+
+    def tearDown(self):
+        self.loop.close()
+        readability.set_shared_pool(None).close()
+        PoolTestCase.tearDown(self)
+
+    def test_callbacks_in_loop_thread(self):
+        done = {}
+
+        def finished(future, n):
+            try:
+                done[n] = (threading.current_thread(), future.result())
+            except readability.ReadabilityBatchError, e:
+                done[n] = (threading.current_thread(), e.reason)
+        urls = ['http://example.com/0', 'error', 'http://example.com/2']
+        for n, url in enumerate(urls):
+            future = readability.extract_async(story(n), url)
+            future.add_done_callback(readability.loop_done_callback(self.loop, lambda future, n=n: finished(future, n)))
+        self.loop.run_until(lambda: len(done) == len(urls))
+        self.assertEqual(set(thread for thread, _ in done.values()), set([threading.current_thread()]))
+        self.assertEqual(done[0][1], self.expected(0))
+        self.assertEqual(done[1][1], 'error')
+        self.assertEqual(done[2][1], self.expected(2))
+
+    def test_callback_of_done_future(self):
+        future = readability.extract_async(story(0), 'http://example.com/0')
+        future.result(10)
+        done = []
+        future.add_done_callback(readability.loop_done_callback(self.loop, done.append))
+        self.assertEqual(done, [])
+        self.loop.run_until(lambda: done)
+        self.assertTrue(done[0] is future)
+
+    @unittest.skipIf(readability.concurrent_futures is None, 'the futures backport is not installed')
+    def test_concurrent_future(self):
+        futures = readability.concurrent_futures
+        readability.set_shared_pool(readability.ReadabilityPool(processes=1, timeout=5)).close()
+        sleeping = readability.extract_async(story(0), 'sleep')
+        waiting = readability.extract_async(story(1), 'http://example.com/1')
+        self.assertTrue(isinstance(sleeping, futures.Future))
+        self.assertTrue(waiting.cancel())
+        self.assertTrue(waiting.cancelled())
+        self.assertRaises(futures.CancelledError, waiting.result)
+
+        done = readability.extract_async(story(2), 'http://example.com/2')
+        self.assertEqual(list(futures.as_completed([done], 10))[0].result(), self.expected(2))
+        self.assertFalse(sleeping.cancel())
+        try:
+            sleeping.result(10)
+        except readability.ReadabilityBatchError, e:
+            self.assertEqual(e.reason, 'timeout')
+        else:
+            self.fail('timeout expected')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import readability
+
+
+PARAGRAPH = '<p>' + 'Words of the story go on, and on, with commas, here. ' * 8 + '</p>'
+
+
+def story_page(furniture):
+    return ('<html><head><title>Story</title></head><body><div id="story">%s</div>%s</body></html>'
+            % (PARAGRAPH * 3, furniture))
+
+
+class PruneUnlikeTest(unittest.TestCase):
+
+    def assertSameOutput(self, html, url='http://example.com/story/1'):
+        outputs = []
+        for prune in (False, True):
+            r = readability.Readability(html, url, prune_unlike=prune)
+            r.process_document()
+            outputs.append(r.get_html())
+        self.assertEqual(outputs[0], outputs[1])
+        return outputs[1]
+
+    def test_pagination_links_survive_pruning(self):
+        html = story_page('<div class="pagination"><a href="http://example.com/story/2">Next</a></div>')
+        self.assertTrue('readability-page-next' in self.assertSameOutput(html))
+
+    def test_next_links_in_other_unlikely_candidates(self):
+        html = story_page('<div class="nav"><a href="/story/2">next &raquo;</a></div>'
+                          '<div class="menu"><a href="/about">About</a></div>')
+        self.assertTrue('http://example.com/story/2' in self.assertSameOutput(html))
+
+    def test_paging_url(self):
+        html = story_page('<div class="menu"><a href="3">3</a></div>')
+        self.assertSameOutput(html, 'http://example.com/story/page/2')
+
+    def test_unrelated_candidates_stay_pruned(self):
+        html = story_page('<div class="menu"><a href="/about">About</a></div><div class="sidebar">Ads</div>')
+        r = readability.Readability(html, 'http://example.com/story/1', prune_unlike=True)
+        r._prepare_document()
+        r._find_next_page_link()
+        self.assertEqual(len(r._osoup.prunedElements), 2)
+
+
+class MayLinkNextPageTest(unittest.TestCase):
+
+    def test_markup(self):
+        self.assertFalse(readability.may_link_next_page('<div class="menu">Next</div>'))
+        self.assertFalse(readability.may_link_next_page('<ul><li><a href="/about">About</a></li></ul>'))
+        self.assertTrue(readability.may_link_next_page('<div><a href="/s/2">Next</a></div>'))
+        self.assertTrue(readability.may_link_next_page('<div><a href="/s/2">&gt;&gt;</a></div>'))
+        self.assertTrue(readability.may_link_next_page('<div><a href="/s?page=2">2</a></div>'))
+        self.assertTrue(readability.may_link_next_page('<div><a href="/s/2">Page 2</a></div>'))
+        self.assertTrue(readability.may_link_next_page(None))
+
+    def test_paging_url(self):
+        markup = '<div><a href="3">3</a></div>'
+        self.assertFalse(readability.may_link_next_page(markup, 'http://example.com/story/2'))
+        self.assertTrue(readability.may_link_next_page(markup, 'http://example.com/story/page/2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
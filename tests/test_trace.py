@@ -0,0 +1,107 @@
+import logging
+import unittest
+
+import readability
+
+
+EVENTS = set(['node_removed', 'node_retagged', 'text_wrapped', 'candidate_scored', 'top_candidate',
+              'sibling_checked', 'unknown_score', 'conditional_check', 'class_removed', 'list_fixed',
+              'title_candidate', 'title_candidates', 'next_page_links', 'next_page_skipped', 'next_page_appended',
+              'locator_checked', 'locator_learned', 'missing_url'])
+
+
+def page():
+    return ('<html><head><title>A story - The Site</title></head><body><div class="sidebar">Links here</div>'
+            '<div id="story"><h1>A story</h1>%s<div class="share"><p>Share</p><a href="/x">x</a></div>'
+            '<div>A line of text</div></div></body></html>'
+            % ''.join('<p>Paragraph %d of the story goes on, and on, with commas, here. %s</p>'
+                      % (k, 'More words of the story. ' * 10) for k in range(6)))
+
+
+def traced(url=None, **settings):
+    events = []
+    r = readability.Readability(page(), url, trace=lambda event, fields: events.append((event, fields)),
+                                **settings)
+    r.process_document()
+    return r, events
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TraceTest(unittest.TestCase):
+
+    def fields(self, events, name):
+        return [fields for event, fields in events if event == name]
+
+    def test_events(self):
+        r, events = traced()
+        self.assertTrue(events)
+        self.assertEqual(set(event for event, _ in events) - EVENTS, set())
+        for event, fields in events:
+            node = fields.get('node')
+            if node is not None:
+                self.assertTrue(isinstance(node, readability.Tag), event)
+
+        removed = [(fields['node'].name, fields['node'].get('class'), fields['reason'])
+                   for fields in self.fields(events, 'node_removed')]
+        self.assertTrue(('div', 'sidebar', 'unlikely candidate') in removed)
+        self.assertTrue(('div', 'share', 'conditionally: contentLength<25 and img') in removed)
+
+        top, = self.fields(events, 'top_candidate')
+        self.assertEqual(top['node'].get('id'), 'story')
+        self.assertEqual(top['score'], r._get_content_score(top['node']))
+        self.assertTrue(top['score'] > 0)
+        scored = [fields['node'] for fields in self.fields(events, 'candidate_scored')]
+        self.assertTrue(top['node'] in scored)
+
+        self.assertEqual([fields['node'].name for fields in self.fields(events, 'node_retagged')], ['p'])
+        self.assertEqual([fields['source'] for fields in self.fields(events, 'title_candidate')], ['title'])
+        titles, = self.fields(events, 'title_candidates')
+        self.assertEqual(titles['titles'].keys(), [u'A story'])
+
+    def test_missing_url(self):
+        _, events = traced()
+        self.assertEqual(self.fields(events, 'missing_url'), [{}])
+        _, events = traced('http://example.com/a/b.html')
+        self.assertEqual(self.fields(events, 'missing_url'), [])
+
+    def test_output_unchanged(self):
+        r, _ = traced('http://example.com/a/b.html', footnote_links=True)
+        plain = readability.Readability(page(), 'http://example.com/a/b.html', footnote_links=True)
+        plain.process_document()
+        self.assertEqual(r.get_html(), plain.get_html())
+
+    def test_debug_default(self):
+        self.assertTrue(readability.Readability(page())._trace is None)
+        readability.__DEBUG__ = True
+        try:
+            self.assertTrue(readability.Readability(page())._trace is readability.log_trace)
+        finally:
+            readability.__DEBUG__ = False
+
+    def test_log_trace(self):
+        handler = ListHandler()
+        logger = logging.getLogger()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            soup = readability.BeautifulSoup('<div class="main" id="story">x</div>')
+            readability.log_trace('top_candidate', {'node': soup.div, 'score': 2.5})
+            readability.log_trace('missing_url', {})
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        self.assertEqual(handler.messages, ['top_candidate: node=div (main:story), score=2.5', 'missing_url: '])
+
+
+if __name__ == '__main__':
+    unittest.main()
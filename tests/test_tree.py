@@ -0,0 +1,402 @@
+import cPickle
+import pickle
+import random
+import unittest
+
+import readability
+from readability import NavigableString, ReadabilitySoup, Tag
+
+
+NAMES = ['div', 'p', 'span', 'a', 'ul', 'li']
+
+
+def random_document(rng):
+    markup = []
+    for k in range(rng.randint(20, 80)):
+        r = rng.random()
+        if r < 0.45:
+            markup.append('<%s%s>' % (rng.choice(NAMES), rng.choice(['', ' id="i%d"' % rng.randint(0, 5)])))
+        elif r < 0.75:
+            markup.append('</%s>' % rng.choice(NAMES))
+        else:
+            markup.append('text %d' % k)
+    return '<html><head></head><body>%s</body></html>' % ''.join(markup)
+
+
+def walk(tag, name=None, **attrs):
+    ''' findAll without the index '''
+    return list(tag._findAll(name, attrs, None, None, tag.recursiveChildGenerator))
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def assertIndexed(self, soup, rng):
+        tags = soup.findAll(True)
+        for tag in [soup] + rng.sample(tags, min(3, len(tags))):
+            for name in NAMES + [NAMES[:3]]:
+                self.assertEqual(list(tag.findAll(name)), walk(tag, name))
+            for k in range(6):
+                self.assertEqual(list(tag.findAll(id='i%d' % k)), walk(tag, id='i%d' % k))
+
+    def new_tag(self, soup, rng):
+        tag = Tag(soup, rng.choice(NAMES), [('id', 'i%d' % rng.randint(0, 5))])
+        if rng.random() < 0.5:
+            tag.append(Tag(soup, rng.choice(NAMES)))
+            tag.append('inner')
+        return tag
+
+    def mutate(self, soup, rng):
+        tags = soup.body.findAll(True)
+        if not tags:
+            soup.body.append(self.new_tag(soup, rng))
+            return
+        tag = rng.choice(tags)
+        op = rng.randint(0, 8)
+        if op == 0:
+            tag.insert(rng.randint(0, len(tag.contents)), self.new_tag(soup, rng))
+        elif op == 1:
+            tag.insert(rng.randint(0, len(tag.contents)), 'more text')
+        elif op == 2:
+            tag.extract()
+        elif op == 3:
+            tag.replaceWith(self.new_tag(soup, rng))
+        elif op == 4:
+            tag.name = rng.choice(NAMES)
+            tag._reindex()
+        elif op == 5:
+            tag['id'] = 'i%d' % rng.randint(0, 5)
+        elif op == 6:
+            if 'id' in tag.attrMap:
+                del tag['id']
+        elif op == 7:
+            # move a tag of the document somewhere else in it
+            other = rng.choice(tags)
+            if other is not tag and other.parent is not tag and \
+                    not [parent for parent in tag.findParents() if parent is other]:
+                tag.insert(rng.randint(0, len(tag.contents)), other)
+        else:
+            target = rng.choice(tags)
+            if target is not tag and not [parent for parent in target.findParents() if parent is tag]:
+                readability.move_children(tag, target)
+
+    def test_kept_up_through_mutations(self):
+        for seed in range(40):
+            rng = random.Random(seed)
+            soup = ReadabilitySoup(random_document(rng))
+            for _ in range(30):
+                self.mutate(soup, rng)
+                self.assertIndexed(soup, rng)
+
+    def test_not_rebuilt_for_text(self):
+        soup = ReadabilitySoup('<html><head></head><body><div id="a"><p>one</p></div></body></html>')
+        index = soup._getTagIndex()
+        soup.find('p').append('two')
+        soup.find('div').insert(0, NavigableString('zero'))
+        soup.find('p').replaceWith('gone')
+        self.assertTrue(soup.tagIndex is index)
+        self.assertEqual(soup.findAll('p'), [])
+
+    def test_updated_in_place(self):
+        soup = ReadabilitySoup('<html><head></head><body><div id="a"><p>one</p></div></body></html>')
+        index = soup._getTagIndex()
+        div = soup.find('div')
+        span = Tag(soup, 'span', [('id', 'b')])
+        div.insert(0, span)
+        div['id'] = 'c'
+        div.name = 'section'
+        div._reindex()
+        self.assertTrue(soup.tagIndex is index)
+        self.assertEqual(soup.findAll('span'), [span])
+        self.assertEqual(soup.findAll(id='b'), [span])
+        self.assertEqual(soup.findAll(id='a'), [])
+        self.assertEqual(soup.findAll(id='c'), [div])
+        self.assertEqual(soup.findAll('div'), [])
+        self.assertEqual(soup.findAll('section'), [div])
+        self.assertEqual(div.findAll(['span', 'p']), [span, soup.find('p')])
+
+    def test_rebuilt_when_out_of_room(self):
+        soup = ReadabilitySoup('<html><head></head><body><p>one</p><p>two</p></body></html>')
+        second = soup.findAll('p')[1]
+        inserted = []
+        for k in range(40):
+            tag = Tag(soup, 'span')
+            second.parent.insert(second.parent.contents.index(second), tag)
+            inserted.append(tag)
+            self.assertEqual(soup.findAll('span'), inserted)
+            self.assertEqual(soup.findAll('p')[1], second)
+
+
+def links(nodes):
+    ''' The tree links of every node, as positions in nodes '''
+    position = dict((id(node), k) for k, node in enumerate(nodes))
+    key = lambda node: None if node is None else position.get(id(node), 'outside')
+    shape = []
+    for node in nodes:
+        shape.append((key(node.parent), key(node.next), key(node.previous),
+                      key(node.nextSibling), key(node.previousSibling),
+                      [key(child) for child in getattr(node, 'contents', ())]))
+    return shape
+
+
+def twin_documents(seed):
+    ''' Two copies of the same random document, with their nodes in document order '''
+    markup = random_document(random.Random(seed))
+    twins = []
+    for k in range(2):
+        soup = ReadabilitySoup(markup)
+        twins.append((soup, [soup] + list(soup.recursiveChildGenerator())))
+    return twins
+
+
+class BulkMoveTest(unittest.TestCase):
+
+    def test_move_children(self):
+        for seed in range(60):
+            rng = random.Random(seed)
+            (one, oneNodes), (bulk, bulkNodes) = twin_documents(seed)
+            tags = [k for k, node in enumerate(oneNodes) if isinstance(node, Tag) and node.parent is not None]
+            inBody = [k for k in tags if oneNodes[k].contents and
+                      [parent for parent in oneNodes[k].findParents() if parent is one.body]]
+            source = rng.choice(inBody or tags[-1:])
+            targets = [k for k in tags if k != source and
+                       not [parent for parent in oneNodes[k].findParents() if parent is oneNodes[source]]]
+            target = rng.choice(targets)
+            for child in oneNodes[source].contents[:]:
+                oneNodes[target].append(child)
+            readability.move_children(bulkNodes[source], bulkNodes[target])
+            self.assertEqual(links(bulkNodes), links(oneNodes))
+            self.assertEqual(str(bulk), str(one))
+
+    def test_move_children_to_empty_target(self):
+        soup = ReadabilitySoup('<html><head></head><body><div><p>a</p>b</div><span></span><i>c</i></body></html>')
+        span = soup.find('span')
+        readability.move_children(soup.find('div'), span)
+        self.assertEqual(str(soup.body), '<body><div></div><span><p>a</p>b</span><i>c</i></body>')
+        self.assertTrue(span.contents[0].previous is span)
+        self.assertTrue(span.contents[-1].next is soup.find('i'))
+        self.assertTrue(soup.find('i').previous is span.contents[-1])
+        self.assertEqual(soup.findAll('p'), [span.contents[0]])
+
+    def test_extract_many(self):
+        for seed in range(60):
+            rng = random.Random(seed)
+            (one, oneNodes), (bulk, bulkNodes) = twin_documents(seed)
+            # any nodes but the document itself, so containers are often extracted along with nodes inside them
+            chosen = rng.sample(range(1, len(oneNodes)), rng.randint(1, min(12, len(oneNodes) - 1)))
+            for k in chosen:
+                oneNodes[k].extract()
+            readability.extract_many([bulkNodes[k] for k in chosen])
+            self.assertEqual(links(bulkNodes), links(oneNodes))
+            self.assertEqual(str(bulk), str(one))
+
+    def test_extract_many_nested(self):
+        soup = ReadabilitySoup('<html><head></head><body><div><p>a<b>b</b></p>c</div><i>d</i></body></html>')
+        div, p, b = soup.find('div'), soup.find('p'), soup.find('b')
+        readability.extract_many([b, div, p])
+        self.assertEqual(str(soup.body), '<body><i>d</i></body>')
+        self.assertEqual(str(div), '<div>c</div>')
+        self.assertEqual(str(p), '<p>a</p>')
+        for element in (div, p, b):
+            self.assertTrue(element.parent is None)
+            self.assertTrue(element.previous is None)
+            self.assertTrue(element._lastRecursiveChild().next is None)
+        self.assertTrue(soup.body.next is soup.find('i'))
+        self.assertEqual(soup.findAll('p'), [])
+
+
+SKIPPED = ['<script>var a = "<p>" + b;</script>', '<script><!-- </div> --></script>', '<script>if (a </b) {}</script>',
+           '<style>p { color: red }</style>', '<style><b>bold</b></style>', '<link rel="stylesheet" href="a.css">',
+           '<link rel="next" href="/2">', '<script>', '</script>', '<style>', '</style>', '<script src="a.js"/>']
+
+
+def skip_document(rng):
+    markup = []
+    for k in range(rng.randint(20, 80)):
+        r = rng.random()
+        if r < 0.35:
+            markup.append('<%s>' % rng.choice(NAMES))
+        elif r < 0.6:
+            markup.append('</%s>' % rng.choice(NAMES))
+        elif r < 0.8:
+            markup.append(rng.choice(SKIPPED))
+        else:
+            markup.append('text %d' % k)
+    return '<html><head></head><body>%s</body></html>' % ''.join(markup)
+
+
+class SkipTheseTest(unittest.TestCase):
+
+    def assertSkipped(self, markup, skipThese=ReadabilitySoup.UNREADABLE_ELEMENTS):
+        skipped = ReadabilitySoup(markup, skipThese=skipThese)
+        extracted = ReadabilitySoup(markup)
+        for strainer in skipThese:
+            for tag in extracted.findAll(strainer):
+                tag.extract()
+        self.assertEqual(str(skipped), str(extracted), markup)
+        # not the document's own links: its previous is where the parser left off
+        self.assertEqual(links(list(skipped.recursiveChildGenerator())),
+                         links(list(extracted.recursiveChildGenerator())), markup)
+        return skipped
+
+    def test_same_as_extracting(self):
+        for seed in range(150):
+            self.assertSkipped(skip_document(random.Random(seed)))
+
+    def test_text_around_skipped_tag(self):
+        soup = self.assertSkipped('<html><head></head><body><p>a<script>b</script>c</p></body></html>')
+        p = soup.find('p')
+        self.assertEqual(p.contents, [u'a', u'c'])
+        self.assertTrue(p.contents[0].nextSibling is p.contents[1])
+
+    def test_skipped_by_attributes(self):
+        soup = self.assertSkipped('<html><head><link rel="stylesheet" href="a.css"><link rel="next" href="/2">'
+                                  '</head><body></body></html>')
+        self.assertEqual([link['rel'] for link in soup.findAll('link')], ['next'])
+
+    def test_strainers_without_plain_names(self):
+        strainers = [readability.SoupStrainer(['script', 'style']),
+                     readability.SoupStrainer(lambda tag: tag.get('class') == 'ad')]
+        self.assertTrue(ReadabilitySoup('', skipThese=strainers).skipNames is None)
+        soup = self.assertSkipped('<html><head></head><body><div class="ad"><p>Ad</p></div><p>Story</p>'
+                                  '<style>p {}</style></body></html>', strainers)
+        self.assertEqual(str(soup.body), '<body><p>Story</p></body>')
+
+    def test_quoted_markup_read_through(self):
+        # a handled start tag, a comment and an SGML shorthand, any of which could end the script early
+        for contents in ('<meta charset="utf-8">', '<!-- x </script> -->', '<a/b/', '</p>'):
+            self.assertSkipped('<html><head></head><body><p>a<script>%s</script>b</p></body></html>' % contents)
+
+
+class MarkedTag(Tag):
+    ''' A Tag subclass without __slots__ of its own, so with a __dict__ '''
+
+
+PICKLED = ('<html><head><title>T</title></head><body><div id="a" class="b">a &lt; b & c <i>\xc3\xa9</i>'
+           '<!-- c --><p>y<br/>z</p><![CDATA[x<y]]><?pi x?></div></body></html>')
+
+
+class PickleTest(unittest.TestCase):
+
+    def round_trips(self, value):
+        for module in (pickle, cPickle):
+            for protocol in (0, 1, 2):
+                yield protocol, module.loads(module.dumps(value, protocol))
+
+    def test_documents(self):
+        soup = ReadabilitySoup(PICKLED)
+        nodes = list(soup.recursiveChildGenerator())
+        for protocol, copy in self.round_trips(soup):
+            copies = list(copy.recursiveChildGenerator())
+            self.assertEqual(str(copy), str(soup), protocol)
+            self.assertEqual(links(copies), links(nodes), protocol)
+            self.assertEqual([type(node) for node in copies], [type(node) for node in nodes], protocol)
+            self.assertEqual([unicode(node) for node in copies if isinstance(node, NavigableString)],
+                             [unicode(node) for node in nodes if isinstance(node, NavigableString)], protocol)
+            self.assertEqual(copy.find('div').attrMap, {'id': 'a', 'class': 'b'})
+
+    def test_text(self):
+        soup = ReadabilitySoup(PICKLED)
+        texts = soup.findAll(text=True)
+        for protocol, copies in self.round_trips(texts):
+            for text, copy in zip(texts, copies):
+                # the text itself, not the markup it is written out as
+                self.assertEqual(copy, text, protocol)
+                self.assertTrue(type(copy) is type(text), protocol)
+                self.assertFalse(hasattr(copy, '__dict__'))
+
+    def test_unset_slots(self):
+        tag = Tag(ReadabilitySoup(''), 'p')
+        del tag.textStats
+        for protocol, copy in self.round_trips(tag):
+            self.assertFalse(hasattr(copy, 'textStats'), protocol)
+            self.assertFalse(hasattr(copy, '__dict__'))
+            self.assertEqual(str(copy), '<p></p>')
+
+    def test_subclass_dict(self):
+        tag = MarkedTag(ReadabilitySoup(''), 'p')
+        tag.mark = 'kept'
+        for protocol, copy in self.round_trips(tag):
+            self.assertTrue(type(copy) is MarkedTag)
+            self.assertEqual(copy.mark, 'kept', protocol)
+            self.assertEqual(copy.name, 'p')
+
+
+def classed_document(rng):
+    markup = []
+    for k in range(rng.randint(20, 80)):
+        r = rng.random()
+        if r < 0.45:
+            attrs = rng.choice(['', ' id="i%d"' % rng.randint(0, 3), ' class="c%d"' % rng.randint(0, 2),
+                                ' class="c0 c%d" id="i%d"' % (rng.randint(1, 2), rng.randint(0, 3)),
+                                ' title="t%d"' % rng.randint(0, 1)])
+            markup.append('<%s%s>' % (rng.choice(NAMES), attrs))
+        elif r < 0.75:
+            markup.append('</%s>' % rng.choice(NAMES))
+        else:
+            markup.append('text %d' % k)
+    return '<html><head></head><body>%s</body></html>' % ''.join(markup)
+
+
+def classes(tag):
+    return tag.get('class', '').split()
+
+
+def ancestors(tag):
+    parent = tag.parent
+    while parent is not None and not isinstance(parent, readability.BeautifulStoneSoup):
+        yield parent
+        parent = parent.parent
+
+
+# selectors, and what they select as a test on each tag
+SELECTORS = [
+    ('p', lambda tag: tag.name == 'p'),
+    ('*', lambda tag: True),
+    ('#i1', lambda tag: tag.get('id') == 'i1'),
+    ('.c0', lambda tag: 'c0' in classes(tag)),
+    ('li.c0.c2', lambda tag: tag.name == 'li' and 'c0' in classes(tag) and 'c2' in classes(tag)),
+    ('span#i2.c1', lambda tag: tag.name == 'span' and tag.get('id') == 'i2' and 'c1' in classes(tag)),
+    ('[title]', lambda tag: tag.get('title') is not None),
+    ('[title=t1]', lambda tag: tag.get('title') == 't1'),
+    ('[class~="c1"]', lambda tag: 'c1' in classes(tag)),
+    ('div p', lambda tag: tag.name == 'p' and [a for a in ancestors(tag) if a.name == 'div']),
+    ('div > p', lambda tag: tag.name == 'p' and tag.parent.name == 'div'),
+    ('ul .c0 > a', lambda tag: tag.name == 'a' and 'c0' in classes(tag.parent)
+                               and [a for a in ancestors(tag.parent) if a.name == 'ul']),
+    ('a, #i0', lambda tag: tag.name == 'a' or tag.get('id') == 'i0'),
+]
+
+
+class SelectTest(unittest.TestCase):
+
+    def test_same_as_walking(self):
+        for seed in range(60):
+            markup = classed_document(random.Random(seed))
+            for soup in (ReadabilitySoup(markup), readability.BeautifulSoup(markup)):
+                tags = walk(soup)
+                for selector, test in SELECTORS:
+                    expected = [tag for tag in tags if test(tag)]
+                    self.assertEqual(soup.select(selector), expected, '%s in %s' % (selector, markup))
+                    self.assertEqual(soup.select(selector, limit=2), expected[:2], selector)
+
+    def test_same_as_findall(self):
+        for seed in range(20):
+            soup = ReadabilitySoup(classed_document(random.Random(seed)))
+            self.assertEqual(soup.select('div'), soup.findAll('div'))
+            self.assertEqual(soup.select('#i3'), soup.findAll(id='i3'))
+            self.assertEqual(soup.select('p[title=t0]'), soup.findAll('p', title='t0'))
+
+    def test_ancestors_outside_the_tag(self):
+        soup = ReadabilitySoup('<html><head></head><body><div><p><a id="x">a</a></p></div><a>b</a></body></html>')
+        p = soup.find('p')
+        self.assertEqual(p.select('div a'), [soup.find(id='x')])
+        self.assertEqual(p.select('div > a'), [])
+        self.assertEqual(soup.body.select('body > a'), [soup.findAll('a')[1]])
+
+    def test_unsupported(self):
+        for selector in ('', 'a:hover', 'a + b', 'a ~ b', 'p >', ', p', 'p,', 'p#', '[x', 'p*'):
+            self.assertRaises(ValueError, ReadabilitySoup('<p>a</p>').select, selector)
+
+
+if __name__ == '__main__':
+    unittest.main()